@@ -0,0 +1,136 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from functools import wraps
+from sqlalchemy import text
+from database import Database
+
+log = logging.getLogger(__name__)
+
+ITEM_TABLES = ['items_extracted', 'item', 'item_rollup']
+GOAL_TABLES = ['items_extracted', 'goal', 'goal_rollup']
+
+
+def cached(tables):
+    # results are pickled next to the database, keyed by the database, the function, its parameters and the change
+    # counters of the tables it reads, so they are recomputed only after those tables were written to. The cache
+    # directory stays with the replay files when the database is elsewhere, hence the id of the database
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(db: Database, *args, use_cache: bool = True, **kwargs):
+            if not use_cache or db.cache_dir is None:
+                return fn(db, *args, **kwargs)
+
+            key = json.dumps([db.get_database_id(), fn.__name__, args, sorted(kwargs.items()), db.get_changes(tables)],
+                             default=str)
+            file_path = os.path.join(db.cache_dir, 'analytics',
+                                     f'{fn.__name__}-{hashlib.sha1(key.encode()).hexdigest()}.pkl')
+
+            if os.path.exists(file_path):
+                return pd.read_pickle(file_path)
+
+            result = fn(db, *args, **kwargs)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            pd.to_pickle(result, f'{file_path}.part')
+            os.replace(f'{file_path}.part', file_path)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def in_list(column: str, values, params: dict):
+    # expands a list filter into named parameters, None means no filter
+    if values is None:
+        return ''
+    names = list(map(lambda x: f'{column.replace(".", "_")}_{x[0]}', enumerate(values)))
+    params.update(zip(names, values))
+    return f' AND {column} IN ({", ".join(map(lambda x: f":{x}", names))})'
+
+
+def group_by(columns, by_season: bool):
+    return ', '.join((['season'] if by_season else []) + columns)
+
+
+def read(db: Database, sql: str, params: dict):
+    result = db.engine.execute(text(sql), **params)
+    return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+
+@cached(['items_extracted', 'season'])
+def map_distribution(db: Database, seasons=None):
+    # map x season counts in one pass over the date index instead of a scan per season
+    params = {}
+    df = read(db, 'SELECT s.season, p.map, count(*) AS count FROM items_extracted p '
+                  'JOIN season s ON p.match_date >= s.start_date AND p.match_date < s.end_date '
+                  f'WHERE p.map IS NOT NULL{in_list("s.season", seasons, params)} GROUP BY s.season, p.map', params)
+    return pd.pivot_table(df, values='count', index='map', columns='season', aggfunc='sum', fill_value=0)
+
+
+@cached(ITEM_TABLES)
+def kickoff_items(db: Database, seasons=None, by_season: bool = True):
+    params = {}
+    group = group_by(['item'], by_season)
+    return read(db, f'SELECT {group}, sum(count) AS count FROM item_rollup '
+                    f'WHERE is_kickoff = 1{in_list("season", seasons, params)} GROUP BY {group}', params)
+
+
+@cached(ITEM_TABLES)
+def wait_time_by_rank(db: Database, items=None, seasons=None, maps=None, by_season: bool = True):
+    # mean and standard deviation come from the count, sum and sum of squares kept in the rollup
+    params = {}
+    group = group_by(['avg_rank', 'item'], by_season)
+    df = read(db, f'SELECT {group}, sum(wait_count) AS count, sum(wait_sum) AS wait_sum, '
+                  'sum(wait_sumsq) AS wait_sumsq FROM item_rollup WHERE avg_rank >= 0 AND wait_count > 0'
+                  f'{in_list("item", items, params)}{in_list("season", seasons, params)}{in_list("map", maps, params)} '
+                  f'GROUP BY {group}', params)
+    df['mean'] = df['wait_sum'] / df['count']
+    df['std'] = np.sqrt(np.maximum(df['wait_sumsq'] / df['count'] - df['mean'] ** 2, 0))
+    return df.drop(['wait_sum', 'wait_sumsq'], axis=1)
+
+
+@cached(['items_extracted', 'item', 'season'])
+def wait_time_samples(db: Database, items=None, seasons=None):
+    # the raw wait times for box plots, read once for every item instead of once per item
+    params = {}
+    return read(db, 'SELECT s.season, p.avg_rank, i.item, i.wait_time FROM item i '
+                    'JOIN items_extracted p ON i.parent_id = p.id '
+                    'LEFT JOIN season s ON p.match_date >= s.start_date AND p.match_date < s.end_date '
+                    'WHERE p.avg_rank IS NOT NULL AND i.wait_time IS NOT NULL'
+                    f'{in_list("i.item", items, params)}{in_list("s.season", seasons, params)}', params)
+
+
+@cached(ITEM_TABLES)
+def win_edge(db: Database, seasons=None, maps=None, by_season: bool = True):
+    # (picked up by the winner - picked up by the loser) / picked up per item, rank and season
+    params = {}
+    group = group_by(['avg_rank', 'item'], by_season)
+    df = read(db, f'SELECT {group}, '
+                  'sum(CASE WHEN winner = 1 THEN count ELSE 0 END) AS winner, '
+                  'sum(CASE WHEN winner = 0 THEN count ELSE 0 END) AS loser FROM item_rollup '
+                  f'WHERE avg_rank >= 0 AND winner >= 0{in_list("season", seasons, params)}'
+                  f'{in_list("map", maps, params)} GROUP BY {group}', params)
+    df['edge'] = (df['winner'] - df['loser']) / (df['winner'] + df['loser'])
+    return df
+
+
+@cached(GOAL_TABLES)
+def goal_breakdown(db: Database, seasons=None, maps=None, by_season: bool = True):
+    # goals per item (-1 for no item) and whether the scorer held an item before, per rank and season
+    params = {}
+    group = group_by(['avg_rank', 'item', 'pre_item'], by_season)
+    return read(db, f'SELECT {group}, sum(count) AS count FROM goal_rollup '
+                    f'WHERE avg_rank >= 0{in_list("season", seasons, params)}{in_list("map", maps, params)} '
+                    f'GROUP BY {group}', params)
+
+
+def pre_item_goal_share(db: Database, seasons=None, maps=None, by_season: bool = True):
+    df = goal_breakdown(db, seasons=seasons, maps=maps, by_season=by_season)
+    df = pd.pivot_table(df, values='count', index=group_by(['avg_rank'], by_season).split(', '), columns='pre_item',
+                        aggfunc='sum', fill_value=0)
+    # goals with an unknown pre_item (-1) are left out like the notebook does
+    return df.get(1, 0) / (df.get(0, 0) + df.get(1, 0))
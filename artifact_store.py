@@ -0,0 +1,187 @@
+import os
+import io
+import shutil
+import hashlib
+import tempfile
+from datetime import datetime
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# kind: (directory, extension, compressed). Frames are memory-mapped, the sidecars are tiny and df is gzipped already,
+# so only the raw replays and the protos are compressed
+KINDS = {
+    'replay': ('replays', '.replay', True),
+    'proto': ('stats', '.pts', True),
+    'frames': ('frames', '.frames', False),
+    'summary': ('summary', '.json', False),
+    'items': ('items', '.json', False),
+    'df': ('df', '.gzip', False),
+    'log': ('logs', '.log', False)
+}
+ZSTD_EXTENSION = '.zst'
+SHARD_DEPTH = 2
+CHUNK_SIZE = 1024 * 1024
+
+
+def shard(replay_hash: str):
+    # two levels of two hash characters, a million replays leave about 15 files per directory
+    return os.path.join(*map(lambda x: replay_hash[x * 2:x * 2 + 2], range(SHARD_DEPTH)))
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise RuntimeError('Compressed artifacts need zstandard')
+    return zstandard
+
+
+def file_checksum(file_obj):
+    # size and blake2b of the uncompressed content
+    digest = hashlib.blake2b(digest_size=16)
+    size = 0
+    for chunk in iter(lambda: file_obj.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    return size, digest.hexdigest()
+
+
+class ArtifactStore(object):
+    # every file the pipeline keeps per replay, under <kind dir>/<shard>/<hash><extension>[.zst]. Files from before
+    # the store in the flat <kind dir>/<hash><extension> layout are still found until migrate_artifacts.py moves
+    # them. Written artifacts are passed to the manifest, a Database.artifact_writer(), when there is one
+
+    def __init__(self, directory: str, compress: bool = True, level: int = 3, manifest=None):
+        self.directory = directory
+        self.compress = compress and zstandard is not None
+        self.level = level
+        self.manifest = manifest
+
+    def path(self, replay_hash: str, kind: str, compressed: bool = False):
+        directory, extension, _ = KINDS[kind]
+        return os.path.join(self.directory, directory, shard(replay_hash),
+                            f'{replay_hash}{extension}{ZSTD_EXTENSION if compressed else ""}')
+
+    def legacy_path(self, replay_hash: str, kind: str):
+        directory, extension, _ = KINDS[kind]
+        return os.path.join(self.directory, directory, f'{replay_hash}{extension}')
+
+    def candidates(self, replay_hash: str, kind: str):
+        compressed = [self.path(replay_hash, kind, True)] if KINDS[kind][2] else []
+        return compressed + [self.path(replay_hash, kind), self.legacy_path(replay_hash, kind)]
+
+    def locate(self, replay_hash: str, kind: str):
+        return next(filter(os.path.exists, self.candidates(replay_hash, kind)), None)
+
+    def exists(self, replay_hash: str, kind: str):
+        return self.locate(replay_hash, kind) is not None
+
+    def open(self, replay_hash: str, kind: str):
+        # a readable binary file of the uncompressed content
+        file_path = self.locate(replay_hash, kind)
+        if file_path is None:
+            raise FileNotFoundError(f'No {kind} artifact for {replay_hash}')
+        return self.open_path(file_path)
+
+    def open_path(self, file_path: str):
+        f = open(file_path, 'rb')
+        if file_path.endswith(ZSTD_EXTENSION):
+            return require_zstandard().ZstdDecompressor().stream_reader(f, closefd=True)
+        return f
+
+    def read(self, replay_hash: str, kind: str):
+        with self.open(replay_hash, kind) as f:
+            return f.read()
+
+    @contextmanager
+    def local_path(self, replay_hash: str, kind: str):
+        # a plain file for readers that only take a path, compressed artifacts are decompressed to a temporary file
+        file_path = self.locate(replay_hash, kind)
+        if file_path is None:
+            raise FileNotFoundError(f'No {kind} artifact for {replay_hash}')
+        if not file_path.endswith(ZSTD_EXTENSION):
+            yield file_path
+            return
+
+        with tempfile.NamedTemporaryFile(suffix=KINDS[kind][1], delete=False) as tmp, \
+                self.open(replay_hash, kind) as f:
+            shutil.copyfileobj(f, tmp, CHUNK_SIZE)
+        try:
+            yield tmp.name
+        finally:
+            os.remove(tmp.name)
+
+    def target(self, replay_hash: str, kind: str):
+        # where writers that need a path put an uncompressed artifact, register() it once the file is complete
+        file_path = self.path(replay_hash, kind)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        return file_path
+
+    def put(self, replay_hash: str, kind: str, source_path: str):
+        # moves a finished file into the store, compressing it when the kind is compressed
+        compressed = self.compress and KINDS[kind][2]
+        file_path = self.path(replay_hash, kind, compressed)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        with open(source_path, 'rb') as f:
+            size, checksum = file_checksum(f)
+
+        if compressed:
+            with open(source_path, 'rb') as src, open(f'{file_path}.part', 'wb') as dst:
+                require_zstandard().ZstdCompressor(level=self.level).copy_stream(src, dst)
+            os.replace(f'{file_path}.part', file_path)
+            os.remove(source_path)
+        else:
+            shutil.move(source_path, file_path)
+
+        return self._record(replay_hash, kind, file_path, size, checksum)
+
+    def write(self, replay_hash: str, kind: str, data: bytes):
+        compressed = self.compress and KINDS[kind][2]
+        file_path = self.path(replay_hash, kind, compressed)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        size, checksum = file_checksum(io.BytesIO(data))
+        with open(f'{file_path}.part', 'wb') as f:
+            f.write(require_zstandard().ZstdCompressor(level=self.level).compress(data) if compressed else data)
+        os.replace(f'{file_path}.part', file_path)
+
+        return self._record(replay_hash, kind, file_path, size, checksum)
+
+    def register(self, replay_hash: str, kind: str, file_path: str = None):
+        file_path = file_path or self.locate(replay_hash, kind)
+        with self.open_path(file_path) as f:
+            size, checksum = file_checksum(f)
+        return self._record(replay_hash, kind, file_path, size, checksum)
+
+    def _record(self, replay_hash: str, kind: str, file_path: str, size: int, checksum: str):
+        # a copy in another layout would shadow or duplicate the new file
+        for other in filter(lambda x: x != file_path and os.path.exists(x), self.candidates(replay_hash, kind)):
+            os.remove(other)
+
+        entry = {
+            'hash': replay_hash,
+            'kind': kind,
+            'path': os.path.relpath(file_path, self.directory),
+            'size': os.path.getsize(file_path),
+            'raw_size': size,
+            'checksum': checksum,
+            'compression': 'zstd' if file_path.endswith(ZSTD_EXTENSION) else None,
+            'created': datetime.utcnow()
+        }
+        if self.manifest is not None:
+            self.manifest.add(entry)
+        return entry
+
+    def hashes(self, kind: str):
+        # every hash with an artifact of this kind on disk, sharded or flat
+        directory, extension, _ = KINDS[kind]
+        root = os.path.join(self.directory, directory)
+
+        for path, _, files in os.walk(root):
+            for file in files:
+                name = file[:-len(ZSTD_EXTENSION)] if file.endswith(ZSTD_EXTENSION) else file
+                if name.endswith(extension):
+                    yield name[:-len(extension)]
@@ -0,0 +1,72 @@
+import logging
+from functools import partial
+from multiprocessing import Pool
+from sqlalchemy import bindparam, text
+from database import Database, ItemsExtracted, update_rollups, rebuild_rollups, record_changes
+from metrics import Instrumented, Progress
+from discovery import keyset_chunks, count, imap_bounded
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+def run_statement(db: Database, statement, tables=(), rollups: bool = False, **params):
+    # database-to-database backfills are a single set-based statement, set rollups if it changes columns the rollup
+    # tables are keyed on and the statement does not keep them in sync itself. A list of statements runs in one
+    # transaction, the row count is the one of the last
+    statements = statement if isinstance(statement, list) else [statement]
+    with db.engine.begin() as connection:
+        for statement in statements:
+            result = connection.execute(text(statement) if isinstance(statement, str) else statement, **params)
+        if rollups:
+            rebuild_rollups(connection)
+        record_changes(connection, tables)
+    return result.rowcount
+
+
+def compute_chunk(rows, compute, directory: str):
+    updates = []
+    for row in rows:
+        try:
+            with metrics.timer('compute'):
+                values = compute(*row[1:], directory=directory)
+        except Exception as e:
+            log.error(f'Failed to backfill {row}', exc_info=e)
+            continue
+        if values is not None:
+            updates.append(dict(values, _id=row[0]))
+    return len(rows), updates
+
+
+def run_file_backfill(db: Database, directory: str, table, columns, compute, where=None, processes: int = 1,
+                      chunk_size: int = 1000, args=None):
+    # compute(*columns, directory=...) returns the new column values for a row, or None to leave it alone. args are
+    # the parsed arguments of metrics.add_arguments, profiles are kept per chunk
+    total = count(db, table, where)
+    progress = Progress.from_args(f'backfill-{table.name}', total, args) if args is not None else \
+        Progress(f'backfill-{table.name}', total)
+    task = Instrumented(partial(compute_chunk, compute=compute, directory=directory), progress.profile_slowest > 0)
+    updated = 0
+    statement = None
+
+    with Pool(processes) as p:
+        chunks = keyset_chunks(db, table, columns, where, chunk_size)
+        for (rows, updates), timings, profile in imap_bounded(p, task, chunks, processes * 2):
+            if len(updates) > 0:
+                if statement is None:
+                    values = dict(map(lambda x: (x, bindparam(x)), filter(lambda x: x != '_id', updates[0].keys())))
+                    statement = table.update().where(table.c.id == bindparam('_id')).values(values)
+
+                with metrics.timer('db_flush'), db.engine.begin() as connection:
+                    if table is ItemsExtracted.__table__:
+                        update_rollups(connection, map(lambda x: x['_id'], updates), -1)
+                    connection.execute(statement, updates)
+                    if table is ItemsExtracted.__table__:
+                        update_rollups(connection, map(lambda x: x['_id'], updates))
+                    record_changes(connection, [table.name])
+                updated += len(updates)
+
+            progress.update(rows, timings=timings, profile=profile)
+
+    progress.close()
+    return updated
@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from carball.generated.api import game_pb2
+from artifact_store import ArtifactStore
+from frame_store import write_frames
+from replay_summary import write_summary, summarize
+from item_sidecar import write_item_uses
+from generate_average_heatmaps import item_map
+from map import standard_maps
+
+# one name per item number, batarang shares its number with ball_lasso
+ITEM_NAMES = dict(map(lambda x: (x[1], x[0]), reversed(list(item_map.items()))))
+FPS = 30
+KICKOFF_FRAMES = 90
+GOAL_RESET_FRAMES = 150
+
+
+def make_game(rng: np.random.Generator, frame_count: int, player_count: int, map_name: str):
+    # a rumble game: kickoffs with an item for everyone shortly after, goals that reset the field and items picked up
+    # and used by every player in between
+    game = game_pb2.Game()
+    game.game_metadata.map = map_name
+
+    for i in range(player_count):
+        player = game.players.add()
+        player.id.id = f'7656119{rng.integers(10 ** 9, 10 ** 10)}'
+        player.name = f'Player {i}'
+        player.is_orange = i >= player_count // 2
+
+    goal_count = int(rng.integers(1, 8))
+    goal_frames = np.sort(rng.choice(np.arange(KICKOFF_FRAMES * 3, frame_count - GOAL_RESET_FRAMES * 2),
+                                     goal_count, replace=False))
+    goal_frames = goal_frames[np.diff(goal_frames, prepend=0) > GOAL_RESET_FRAMES * 2]
+    kickoff_frames = [10] + list(map(lambda x: int(x) + GOAL_RESET_FRAMES, goal_frames))
+
+    for frame in kickoff_frames:
+        game.game_stats.kickoffs.add().start_frame_number = frame
+
+    # items are picked up from shortly after a kickoff until the next goal, nothing happens between a goal and the
+    # kickoff after it
+    items = []
+
+    for player in game.players:
+        for start, end in zip(kickoff_frames, list(goal_frames) + [frame_count]):
+            frame = start + KICKOFF_FRAMES + int(rng.integers(0, 2))
+            while frame < end:
+                item = int(rng.integers(1, len(ITEM_NAMES) + 1))
+                use = frame + int(rng.integers(15, 300))
+                if use >= end:
+                    use = -1
+                items.append((frame, use, item, player.id.id))
+                if use < 0:
+                    break
+                frame = use + int(rng.integers(20, 400))
+
+    items.sort()
+    for frame_get, frame_use, item, player_id in items:
+        event = game.game_stats.rumble_items.add()
+        event.frame_number_get = frame_get
+        event.frame_number_use = frame_use
+        event.item = item
+        event.player_id.id = player_id
+
+    scores = [0, 0]
+    for frame in goal_frames:
+        scorer = game.players[int(rng.integers(0, player_count))]
+        goal = game.game_metadata.goals.add()
+        goal.frame_number = int(frame)
+        goal.player_id.id = scorer.id.id
+        goal.extra_mode_info.pre_items = bool(rng.random() < 0.5)
+        goal.extra_mode_info.scored_with_item = bool(rng.random() < 0.3)
+        if goal.extra_mode_info.scored_with_item:
+            goal.extra_mode_info.used_item = int(rng.integers(1, len(ITEM_NAMES) + 1))
+        scores[1 if scorer.is_orange else 0] += 1
+
+    game.game_metadata.score.team_0_score, game.game_metadata.score.team_1_score = scores
+    game.game_metadata.frames = frame_count
+
+    return game
+
+
+def make_frames(rng: np.random.Generator, game, frame_count: int):
+    # the columns the extractors read: game time and per player position, held item and whether it is active
+    columns = {('game', 'time'): np.cumsum(rng.normal(1 / FPS, 0.002, frame_count)).astype(np.float32),
+               ('game', 'delta'): np.full(frame_count, 1 / FPS, dtype=np.float32)}
+    limits = {'pos_x': 4000, 'pos_y': 5000, 'pos_z': 2000}
+
+    for player in game.players:
+        for field, limit in limits.items():
+            walk = np.cumsum(rng.normal(0, 30, frame_count))
+            columns[(player.name, field)] = (np.abs((walk + limit) % (4 * limit) - 2 * limit) - limit) \
+                .astype(np.float32)
+        columns[(player.name, 'pos_z')] = np.abs(columns[(player.name, 'pos_z')])
+
+        power_up = np.full(frame_count, np.nan, dtype=object)
+        power_up_active = np.full(frame_count, np.nan, dtype=object)
+
+        for event in filter(lambda x: x.player_id.id == player.id.id, game.game_stats.rumble_items):
+            end = event.frame_number_use if event.frame_number_use > -1 else frame_count
+            power_up[event.frame_number_get:end] = ITEM_NAMES[event.item]
+            power_up_active[event.frame_number_get:end] = False
+            if event.frame_number_use > -1:
+                power_up[end:end + 10] = ITEM_NAMES[event.item]
+                power_up_active[end:end + 10] = True
+
+        columns[(player.name, 'power_up')] = power_up
+        columns[(player.name, 'power_up_active')] = power_up_active
+
+    df = pd.DataFrame(columns, index=np.arange(frame_count))
+    df.columns = pd.MultiIndex.from_tuples(list(columns.keys()))
+    return df
+
+
+def make_replay(directory: str, replay_hash: str, rng: np.random.Generator, frame_count: int = 9000,
+                player_count: int = 6):
+    # writes the proto, the frame store and the sidecars and returns the replay like the api lists it
+    game = make_game(rng, frame_count, player_count, str(rng.choice(sorted(standard_maps))))
+    store = ArtifactStore(directory)
+
+    store.write(replay_hash, 'proto', game.SerializeToString())
+    frames = make_frames(rng, game, frame_count)
+    write_frames(store.target(replay_hash, 'frames'), frames)
+    write_summary(directory, replay_hash, game)
+    write_item_uses(directory, replay_hash, summarize(game), frames)
+
+    match_date = datetime(2019, 1, 1) + timedelta(days=int(rng.integers(0, 330)))
+    ranks = list(map(int, rng.integers(1, 20, player_count)))
+    return {
+        'hash': replay_hash,
+        'download': f'/replays/{replay_hash}/download',
+        'mmrs': list(map(lambda x: int(x * 60 + rng.integers(0, 60)), ranks)),
+        'ranks': ranks,
+        'match_date': match_date.isoformat(),
+        'upload_date': (match_date + timedelta(hours=1)).isoformat()
+    }
+
+
+def make_fixtures(directory: str, count: int, frame_count: int = 9000, player_count: int = 6, seed: int = 0):
+    os.makedirs(directory, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    # spread over the shard directories like real replay hashes
+    replays = list(map(lambda x: make_replay(directory, hashlib.md5(f'{seed}-{x}'.encode()).hexdigest().upper(), rng,
+                                             frame_count, player_count), range(count)))
+
+    with open(os.path.join(directory, 'replays.json'), 'w') as f:
+        json.dump(replays, f)
+
+    return replays
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes synthetic parsed replays for benchmarks')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-n', '--count', type=int, default=100)
+    parser.add_argument('--frames', type=int, default=9000, help='Frames per replay, 9000 is five minutes')
+    parser.add_argument('--players', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    make_fixtures(args.directory, args.count, args.frames, args.players, args.seed)
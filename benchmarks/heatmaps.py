@@ -0,0 +1,86 @@
+import time
+import itertools
+import argparse
+import numpy as np
+import pandas as pd
+from generate_average_heatmaps import process, item_map, heatmap_bins, heatmap_range
+from frame_store import load_frames
+from replay_summary import load_summary
+from artifact_store import ArtifactStore
+
+
+def process_reference(replay_hash: str, directory: str):
+    # the pandas implementation process() replaced, kept to check and time the kernel against
+    summary = load_summary(directory, replay_hash)
+    columns = []
+    for player in summary['players']:
+        columns += [(player['name'], field) for field in ['pos_x', 'pos_y', 'pos_z', 'power_up', 'power_up_active']]
+    df = load_frames(directory, replay_hash, columns)
+
+    if len(summary['kickoffs']) > 0:
+        df.drop(df.loc[0:summary['kickoffs'][0]].index, inplace=True, errors='ignore')
+
+        for i, goal in enumerate(summary['goals']):
+            if len(summary['kickoffs']) > i + 1:
+                kickoff = summary['kickoffs'][i + 1]
+            else:
+                kickoff = df.index[-1].item()
+
+            df.drop(df.loc[goal['frame']:kickoff].index, inplace=True, errors='ignore')
+
+    item_dfs = []
+
+    for i in range(11):
+        item_dfs.append(pd.DataFrame(columns=['pos_x', 'pos_y', 'pos_z']))
+
+    for player in summary['players']:
+        pdf = df[player['name']].copy()
+        if 'power_up_active' not in pdf.columns:
+            continue
+        if 'power_up' not in pdf.columns:
+            continue
+        pdf['power_up_active'] = pdf['power_up_active'].astype(object)
+        while len(pdf.loc[(pdf['power_up_active'].shift(1) == True) & (pdf['power_up_active'] == False)]) > 0:
+            pdf = pdf.loc[(pdf['power_up_active'].shift(1) != True) | (pdf['power_up_active'] != False)]
+
+        pdf = pdf[pdf['power_up_active'] == False].copy()
+
+        if player['is_orange']:
+            pdf['pos_y'] = -pdf['pos_y']
+            pdf['pos_x'] = -pdf['pos_x']
+
+        for item_name in item_map.keys():
+            # DataFrame.append in the original, which newer pandas no longer has
+            item_dfs[item_map[item_name] - 1] = pd.concat(
+                [item_dfs[item_map[item_name] - 1], pdf.loc[pdf['power_up'] == item_name][['pos_x', 'pos_y', 'pos_z']]],
+                ignore_index=True)
+
+    return list(map(lambda x: np.histogram2d(x['pos_x'].astype(np.float64), x['pos_y'].astype(np.float64),
+                                             heatmap_bins, heatmap_range)[0], item_dfs))
+
+
+def benchmark(fn, hashes, directory: str):
+    results = []
+    start = time.perf_counter()
+    for replay_hash in hashes:
+        results.append(fn(replay_hash, directory))
+    return results, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the heatmap kernel against the pandas implementation')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-n', '--count', type=int, default=50)
+    args = parser.parse_args()
+
+    hashes = list(itertools.islice(ArtifactStore(args.directory).hashes('summary'), args.count))
+
+    reference, reference_time = benchmark(process_reference, hashes, args.directory)
+    kernel, kernel_time = benchmark(process, hashes, args.directory)
+
+    mismatches = sum(1 for a, b in zip(reference, kernel) if not all(map(np.array_equal, a, b)))
+
+    print(f'replays:   {len(hashes)}')
+    print(f'reference: {reference_time / len(hashes) * 1000:.1f} ms/replay')
+    print(f'kernel:    {kernel_time / len(hashes) * 1000:.1f} ms/replay ({reference_time / kernel_time:.1f}x)')
+    print(f'mismatches: {mismatches}')
@@ -0,0 +1,293 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from benchmarks.fixtures import make_fixtures
+from artifact_store import ArtifactStore
+from database import Database, ReplayRecord
+from download_replays import ReplayDownloader
+from extract_item_events import process_replay, is_kickoff_item, get_kickoff_items
+from item_sidecar import get_frame_columns, get_item_uses, read_item_uses
+from generate_average_heatmaps import process
+from frame_store import load_frames
+from replay_summary import load_summary, summarize
+from carball.analysis.utils.proto_manager import ProtobufManager
+
+
+def timed(fn, replays):
+    latencies = []
+    for replay in replays:
+        start = time.perf_counter()
+        fn(replay)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_summary(context, replays):
+    # the proto fallback of load_summary, what every stage paid before the summary sidecar
+    store = ArtifactStore(context['directory'])
+
+    def parse(replay):
+        with store.open(replay['hash'], 'proto') as f:
+            summarize(ProtobufManager.read_proto_out_from_file(f))
+
+    return timed(parse, replays)
+
+
+def bench_frames(context, replays):
+    return timed(lambda x: load_frames(context['directory'], x['hash'],
+                                       get_frame_columns(load_summary(context['directory'], x['hash']))), replays)
+
+
+def bench_item_uses_frames(context, replays):
+    # what item extraction paid before the item sidecar
+    def run(replay):
+        summary = load_summary(context['directory'], replay['hash'])
+        get_item_uses(summary, load_frames(context['directory'], replay['hash'], get_frame_columns(summary)))
+
+    return timed(run, replays)
+
+
+def bench_item_uses(context, replays):
+    directory = context['directory']
+    return timed(lambda x: read_item_uses(directory, x['hash'], load_summary(directory, x['hash'])), replays)
+
+
+def get_items(context, replay):
+    summary = load_summary(context['directory'], replay['hash'])
+    player_ids = np.array(list(map(lambda x: x['player_id'], summary['rumble_items'])))
+    frame_get = np.array(list(map(lambda x: x['frame_get'], summary['rumble_items'])), dtype=np.int64)
+    return summary, player_ids, frame_get
+
+
+def bench_is_kickoff_item(context, replays):
+    # the per item scan get_kickoff_items replaced
+    inputs = dict(map(lambda x: (x['hash'], get_items(context, x)), replays))
+
+    def run(replay):
+        summary, player_ids, frame_get = inputs[replay['hash']]
+        return list(map(lambda x: is_kickoff_item(x[1], summary, x[0]), zip(player_ids, frame_get)))
+
+    return timed(run, replays)
+
+
+def bench_kickoff_items(context, replays):
+    inputs = dict(map(lambda x: (x['hash'], get_items(context, x)), replays))
+    return timed(lambda x: get_kickoff_items(*inputs[x['hash']]), replays)
+
+
+def bench_item_events(context, replays):
+    return timed(lambda x: process_replay(x, context['directory']), replays)
+
+
+def bench_heatmaps(context, replays):
+    return timed(lambda x: process(x['hash'], context['directory']), replays)
+
+
+def bench_replay_ingest(context, replays):
+    # batched writes have no per replay latency, the whole run is spread over the replays
+    directory = tempfile.mkdtemp(dir=context['work_dir'])
+    db = Database(directory)
+    records = list(map(ReplayRecord.create, replays))
+
+    start = time.perf_counter()
+    ingest = db.bulk_ingest()
+    for record in records:
+        ingest.add(record)
+    ingest.close()
+    elapsed = time.perf_counter() - start
+
+    db.close()
+    return elapsed
+
+
+def bench_extraction_write(context, replays):
+    directory = tempfile.mkdtemp(dir=context['work_dir'])
+    db = Database(directory)
+    results = list(map(lambda x: process_replay(x, context['directory']), replays))
+
+    start = time.perf_counter()
+    writer = db.extraction_writer()
+    for events, replay_data in results:
+        writer.add(replay_data, events)
+    writer.close()
+    elapsed = time.perf_counter() - start
+
+    db.close()
+    return elapsed
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = b''
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TimedDownloader(ReplayDownloader):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def download(self, replay):
+        start = time.perf_counter()
+        result = super().download(replay)
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+
+def bench_download(context, replays):
+    # downloads from a local server that answers every request with a replay sized body after a fixed latency
+    handler = type('Handler', (StubHandler,), {'body': os.urandom(context['replay_size'] * 1024),
+                                               'latency': context['latency'] / 1000})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    directory = tempfile.mkdtemp(dir=context['work_dir'])
+    downloader = TimedDownloader(directory, f'http://127.0.0.1:{server.server_port}', context['downloads'])
+
+    start = time.perf_counter()
+    downloader.download_all(replays, lambda x: None)
+    elapsed = time.perf_counter() - start
+
+    downloader.close()
+    server.shutdown()
+    server.server_close()
+    return downloader.latencies, elapsed
+
+
+STAGES = {
+    'summary': bench_summary,
+    'frames': bench_frames,
+    'item_uses_frames': bench_item_uses_frames,
+    'item_uses': bench_item_uses,
+    'is_kickoff_item': bench_is_kickoff_item,
+    'kickoff_items': bench_kickoff_items,
+    'item_events': bench_item_events,
+    'heatmaps': bench_heatmaps,
+    'replay_ingest': bench_replay_ingest,
+    'extraction_write': bench_extraction_write,
+    'download': bench_download
+}
+
+
+def run_stage(fn, context, replays):
+    # stages return per replay latencies, a total for batched stages, or both for concurrent ones
+    start = time.perf_counter()
+    result = fn(context, replays)
+    elapsed = time.perf_counter() - start
+
+    latencies = None
+    if isinstance(result, tuple):
+        latencies, elapsed = result
+    elif isinstance(result, list):
+        latencies = result
+    else:
+        elapsed = result
+
+    stats = {'replays': len(replays), 'seconds': elapsed, 'replays_per_second': len(replays) / elapsed}
+    if latencies is not None and len(latencies) > 0:
+        stats['mean_ms'] = float(np.mean(latencies) * 1000)
+        stats['p50_ms'] = float(np.percentile(latencies, 50) * 1000)
+        stats['p95_ms'] = float(np.percentile(latencies, 95) * 1000)
+    else:
+        stats['mean_ms'] = elapsed / len(replays) * 1000
+    return stats
+
+
+def measure_memory(fn, context, replays):
+    # a separate run so that tracing does not distort the timings
+    tracemalloc.start()
+    try:
+        fn(context, replays)
+        return tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    finally:
+        tracemalloc.stop()
+
+
+def print_results(results, baseline=None):
+    header = f'{"stage":<18}{"replays":>8}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}{"replays/s":>12}{"peak MiB":>10}'
+    print(header + ('' if baseline is None else f'{"vs base":>10}'))
+
+    for stage, stats in results.items():
+        line = f'{stage:<18}{stats["replays"]:>8}{stats["mean_ms"]:>10.2f}' \
+               f'{stats.get("p50_ms", float("nan")):>10.2f}{stats.get("p95_ms", float("nan")):>10.2f}' \
+               f'{stats["replays_per_second"]:>12.1f}{stats.get("peak_mib", float("nan")):>10.1f}'
+        if baseline is not None and stage in baseline:
+            line += f'{stats["replays_per_second"] / baseline[stage]["replays_per_second"]:>9.2f}x'
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times every stage of the pipeline on synthetic replays')
+    parser.add_argument('-d', '--directory', type=str, default=None,
+                        help='Fixture directory, generated if it has no replays.json. Defaults to a temporary one')
+    parser.add_argument('-n', '--count', type=int, default=50)
+    parser.add_argument('--frames', type=int, default=9000)
+    parser.add_argument('--players', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-s', '--stages', nargs='+', choices=list(STAGES.keys()), default=list(STAGES.keys()))
+    parser.add_argument('--memory-sample', type=int, default=5,
+                        help='Replays to run again with allocation tracing for the peak memory, 0 to skip')
+    parser.add_argument('--replay-size', type=int, default=1500, help='KiB served per download')
+    parser.add_argument('--latency', type=float, default=20, help='Milliseconds the stub server waits per request')
+    parser.add_argument('--downloads', type=int, default=16, help='Concurrent downloads')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Write the results as json')
+    parser.add_argument('-b', '--baseline', type=str, default=None, help='Results json of an earlier run to compare')
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp(prefix='rl-stats-bench-')
+    replays_file = os.path.join(directory, 'replays.json')
+    if not os.path.exists(replays_file):
+        make_fixtures(directory, args.count, args.frames, args.players, args.seed)
+    with open(replays_file) as f:
+        replays = json.load(f)[:args.count]
+
+    # the api listing form for downloads and ingest, the database form for extraction
+    extracted = list(map(lambda x: ReplayRecord.create(x).as_dict(), replays))
+    context = {
+        'directory': directory,
+        'work_dir': tempfile.mkdtemp(prefix='rl-stats-bench-work-'),
+        'replay_size': args.replay_size,
+        'latency': args.latency,
+        'downloads': args.downloads
+    }
+
+    results = {}
+    try:
+        for stage in args.stages:
+            inputs = replays if stage in ('replay_ingest', 'download') else extracted
+            results[stage] = run_stage(STAGES[stage], context, inputs)
+            if args.memory_sample > 0:
+                results[stage]['peak_mib'] = measure_memory(STAGES[stage], context, inputs[:args.memory_sample])
+    finally:
+        shutil.rmtree(context['work_dir'], ignore_errors=True)
+        if args.directory is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,178 @@
+import os
+import sys
+import glob
+import logging
+import argparse
+from sqlalchemy import select, func, and_
+from database import Database, ItemsExtracted, ItemRecord, GoalRecord, SeasonRecord
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+log = logging.getLogger(__name__)
+
+STATE_KEY = 'columnar.last_parent_id'
+PARTITIONS = ['season', 'avg_rank']
+TABLES = {
+    'items_extracted': ItemsExtracted.__table__,
+    'item': ItemRecord.__table__,
+    'goal': GoalRecord.__table__
+}
+
+
+def columnar_path(directory: str, table: str = None):
+    path = os.path.join(directory, 'columnar')
+    return path if table is None else os.path.join(path, table)
+
+
+def get_arrow_type(column):
+    python_type = column.type.python_type
+    if python_type is bool:
+        return pa.bool_()
+    if python_type is int:
+        return pa.int64()
+    if python_type is float:
+        return pa.float64()
+    if python_type.__name__ == 'datetime':
+        return pa.timestamp('us')
+    return pa.string()
+
+
+def get_export_query(name: str):
+    # every table is written with the replay's season, rank, map and winner so that scans can filter on them
+    # without a join, -1 stands for an unknown season or rank like in the rollups
+    parent = ItemsExtracted.__table__
+    season = SeasonRecord.__table__
+    table = TABLES[name]
+
+    columns = [parent.c.id.label('parent_id'), parent.c.hash, parent.c.avg_mmr, parent.c.map, parent.c.match_date,
+               parent.c.orange_winner] if name == 'items_extracted' else \
+        list(table.c) + [parent.c.map, parent.c.orange_winner]
+    columns += [func.coalesce(season.c.season, -1).label('season'),
+                func.coalesce(parent.c.avg_rank, -1).label('avg_rank')]
+
+    joined = parent if name == 'items_extracted' else table.join(parent, table.c.parent_id == parent.c.id)
+    joined = joined.outerjoin(season, and_(parent.c.match_date >= season.c.start_date,
+                                           parent.c.match_date < season.c.end_date))
+    query = select(columns).select_from(joined)
+    return query, columns
+
+
+def get_schema(columns):
+    return pa.schema(list(map(lambda x: (x.name, get_arrow_type(x)), columns)))
+
+
+def export_chunk(db: Database, directory: str, low: int, high: int):
+    parent = ItemsExtracted.__table__
+
+    for name in TABLES:
+        query, columns = get_export_query(name)
+        rows = db.engine.execute(query.where(and_(parent.c.id > low, parent.c.id <= high))).fetchall()
+        if len(rows) == 0:
+            continue
+
+        schema = get_schema(columns)
+        table = pa.table(list(map(lambda x: pa.array(list(map(lambda row: row[x[0]], rows)), type=x[1].type),
+                                  enumerate(schema))), schema=schema)
+
+        # file names are derived from the chunk, rerunning a chunk after a crash overwrites its files
+        pq.write_to_dataset(table, columnar_path(directory, name), partition_cols=PARTITIONS,
+                            basename_template=f'part-{low + 1}-{high}-{{i}}.parquet',
+                            existing_data_behavior='overwrite_or_ignore')
+
+
+def export(db: Database, directory: str, chunk_size: int = 5000, full: bool = False):
+    # appends the replays with an id above the last exported one. Re-extracted replays keep their id, run with
+    # full to pick those up
+    if pa is None:
+        raise RuntimeError('The columnar export needs pyarrow')
+
+    last = 0 if full else db.get_state(STATE_KEY, 0)
+    if full:
+        for name in TABLES:
+            for file_path in glob.glob(os.path.join(columnar_path(directory, name), '**', '*.parquet'),
+                                       recursive=True):
+                os.remove(file_path)
+
+    key = ItemsExtracted.__table__.c.id
+    total = db.engine.execute(select([func.count()]).select_from(key.table).where(key > last)).scalar()
+    exported = 0
+
+    while True:
+        ids = list(map(lambda x: x[0], db.engine.execute(
+            select([key]).where(key > last).order_by(key).limit(chunk_size))))
+        if len(ids) == 0:
+            break
+
+        export_chunk(db, directory, last, ids[-1])
+        last = ids[-1]
+        db.set_state(STATE_KEY, last)
+
+        exported += len(ids)
+        sys.stdout.write(f'\r{exported}/{total}')
+        sys.stdout.flush()
+
+    return exported
+
+
+def dataset(directory: str, table: str):
+    return ds.dataset(columnar_path(directory, table), format='parquet', partitioning='hive')
+
+
+def scan(directory: str, table: str, columns=None, **filters):
+    # reads the columns of the rows matching the filters (column=value or column=[values]) into pandas, partition
+    # filters only open the matching directories and the rest is pushed down to the row groups
+    expression = None
+    for column, value in filters.items():
+        if value is None:
+            continue
+        condition = ds.field(column).isin(value) if isinstance(value, (list, tuple, set)) else \
+            ds.field(column) == value
+        expression = condition if expression is None else expression & condition
+
+    return dataset(directory, table).to_table(columns=columns, filter=expression).to_pandas()
+
+
+def connect(directory: str):
+    # an in-memory duckdb with a view per exported table, for sql over the parquet files
+    if duckdb is None:
+        raise RuntimeError('Querying the columnar export with sql needs duckdb')
+
+    connection = duckdb.connect()
+    for name in TABLES:
+        path = os.path.join(columnar_path(directory, name), '**', '*.parquet')
+        if len(glob.glob(path, recursive=True)) > 0:
+            connection.execute(f"CREATE VIEW {name} AS SELECT * FROM read_parquet('{path}', hive_partitioning = true)")
+    return connection
+
+
+def query(directory: str, sql: str, params=None):
+    connection = connect(directory)
+    try:
+        return connection.execute(sql, params or []).df()
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports the extracted tables to parquet partitioned by season and '
+                                                 'rank')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Replays per written file')
+    parser.add_argument('--full', action='store_true', help='Delete the export and write everything again')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    db = Database(args.directory)
+    export(db, args.directory, args.chunk_size, args.full)
+    db.close()
@@ -1,21 +1,27 @@
-import sys
-from database import Database, ItemsExtracted, ReplayRecord
+import argparse
+from backfill import run_statement
+from database import Database, rollup_shift, ROLLUP_PRUNE
 
-db = Database('D:\\rumble_replays')
 
-processed = 0
-total = db.Session().query(ItemsExtracted.id).count()
+def copy_date(db: Database):
+    # one correlated update of the replays whose date changes. The rollups are keyed on the season, so in the same
+    # transaction those replays are taken out under their old date and added back under the new one first
+    distinct = 'IS NOT' if db.engine.dialect.name == 'sqlite' else 'IS DISTINCT FROM'
+    replay_date = '(SELECT replay.match_date FROM replay WHERE replay.hash = items_extracted.hash)'
+    join = 'LEFT JOIN replay r ON r.hash = p.hash'
+    changed = f'p.match_date {distinct} r.match_date'
 
-for item_e in db.Session().query(ItemsExtracted):
-    replay: ReplayRecord = db.Session().query(ReplayRecord).get(item_e.hash)
-    item_e.match_date = replay.match_date
+    return run_statement(db, rollup_shift(changed, join, sign=-1) + rollup_shift(changed, join, 'r.match_date') +
+                         ROLLUP_PRUNE + [f'UPDATE items_extracted SET match_date = {replay_date} '
+                                         f'WHERE match_date {distinct} {replay_date}'],
+                         tables=['items_extracted', 'item_rollup', 'goal_rollup'])
 
-    processed += 1
-    sys.stdout.write(f'\r{processed}/{total}')
-    sys.stdout.flush()
 
-    if processed % 10000 == 0:
-        db.commit()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    args = parser.parse_args()
 
-db.commit()
-db.close()
+    db = Database(args.directory)
+    print(f'Updated {copy_date(db)} rows')
+    db.close()
@@ -1,10 +1,25 @@
+import os
 import json
+import time
+import uuid
+import queue
+import logging
+import threading
+import itertools
 import dateutil
-from sqlalchemy import create_engine, Column, String, DateTime, Integer, Float, Boolean, ForeignKey
+from datetime import datetime
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, exc, inspect, select, func, bindparam, text, Column, String, DateTime, \
+    Integer, Float, Boolean, ForeignKey, Index, and_
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import sessionmaker, scoped_session, relationship
 from sqlalchemy.ext.declarative import declarative_base
+from season import seasons
+from map import maps, standard_maps
+import metrics
 
 Base = declarative_base()
+log = logging.getLogger(__name__)
 
 
 class ItemsExtracted(Base):
@@ -15,10 +30,16 @@ class ItemsExtracted(Base):
     avg_rank = Column(Integer, index=True)
     map = Column(Integer)
     match_date = Column(DateTime, index=True)
-    children = relationship('ItemRecord', back_populates='parent')
-    goals = relationship('GoalRecord', back_populates='parent')
+    children = relationship('ItemRecord', back_populates='parent', cascade='all, delete-orphan')
+    goals = relationship('GoalRecord', back_populates='parent', cascade='all, delete-orphan')
     orange_winner = Column(Boolean)
 
+    __table_args__ = (
+        # per rank aggregations join item/goal on id and read these without touching the table
+        Index('ix_items_extracted_rank_covering', 'avg_rank', 'id', 'orange_winner', 'map'),
+        Index('ix_items_extracted_date_map', 'match_date', 'map'),
+    )
+
     @staticmethod
     def create(from_: dict):
         record = ItemsExtracted()
@@ -26,17 +47,19 @@ class ItemsExtracted(Base):
         record.map = from_['map']
         record.avg_mmr = from_['avg_mmr']
         record.avg_rank = from_['avg_rank']
+        record.match_date = from_.get('match_date', None)
+        record.orange_winner = from_.get('orange_winner', None)
         return record
 
 
 class ItemRecord(Base):
     __tablename__ = 'item'
-    parent_id = Column(Integer, ForeignKey('items_extracted.id'), primary_key=True, index=True)
+    parent_id = Column(Integer, ForeignKey('items_extracted.id'), primary_key=True)
     parent = relationship('ItemsExtracted', back_populates='children')
-    player_id = Column(String, primary_key=True, index=True)
-    frame_get = Column(Integer, primary_key=True, index=True)
+    player_id = Column(String, primary_key=True)
+    frame_get = Column(Integer, primary_key=True)
     frame_use = Column(Integer)
-    item = Column(Integer, index=True)
+    item = Column(Integer)
     use_x = Column(Float)
     use_y = Column(Float)
     use_z = Column(Float)
@@ -44,6 +67,14 @@ class ItemRecord(Base):
     is_kickoff = Column(Boolean)
     is_orange = Column(Boolean)
 
+    # lookups by parent_id use the primary key, these cover the notebook's queries so they never read the table
+    __table_args__ = (
+        Index('ix_item_kickoff', 'is_kickoff', 'parent_id', 'frame_get', 'item', 'is_orange'),
+        Index('ix_item_parent_covering', 'parent_id', 'item', 'is_orange', 'wait_time'),
+        Index('ix_item_item_wait', 'item', 'parent_id', 'wait_time'),
+        Index('ix_item_item_use', 'item', 'parent_id', 'is_orange', 'use_x', 'use_y', 'use_z'),
+    )
+
     @staticmethod
     def create(from_: dict):
         record = ItemRecord()
@@ -62,7 +93,7 @@ class ItemRecord(Base):
 
 class GoalRecord(Base):
     __tablename__ = 'goal'
-    parent_id = Column(Integer, ForeignKey('items_extracted.id'), primary_key=True, index=True)
+    parent_id = Column(Integer, ForeignKey('items_extracted.id'), primary_key=True)
     parent = relationship('ItemsExtracted', back_populates='goals')
     player_id = Column(String, primary_key=True)
     frame = Column(Integer, primary_key=True)
@@ -70,10 +101,16 @@ class GoalRecord(Base):
     pre_item = Column(Boolean)
     is_orange = Column(Boolean)
 
+    __table_args__ = (
+        Index('ix_goal_parent_covering', 'parent_id', 'item', 'pre_item', 'is_orange'),
+    )
+
     @staticmethod
     def create(from_: dict):
         record = GoalRecord()
         record.player_id = from_['player_id']
+        record.frame = from_['frame']
+        record.pre_item = from_['pre_item']
         record.item = from_['item']
         record.is_orange = from_['is_orange']
         return record
@@ -110,15 +147,531 @@ class ReplayRecord(Base):
         }
 
 
+class StateRecord(Base):
+    __tablename__ = 'state'
+    key = Column(String, primary_key=True)
+    value = Column(String)
+
+
+class SeasonRecord(Base):
+    __tablename__ = 'season'
+    season = Column(Integer, primary_key=True)
+    start_date = Column(DateTime, nullable=False)
+    end_date = Column(DateTime, nullable=False)
+
+
+class MapRecord(Base):
+    __tablename__ = 'map'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    is_standard = Column(Boolean, nullable=False)
+
+
+class ArtifactRecord(Base):
+    # the manifest of the artifact store, size is on disk and raw_size and checksum are of the uncompressed content
+    __tablename__ = 'artifact'
+    hash = Column(String, primary_key=True)
+    kind = Column(String, primary_key=True)
+    path = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    raw_size = Column(Integer, nullable=False)
+    checksum = Column(String, nullable=False)
+    compression = Column(String)
+    created = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_artifact_kind_hash', 'kind', 'hash'),
+    )
+
+
+class TaskRecord(Base):
+    # the work queue, a task is pending, leased by a worker until lease_expires, done or failed after max attempts
+    __tablename__ = 'task'
+    job = Column(String, primary_key=True)
+    hash = Column(String, primary_key=True)
+    state = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    lease_id = Column(String)
+    owner = Column(String)
+    lease_expires = Column(DateTime)
+    error = Column(String)
+    updated = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_task_claim', 'job', 'state', 'lease_expires'),
+        Index('ix_task_lease', 'lease_id'),
+    )
+
+
+class FailedReplay(Base):
+    __tablename__ = 'failed_replay'
+    hash = Column(String, primary_key=True)
+    stage = Column(String)
+    error = Column(String)
+    attempts = Column(Integer)
+    last_attempt = Column(DateTime)
+    replay = Column(String)
+
+
+# -1 stands in for NULL in the rollup dimensions so that they can make up the primary key
+class ItemRollup(Base):
+    __tablename__ = 'item_rollup'
+    item = Column(Integer, primary_key=True)
+    avg_rank = Column(Integer, primary_key=True)
+    season = Column(Integer, primary_key=True)
+    map = Column(Integer, primary_key=True)
+    winner = Column(Integer, primary_key=True)
+    is_kickoff = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False)
+    wait_count = Column(Integer, nullable=False)
+    wait_sum = Column(Float, nullable=False)
+    wait_sumsq = Column(Float, nullable=False)
+
+
+class GoalRollup(Base):
+    __tablename__ = 'goal_rollup'
+    item = Column(Integer, primary_key=True)
+    pre_item = Column(Integer, primary_key=True)
+    avg_rank = Column(Integer, primary_key=True)
+    season = Column(Integer, primary_key=True)
+    map = Column(Integer, primary_key=True)
+    winner = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
+SEASON_CASE = 'CASE {} ELSE -1 END'.format(' '.join(map(
+    lambda x: f"WHEN p.match_date >= '{x[1][0]:%Y-%m-%d %H:%M:%S}' AND p.match_date < '{x[1][1]:%Y-%m-%d %H:%M:%S}' "
+              f"THEN {x[0]}", seasons.items())))
+WINNER_CASE = 'CASE WHEN p.orange_winner IS NULL THEN -1 WHEN p.orange_winner = c.is_orange THEN 1 ELSE 0 END'
+
+ITEM_ROLLUP_UPSERT = f'''
+INSERT INTO item_rollup (item, avg_rank, season, map, winner, is_kickoff, count, wait_count, wait_sum, wait_sumsq)
+SELECT COALESCE(c.item, -1), COALESCE(p.avg_rank, -1), {SEASON_CASE}, COALESCE(p.map, -1), {WINNER_CASE},
+       CASE WHEN c.is_kickoff IS NULL THEN -1 WHEN c.is_kickoff THEN 1 ELSE 0 END,
+       :sign * COUNT(*), :sign * COUNT(c.wait_time),
+       :sign * COALESCE(SUM(c.wait_time), 0), :sign * COALESCE(SUM(c.wait_time * c.wait_time), 0)
+FROM item c JOIN items_extracted p ON c.parent_id = p.id
+WHERE c.parent_id IN :parent_ids
+GROUP BY 1, 2, 3, 4, 5, 6
+ON CONFLICT (item, avg_rank, season, map, winner, is_kickoff) DO UPDATE SET
+    count = item_rollup.count + excluded.count,
+    wait_count = item_rollup.wait_count + excluded.wait_count,
+    wait_sum = item_rollup.wait_sum + excluded.wait_sum,
+    wait_sumsq = item_rollup.wait_sumsq + excluded.wait_sumsq
+'''
+
+GOAL_ROLLUP_UPSERT = f'''
+INSERT INTO goal_rollup (item, pre_item, avg_rank, season, map, winner, count)
+SELECT COALESCE(c.item, -1), CASE WHEN c.pre_item IS NULL THEN -1 WHEN c.pre_item THEN 1 ELSE 0 END,
+       COALESCE(p.avg_rank, -1), {SEASON_CASE}, COALESCE(p.map, -1), {WINNER_CASE}, :sign * COUNT(*)
+FROM goal c JOIN items_extracted p ON c.parent_id = p.id
+WHERE c.parent_id IN :parent_ids
+GROUP BY 1, 2, 3, 4, 5, 6
+ON CONFLICT (item, pre_item, avg_rank, season, map, winner) DO UPDATE SET
+    count = goal_rollup.count + excluded.count
+'''
+
+ROLLUP_STATEMENTS = list(map(lambda x: text(x).bindparams(bindparam('parent_ids', expanding=True)),
+                             [ITEM_ROLLUP_UPSERT, GOAL_ROLLUP_UPSERT]))
+ROLLUP_PRUNE = [ItemRollup.__table__.delete().where(ItemRollup.__table__.c.count == 0),
+                GoalRollup.__table__.delete().where(GoalRollup.__table__.c.count == 0)]
+
+
+def rollup_shift(condition: str, join: str = '', season_date: str = 'p.match_date', sign: int = 1):
+    # the rollup upserts as set-based statements over the replays p the condition selects instead of a list of ids.
+    # season_date puts them under another date, so a backfill can move replays to the date they are about to get
+    # before the update that gives it to them. Follow the ones with sign=-1 with ROLLUP_PRUNE
+    return list(map(lambda x: text(x.replace('p.match_date', season_date)
+                                   .replace('WHERE c.parent_id IN :parent_ids', f'{join} WHERE {condition}'))
+                    .bindparams(sign=sign),
+                    [ITEM_ROLLUP_UPSERT, GOAL_ROLLUP_UPSERT]))
+
+
+CHANGE_UPSERT = text('''
+INSERT INTO state (key, value) VALUES (:key, '1')
+ON CONFLICT (key) DO UPDATE SET value = CAST(CAST(state.value AS INTEGER) + 1 AS VARCHAR)
+''')
+
+
+def record_changes(connection, tables):
+    # every write to a table bumps its counter in the state table, cached query results are keyed on these
+    for table in set(tables):
+        connection.execute(CHANGE_UPSERT, key=f'changes.{table}')
+
+
+def update_rollups(connection, parent_ids, sign: int = 1):
+    # adds (or with sign=-1 removes) the current item/goal rows of these replays to the rollups, call it with -1
+    # before changing or deleting anything the rollups are keyed on and with 1 after, inside the same transaction
+    parent_ids = list(parent_ids)
+
+    for i in range(0, len(parent_ids), 500):
+        for statement in ROLLUP_STATEMENTS:
+            connection.execute(statement, parent_ids=parent_ids[i:i + 500], sign=sign)
+
+    if sign < 0:
+        for statement in ROLLUP_PRUNE:
+            connection.execute(statement)
+
+
+def rebuild_rollups(connection):
+    connection.execute(ItemRollup.__table__.delete())
+    connection.execute(GoalRollup.__table__.delete())
+    update_rollups(connection, map(lambda x: x[0], connection.execute(select([ItemsExtracted.id]))))
+    record_changes(connection, [ItemRollup.__tablename__, GoalRollup.__tablename__])
+
+
+def set_sqlite_pragmas(connection, _):
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-65536')
+    cursor.close()
+
+
+def insert_ignore(engine, table):
+    # an insert that skips rows whose primary or unique key already exists
+    if engine.dialect.name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if engine.dialect.name == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert()
+
+
+def insert_replace(engine, table):
+    # an insert that overwrites rows whose primary key already exists
+    if engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=list(table.primary_key.columns),
+            set_=dict(map(lambda x: (x.name, statement.excluded[x.name]),
+                          filter(lambda x: not x.primary_key, table.columns))))
+    if engine.dialect.name == 'sqlite':
+        return table.insert().prefix_with('OR REPLACE')
+    return table.insert()
+
+
+def add_process_guards(engine):
+    # connections must not cross a fork, a child process that got the pool of its parent opens its own connections
+    # instead of sharing the parent's sockets
+    @event.listens_for(engine, 'connect')
+    def connect(_, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(_, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(f'Connection record belongs to pid {connection_record.info["pid"]}, '
+                                         f'attempting to check out in pid {pid}')
+
+
+class BulkWriter(object):
+    _STOP = object()
+
+    def __init__(self, engine, table, batch_size: int = 1000, flush_interval: float = 1.0, queue_size: int = None,
+                 retries: int = 3, backoff: float = 1.0):
+        self.engine = engine
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.backoff = backoff
+        # rows given up on after the retries, callers check it after flush() before they treat the rows as stored
+        self.failed = 0
+        self.insert = insert_ignore(engine, table)
+        self.queue = queue.Queue(maxsize=queue_size or batch_size * 4)
+        self.thread = threading.Thread(target=self._run, name=f'writer-{table.name}', daemon=True)
+        self.thread.start()
+
+    def add(self, row: dict):
+        self.queue.put(row)
+
+    def flush(self):
+        # blocks until everything added so far is written
+        flushed = threading.Event()
+        self.queue.put(flushed)
+        flushed.wait()
+
+    def close(self):
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+    def _rows(self, entry):
+        return 1
+
+    def _run(self):
+        batch = []
+        rows = 0
+        deadline = time.monotonic() + self.flush_interval
+
+        while True:
+            try:
+                row = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                row = None
+
+            if row is self._STOP:
+                break
+
+            if isinstance(row, threading.Event):
+                self._flush(batch)
+                batch = []
+                rows = 0
+                row.set()
+            elif row is not None:
+                batch.append(row)
+                rows += self._rows(row)
+
+            if rows >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                rows = 0
+                deadline = time.monotonic() + self.flush_interval
+
+        self._flush(batch)
+
+    def _flush(self, batch):
+        if len(batch) > 0:
+            with metrics.timer('db_flush'):
+                self._write(batch)
+
+    def _write(self, batch):
+        if len(batch) == 0:
+            return
+
+        for attempt in range(self.retries + 1):
+            try:
+                with self.engine.begin() as connection:
+                    self._write_rows(connection, batch)
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    log.error(f'Failed to write {len(batch)} rows to {self.table.name}', exc_info=e)
+                    self.failed += len(batch)
+                    self._failed(batch)
+                    return
+                delay = self.backoff * 2 ** attempt
+                log.warning(f'Failed to write {len(batch)} rows to {self.table.name} ({e}), retrying in {delay}s')
+                time.sleep(delay)
+
+    def _write_rows(self, connection, batch):
+        connection.execute(self.insert, batch)
+
+    def _failed(self, batch):
+        pass
+
+
+class ReplayIngest(BulkWriter):
+
+    def __init__(self, db, batch_size: int = 1000, flush_interval: float = 1.0):
+        super().__init__(db.engine, ReplayRecord.__table__, batch_size, flush_interval)
+        self.known_hashes = db.get_existing_hashes()
+
+    def add(self, record: ReplayRecord):
+        if record.hash in self.known_hashes:
+            return
+        self.known_hashes.add(record.hash)
+        super().add(record.as_dict())
+
+    def _failed(self, batch):
+        # so that the replays are added again when they come up next time
+        self.known_hashes.difference_update(map(lambda x: x['hash'], batch))
+
+
+class ArtifactManifest(BulkWriter):
+
+    def __init__(self, db, batch_size: int = 1000, flush_interval: float = 1.0):
+        super().__init__(db.engine, ArtifactRecord.__table__, batch_size, flush_interval)
+        # an artifact written again replaces its entry
+        self.insert = insert_replace(db.engine, ArtifactRecord.__table__)
+        self.delete = ArtifactRecord.__table__.delete().where(and_(ArtifactRecord.hash == bindparam('_hash'),
+                                                                   ArtifactRecord.kind == bindparam('_kind')))
+
+    def remove(self, replay_hash: str, kind: str):
+        super().add({'_hash': replay_hash, '_kind': kind})
+
+    def _write_rows(self, connection, batch):
+        # removals and writes keep their order, a run of either is written with one statement
+        for is_removal, rows in itertools.groupby(batch, lambda x: '_hash' in x):
+            connection.execute(self.delete if is_removal else self.insert, list(rows))
+
+
+def write_extractions(connection, batch):
+    # writes (replace, replay_data, items, goals) entries inside the caller's transaction, the extraction writer does
+    # this on its thread and the worker right in the transaction that completes its tasks. A replay added twice has
+    # to see its first write, so the batch is split wherever a hash repeats
+    hashes = set()
+    start = 0
+    for i, entry in enumerate(batch):
+        if entry[1]['hash'] in hashes:
+            write_extraction_entries(connection, batch[start:i])
+            hashes.clear()
+            start = i
+        hashes.add(entry[1]['hash'])
+    write_extraction_entries(connection, batch[start:])
+
+
+def get_parent_ids(connection, hashes):
+    table = ItemsExtracted.__table__
+    query = select([table.c.hash, table.c.id]).where(table.c.hash.in_(bindparam('hashes', expanding=True)))
+    parent_ids = {}
+    for i in range(0, len(hashes), 500):
+        parent_ids.update(map(tuple, connection.execute(query, hashes=hashes[i:i + 500])))
+    return parent_ids
+
+
+def write_extraction_entries(connection, batch):
+    # ids come from the database so that several writers can work on the same database, replays that already exist
+    # are looked up by hash first
+    parent_ids = get_parent_ids(connection, list(map(lambda x: x[1]['hash'], batch)))
+    existing = set(parent_ids.values())
+
+    parents = {}
+    for _, replay_data, _, _ in filter(lambda x: x[1]['hash'] not in parent_ids, batch):
+        parents.setdefault(tuple(sorted(replay_data.keys())), []).append(replay_data)
+
+    update_rollups(connection, existing, -1)
+
+    for rows in parents.values():
+        connection.execute(insert_ignore(connection.engine, ItemsExtracted.__table__), rows)
+
+    if len(parents) > 0:
+        parent_ids = get_parent_ids(connection, list(map(lambda x: x[1]['hash'], batch)))
+
+    updates = {}
+    replaced = {ItemRecord.__table__: [], GoalRecord.__table__: []}
+    children = {ItemRecord.__table__: [], GoalRecord.__table__: []}
+
+    for replace, replay_data, items, goals in batch:
+        parent_id = parent_ids[replay_data['hash']]
+        is_new = parent_id not in existing
+
+        if replace and not is_new:
+            row = dict(replay_data, _id=parent_id)
+            updates.setdefault(tuple(sorted(row.keys())), []).append(row)
+
+        for table, rows in [(ItemRecord.__table__, items), (GoalRecord.__table__, goals)]:
+            if rows is None:
+                continue
+            if replace and not is_new:
+                replaced[table].append({'_id': parent_id})
+            children[table] += list(map(lambda x: dict(x, parent_id=parent_id), rows))
+
+    for keys, rows in updates.items():
+        values = dict(map(lambda x: (x, bindparam(x)), filter(lambda x: x not in ('_id', 'hash'), keys)))
+        if len(values) > 0:
+            connection.execute(ItemsExtracted.__table__.update()
+                               .where(ItemsExtracted.__table__.c.id == bindparam('_id')).values(values), rows)
+
+    for table, rows in replaced.items():
+        if len(rows) > 0:
+            connection.execute(table.delete().where(table.c.parent_id == bindparam('_id')), rows)
+
+    for table, rows in children.items():
+        if len(rows) > 0:
+            connection.execute(table.insert(), rows)
+
+    update_rollups(connection, parent_ids.values())
+
+    changed = list(map(lambda x: x.name, filter(lambda x: len(replaced[x]) + len(children[x]) > 0, children)))
+    if len(parents) + len(updates) > 0:
+        changed.append(ItemsExtracted.__tablename__)
+    record_changes(connection, changed)
+
+
+class ExtractionWriter(BulkWriter):
+
+    def __init__(self, db, batch_size: int = 5000, flush_interval: float = 5.0):
+        super().__init__(db.engine, ItemsExtracted.__table__, batch_size, flush_interval, queue_size=100)
+
+    def add(self, replay_data: dict, items=None, goals=None, replace: bool = False):
+        super().add((replace, replay_data, items, goals))
+
+    def _rows(self, entry):
+        _, _, items, goals = entry
+        return 1 + len(items or []) + len(goals or [])
+
+    def _write(self, batch):
+        if len(batch) == 0:
+            return
+
+        try:
+            with self.engine.begin() as connection:
+                write_extractions(connection, batch)
+        except Exception as e:
+            log.error(f'Failed to write a batch of {len(batch)} replays, retrying them one by one', exc_info=e)
+
+            for entry in batch:
+                try:
+                    with self.engine.begin() as connection:
+                        write_extraction_entries(connection, [entry])
+                except Exception as e:
+                    log.error(f'Failed to write {entry[1]["hash"]}', exc_info=e)
+                    self.failed += 1
+
+
+INGEST_TABLES = [ItemRecord.__table__, GoalRecord.__table__]
+
+
 class Database(object):
 
-    def __init__(self, dir: str):
-        self.engine = create_engine(f'sqlite:///{dir}/replays.sqlite', connect_args={'timeout': 60})
+    def __init__(self, dir: str, url: str = None, pool_size: int = 5):
+        # the url defaults to RL_STATS_DATABASE_URL and then to replays.sqlite in the directory, which still holds the
+        # replay files and caches when the database is somewhere else
+        url = url or os.environ.get('RL_STATS_DATABASE_URL', None) or f'sqlite:///{dir}/replays.sqlite'
+
+        if url.startswith('sqlite'):
+            self.engine = create_engine(url, connect_args={'timeout': 60})
+            event.listen(self.engine, 'connect', set_sqlite_pragmas)
+        else:
+            self.engine = create_engine(url, pool_size=pool_size, max_overflow=pool_size * 2, pool_pre_ping=True)
+        add_process_guards(self.engine)
+
         Base.metadata.create_all(self.engine)
         self.Session = scoped_session(sessionmaker(bind=self.engine))
+        self.cache_dir = os.path.join(dir, 'cache')
+        self.sync_dimensions()
+        self.sync_rollups()
+
+    def sync_dimensions(self):
+        # the season calendar and the map list live in the database so that queries can group and filter on them
+        # without looking up names in python
+        dimensions = [
+            (SeasonRecord.__table__, list(map(lambda x: {'season': x[0], 'start_date': x[1][0], 'end_date': x[1][1]},
+                                              sorted(seasons.items())))),
+            (MapRecord.__table__, list(map(lambda x: {'id': x[0], 'name': x[1], 'is_standard': x[1] in standard_maps},
+                                           sorted(maps.items()))))
+        ]
+
+        with self.engine.begin() as connection:
+            for table, rows in dimensions:
+                key = list(table.primary_key.columns)[0]
+                if list(map(dict, connection.execute(select([table]).order_by(key)))) != rows:
+                    connection.execute(table.delete())
+                    connection.execute(table.insert(), rows)
+                    record_changes(connection, [table.name])
 
     def get_existing_hashes(self):
-        return set(map(lambda x: x.hash, self.Session().query(ReplayRecord)))
+        return set(map(lambda x: x[0], self.engine.execute(select([ReplayRecord.hash]))))
+
+    def bulk_ingest(self, batch_size: int = 1000, flush_interval: float = 1.0):
+        return ReplayIngest(self, batch_size, flush_interval)
+
+    def extraction_writer(self, batch_size: int = 5000, flush_interval: float = 5.0):
+        return ExtractionWriter(self, batch_size, flush_interval)
+
+    def artifact_writer(self, batch_size: int = 1000, flush_interval: float = 1.0):
+        return ArtifactManifest(self, batch_size, flush_interval)
+
+    def get_artifact_hashes(self, kinds):
+        # hashes that have an artifact of every one of these kinds
+        kinds = [kinds] if isinstance(kinds, str) else list(kinds)
+        table = ArtifactRecord.__table__
+        query = select([table.c.hash]).where(table.c.kind.in_(kinds)).group_by(table.c.hash) \
+            .having(func.count() == len(kinds))
+        return set(map(lambda x: x[0], self.engine.execute(query)))
 
     def add(self, record: ReplayRecord):
         self.Session().add(record)
@@ -135,3 +688,95 @@ class Database(object):
 
     def commit(self):
         self.Session().commit()
+
+    def record_failure(self, replay: dict, stage: str, error: str):
+        record = self.Session().query(FailedReplay).get(replay['hash'])
+        if record is None:
+            record = FailedReplay(hash=replay['hash'], attempts=0)
+            self.Session().add(record)
+        record.stage = stage
+        record.error = error
+        record.attempts += 1
+        record.last_attempt = datetime.utcnow()
+        record.replay = json.dumps(replay)
+        self.commit()
+
+    def clear_failure(self, hash: str):
+        self.Session().query(FailedReplay).filter_by(hash=hash).delete()
+        self.commit()
+
+    def get_failed_hashes(self):
+        return set(map(lambda x: x[0], self.engine.execute(select([FailedReplay.hash]))))
+
+    def get_failed_replays(self, max_attempts: int):
+        failed = self.Session().query(FailedReplay).filter(FailedReplay.attempts < max_attempts)
+        return list(map(lambda x: json.loads(x.replay), failed))
+
+    def get_indexes(self, table):
+        return set(map(lambda x: x['name'], inspect(self.engine).get_indexes(table.name)))
+
+    def drop_secondary_indexes(self, tables=None):
+        for table in tables or INGEST_TABLES:
+            existing = self.get_indexes(table)
+            for index in table.indexes:
+                if index.name in existing:
+                    index.drop(self.engine)
+
+    def sync_rollups(self):
+        # create_all gives a database from before the rollups empty rollup tables, the deltas of every later write
+        # would only add up to partial totals on top of them, so they are built from the item and goal rows first
+        with self.engine.begin() as connection:
+            empty = dict(map(lambda x: (x, connection.execute(select([list(x.c)[0]]).limit(1)).first() is None),
+                             [ItemRollup.__table__, GoalRollup.__table__, ItemRecord.__table__, GoalRecord.__table__]))
+            if empty[ItemRollup.__table__] and empty[GoalRollup.__table__] and \
+                    not (empty[ItemRecord.__table__] and empty[GoalRecord.__table__]):
+                log.info('Building the rollup tables')
+                rebuild_rollups(connection)
+
+    def sync_indexes(self, tables=None):
+        # creates the indexes the schema declares and drops the ones it no longer does
+        for table in tables or Base.metadata.sorted_tables:
+            existing = self.get_indexes(table)
+            declared = set(map(lambda x: x.name, table.indexes))
+
+            for name in existing - declared:
+                log.info(f'Dropping index {name}')
+                self.engine.execute(f'DROP INDEX {name}')
+
+            for index in table.indexes:
+                if index.name not in existing:
+                    log.info(f'Creating index {index.name}')
+                    index.create(self.engine)
+
+        self.engine.execute('ANALYZE')
+
+    @contextmanager
+    def ingest_mode(self, tables=None):
+        # secondary indexes are rebuilt once after a bulk load instead of being updated on every insert
+        self.drop_secondary_indexes(tables)
+        try:
+            yield self
+        finally:
+            self.sync_indexes(tables or INGEST_TABLES)
+
+    def get_state(self, key: str, default=None):
+        record = self.Session().query(StateRecord).get(key)
+        return default if record is None else json.loads(record.value)
+
+    def get_changes(self, tables):
+        keys = list(map(lambda x: f'changes.{x}', tables))
+        rows = dict(self.engine.execute(select([StateRecord.key, StateRecord.value])
+                                        .where(StateRecord.key.in_(keys))).fetchall())
+        return dict(map(lambda x: (x, json.loads(rows.get(f'changes.{x}', '0'))), tables))
+
+    def get_database_id(self):
+        # a random id the database gets the first time it is asked for, so that a database recreated at the same url
+        # or a copy of it at another one never share the results cached for another
+        self.engine.execute(insert_ignore(self.engine, StateRecord.__table__),
+                            key='database.id', value=json.dumps(uuid.uuid4().hex))
+        return json.loads(self.engine.execute(select([StateRecord.value])
+                                              .where(StateRecord.key == 'database.id')).scalar())
+
+    def set_state(self, key: str, value):
+        self.Session().merge(StateRecord(key=key, value=json.dumps(value)))
+        self.commit()
@@ -0,0 +1,100 @@
+import threading
+from sqlalchemy import select, func, exists, and_
+from database import Database, ReplayRecord, ItemsExtracted, ItemRecord, GoalRecord
+
+# Finds the replays a script still has to work on in the database and streams them in pages, so that memory stays
+# flat however big the archive is and the pool gets its first tasks right away.
+
+
+def has_items(replay_hash):
+    parent = ItemsExtracted.__table__
+    item = ItemRecord.__table__
+    return exists().where(and_(parent.c.hash == replay_hash, item.c.parent_id == parent.c.id))
+
+
+def has_goals(parent_id):
+    return exists().where(GoalRecord.__table__.c.parent_id == parent_id)
+
+
+def is_extracted(replay_hash):
+    return exists().where(ItemsExtracted.__table__.c.hash == replay_hash)
+
+
+def replays_without_items():
+    return ~has_items(ReplayRecord.__table__.c.hash)
+
+
+def replays_not_extracted():
+    return ~is_extracted(ReplayRecord.__table__.c.hash)
+
+
+def extracted_without_goals():
+    return ~has_goals(ItemsExtracted.__table__.c.id)
+
+
+def count(db: Database, table, where=None):
+    query = select([func.count()]).select_from(table)
+    return db.engine.execute(query if where is None else query.where(where)).scalar()
+
+
+def keyset_chunks(db: Database, table, columns, where=None, chunk_size: int = 1000):
+    # pages through the table by primary key instead of holding one long running cursor or offset scans, every page
+    # is a fresh query that starts at an index seek past the last key. Yields lists of (key, *columns) tuples
+    key = list(table.primary_key.columns)[0]
+    last = None
+
+    while True:
+        query = select([key] + list(columns)).order_by(key).limit(chunk_size)
+        if where is not None:
+            query = query.where(where)
+        if last is not None:
+            query = query.where(key > last)
+
+        rows = list(map(tuple, db.engine.execute(query)))
+        if len(rows) == 0:
+            return
+
+        yield rows
+        last = rows[-1][0]
+
+
+def stream(db: Database, table, columns=None, where=None, chunk_size: int = 1000):
+    # the matching rows one at a time as dicts of the columns, all of them by default
+    columns = list(table.c) if columns is None else list(columns)
+    key = list(table.primary_key.columns)[0]
+    # the key is selected anyway and a select drops repeated columns
+    others = list(filter(lambda x: x is not key, columns))
+    names = list(map(lambda x: x.name, others))
+
+    for rows in keyset_chunks(db, table, others, where, chunk_size):
+        for row in rows:
+            values = dict(zip(names, row[1:]))
+            if key in columns:
+                values[key.name] = row[0]
+            yield values
+
+
+class BoundedFeed(object):
+    # Pool.imap and imap_unordered pull their whole input on a background thread, this holds the input back so that
+    # only limit tasks are in flight and the rest are still pages in the database
+
+    def __init__(self, iterable, limit: int):
+        self.iterable = iterable
+        self.slots = threading.BoundedSemaphore(limit)
+
+    def __iter__(self):
+        for item in self.iterable:
+            self.slots.acquire()
+            yield item
+
+    def done(self):
+        self.slots.release()
+
+
+def imap_bounded(pool, fn, iterable, limit: int, chunksize: int = 1):
+    # imap_unordered that reads at most limit items ahead of the results, limit has to be a good deal larger than
+    # chunksize times the pool size to keep every process busy
+    feed = BoundedFeed(iterable, limit)
+    for result in pool.imap_unordered(fn, feed, chunksize):
+        feed.done()
+        yield result
@@ -1,75 +1,386 @@
+import io
 import argparse
 import requests
 import logging
 import os
-import gzip
+import time
+import queue
 import carball
 import math
-from multiprocessing import Pool
+import threading
+import dateutil.parser
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from database import Database, ReplayRecord
+from requests.adapters import HTTPAdapter
+from sqlalchemy import select, func
+from database import Database, ReplayRecord, ReplayIngest
+from supervisor import Supervisor
+from artifact_store import ArtifactStore
+from frame_store import write_frames
+from replay_summary import write_summary, summarize
+from item_sidecar import write_item_uses
+from metrics import Instrumented, Progress
+import metrics
 
 HOST = 'https://calculated.gg'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# the artifacts that mark a replay as parsed
+PARSE_OUTPUTS = ['proto', 'frames', 'summary']
 
 log = logging.getLogger(__name__)
 
 
-def carball_parse(hash: str, output_dir: str):
-    pts_file = os.path.join(output_dir, 'stats', f'{hash}.pts')
-    gzip_file = os.path.join(output_dir, 'df', f'{hash}.gzip')
+def upload_date(replay):
+    return dateutil.parser.parse(replay['upload_date']).replace(tzinfo=None)
+
+
+def create_session(pool_size: int):
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class ReplayDownloader(object):
+
+    def __init__(self, output_dir: str, host: str = HOST, max_in_flight: int = 16, retries: int = 5,
+                 backoff: float = 1.0, timeout: float = 60, manifest=None, known=None):
+        self.output_dir = output_dir
+        self.store = ArtifactStore(output_dir, manifest=manifest)
+        # hashes the manifest has a replay file for, the rest are looked for on disk
+        self.known = known or set()
+        self.host = host
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = create_session(max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='download')
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+
+    def with_retries(self, url: str, fn):
+        for attempt in range(self.retries + 1):
+            try:
+                return fn()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                if isinstance(e, requests.HTTPError) and e.response.status_code not in RETRY_STATUSES:
+                    raise
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                log.warning(f'Failed to download {url} ({e}), retrying in {delay}s')
+                time.sleep(delay)
+
+    def get_json(self, url: str):
+        def get():
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+
+        return self.with_retries(url, get)
+
+    def fetch(self, url: str, file_path: str):
+        tmp_path = f'{file_path}.part'
+
+        def get():
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+
+            os.replace(tmp_path, file_path)
+
+        self.with_retries(url, get)
+
+    def download(self, replay):
+        hash = replay['hash']
+
+        if hash in self.known or self.store.exists(hash, 'replay'):
+            log.info(f'Replay {hash} already exists')
+        else:
+            # fetched to the uncompressed path in the store, put() compresses it in place
+            file_path = self.store.target(hash, 'replay')
+            log.info(f'Downloading replay {hash}, saving to {file_path}')
+            with metrics.timer('download'):
+                self.fetch(self.host + replay['download'], file_path)
+            with metrics.timer('compress'):
+                self.store.put(hash, 'replay', file_path)
+
+        return replay
+
+    def download_all(self, replays, on_done, on_failed=None):
+        # blocks until every replay is downloaded, the callbacks are called from the download threads
+
+        def done(replay, future):
+            # the slot is only given back after the callback, so that download_all can not return before it ran
+            try:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    log.error(f'Failed to download {replay}', exc_info=e)
+                    if on_failed is not None:
+                        on_failed(replay)
+                    return
+                on_done(result)
+            finally:
+                self.slots.release()
+
+        for replay in replays:
+            self.slots.acquire()
+            self.executor.submit(self.download, replay).add_done_callback(partial(done, replay))
+
+        for _ in range(self.max_in_flight):
+            self.slots.acquire()
+        for _ in range(self.max_in_flight):
+            self.slots.release()
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+
+class CrawlFrontier(object):
+
+    def __init__(self, downloader: ReplayDownloader, api_key: str, start_page: int, prefetch: int = 2, newest=None):
+        self.downloader = downloader
+        # the high-water mark of the finished crawls, every replay uploaded up to it is in the database already
+        self.newest = newest
+        self.api_key = api_key
+        self.start_page = start_page
+        self.pages = queue.Queue(maxsize=prefetch)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.remaining = {}
+        self.finished = set()
+        self.completed_page = start_page - 1
+        self.saved_page = self.completed_page
+        self.stalled = False
+        self.total_page = None
+        # set once the listing ran out or reached the high-water mark, not when fetching it failed
+        self.last_page = None
+
+    def listing_url(self, page: int):
+        return f'{self.downloader.host}/api/v1/replays?key={self.api_key}&page={page}&playlist=28&num=200'
+
+    def fetch_pages(self):
+        page = self.start_page
+        try:
+            while True:
+                response = self.downloader.get_json(self.listing_url(page))
+                self.total_page = math.ceil(response['total_count'] / 200)
+                self.pages.put((page, response['data']))
+
+                if not response.get('next', None) or len(response['data']) == 0:
+                    self.last_page = page
+                    break
+                if self.newest is not None and all(map(lambda x: upload_date(x) <= self.newest, response['data'])):
+                    # the listing is newest first, everything past this page was handled by an earlier crawl
+                    log.info(f'Reached the replays uploaded up to {self.newest} on page {page}')
+                    self.last_page = page
+                    break
+                page += 1
+        except Exception as e:
+            log.error(f'Failed to fetch listing page {page}', exc_info=e)
+        finally:
+            self.pages.put(None)
+
+    def replays(self):
+        threading.Thread(target=self.fetch_pages, name='crawl-frontier', daemon=True).start()
+
+        for page, data in iter(self.pages.get, None):
+            log.info(f'Queueing replays from page {page}/{self.total_page}')
+
+            with self.lock:
+                self.remaining[page] = len(data)
+
+            for replay in data:
+                with self.lock:
+                    duplicate = replay['hash'] in self.pending
+                    if not duplicate:
+                        self.pending[replay['hash']] = page
+
+                if duplicate:
+                    self._page_done(page)
+                else:
+                    yield replay
+
+            if len(data) == 0:
+                self._page_done(page, 0)
+
+    def done(self, hash: str):
+        with self.lock:
+            page = self.pending.pop(hash)
+        self._page_done(page)
+
+    def _page_done(self, page: int, count: int = 1):
+        with self.lock:
+            self.remaining[page] -= count
+            if self.remaining[page] > 0:
+                return
+
+            del self.remaining[page]
+            self.finished.add(page)
+            while self.completed_page + 1 in self.finished:
+                self.completed_page += 1
+                self.finished.remove(self.completed_page)
+
+    def checkpoint(self, db: Database, ingest: ReplayIngest):
+        # only pages with every replay handled count, so a restart never skips unfinished replays
+        if self.completed_page != self.saved_page:
+            ingest.flush()
+            if ingest.failed > 0:
+                # the position stays before the replays that were not written, the next run picks them up again
+                if not self.stalled:
+                    log.error(f'{ingest.failed} replays failed to be written, the crawl position stays at page '
+                              f'{self.saved_page}')
+                    self.stalled = True
+                return
+
+            self.saved_page = self.completed_page
+            db.set_state('crawl_page', self.saved_page)
+            log.info(f'Finished page {self.saved_page}/{self.total_page}')
+
+            if self.last_page is not None and self.saved_page >= self.last_page:
+                # every replay up to the newest one in the database is handled, the next crawls only have to page
+                # through the uploads since
+                newest = db.engine.execute(select([func.max(ReplayRecord.__table__.c.upload_date)])).scalar()
+                if newest is not None:
+                    db.set_state('crawl_newest', newest.isoformat())
+                    log.info(f'Crawl finished, the next one stops at the replays uploaded up to {newest}')
+
+
+class FailedReplaySource(object):
+
+    def __init__(self, replays):
+        self.failed = replays
+
+    def replays(self):
+        log.info(f'Retrying {len(self.failed)} failed replays')
+        return iter(self.failed)
+
+    def done(self, hash: str):
+        pass
+
+    def checkpoint(self, db: Database, ingest: ReplayIngest):
+        pass
 
-    if os.path.exists(pts_file) and os.path.exists(gzip_file):
-        return
 
-    manager = carball.analyze_replay_file(os.path.join(output_dir, 'replays', f'{hash}.replay'))
+def carball_parse(hash: str, output_dir: str):
+    # returns the manifest entries of the written artifacts, the workers have no database so the caller records them.
+    # process_replays only sends replays the manifest has no parse outputs for, they are looked for on disk here
+    store = ArtifactStore(output_dir)
 
-    with open(pts_file, 'wb') as f:
-        manager.write_proto_out_to_file(f)
+    if all(map(lambda x: store.exists(hash, x), PARSE_OUTPUTS)):
+        return []
 
-    with gzip.open(gzip_file, 'wb') as f:
-        manager.write_pandas_out_to_file(f)
+    with metrics.timer('carball_parse'), store.local_path(hash, 'replay') as replay_file:
+        manager = carball.analyze_replay_file(replay_file)
 
+    # every artifact is written to a temporary file first so a killed worker never leaves a truncated output behind,
+    # the proto goes last as it marks the replay as parsed
+    with metrics.timer('write_outputs'):
+        frames = manager.get_data_frame()
+        frames_file = store.target(hash, 'frames')
+        write_frames(frames_file, frames)
+        entries = [store.register(hash, 'frames', frames_file),
+                   write_summary(output_dir, hash, manager.get_protobuf_data())]
 
-def process_replay(replay, output_dir: str, existing_hashes):
-    download_url = HOST + replay['download']
-    hash = replay['hash']
+        # item extraction falls back to the frames without the sidecar, so it is not worth failing the replay over
+        try:
+            entries.append(write_item_uses(output_dir, hash, summarize(manager.get_protobuf_data()), frames))
+        except Exception as e:
+            log.error(f'Failed to write the item sidecar of {hash}', exc_info=e)
 
-    if hash in existing_hashes is not None:
-        return None
+        proto = io.BytesIO()
+        manager.write_proto_out_to_file(proto)
+        entries.append(store.write(hash, 'proto', proto.getvalue()))
 
-    logging.basicConfig(
-        handlers=[logging.FileHandler(os.path.join(output_dir, 'logs', f'{hash}.log'), encoding='utf-8')],
-        format='%(asctime)s %(levelname)s %(threadName)s %(message)s',
-        level=logging.DEBUG)
+    return entries
 
-    file_path = os.path.join(output_dir, 'replays', f'{hash}.replay')
-    try:
 
-        if os.path.exists(file_path):
-            log.info(f'{file_path} already exists')
-        else:
-            log.info(f'Downloading replay {hash}, saving to {file_path}')
-            replay_response = requests.get(download_url)
+def process_replay(replay, output_dir: str):
+    hash = replay['hash']
 
-            with open(file_path, 'wb') as f:
-                f.write(replay_response.content)
+    # workers are reused, so route this replay's records to its own log file only while it is being parsed
+    store = ArtifactStore(output_dir)
+    log_file = store.target(hash, 'log')
+    handler = logging.FileHandler(log_file, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(threadName)s %(message)s'))
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    root.addHandler(handler)
 
-        carball_parse(hash, output_dir)
-        return ReplayRecord.create(replay)
+    try:
+        entries = carball_parse(hash, output_dir)
     except Exception as e:
         log.error(f'Failed to process {replay}', exc_info=e)
-        return None
+        raise
+    finally:
+        root.removeHandler(handler)
+        handler.close()
+
+    return ReplayRecord.create(replay), entries + [store.register(hash, 'log', log_file)]
+
+
+def process_replays(source, db: Database, downloader: ReplayDownloader, supervisor: Supervisor, progress: Progress,
+                    manifest):
+    ingest = db.bulk_ingest()
+    existing = ingest.known_hashes
+    failed = db.get_failed_hashes()
+    # replays the manifest has every parse output of need neither the download nor the parse
+    parsed = db.get_artifact_hashes(PARSE_OUTPUTS)
+    downloaded = queue.Queue()
+
+    def new_replays():
+        for replay in source.replays():
+            if replay['hash'] in existing:
+                source.done(replay['hash'])
+            elif replay['hash'] in parsed:
+                ingest.add(ReplayRecord.create(replay))
+                if replay['hash'] in failed:
+                    db.clear_failure(replay['hash'])
+                source.done(replay['hash'])
+            else:
+                yield replay
+
+    def download_failed(replay):
+        db.record_failure(replay, 'download', 'Download failed')
+        source.done(replay['hash'])
+
+    def download():
+        try:
+            downloader.download_all(new_replays(), downloaded.put, download_failed)
+        finally:
+            downloaded.put(None)
+
+    threading.Thread(target=download, name='download-feeder', daemon=True).start()
+
+    # the parse workers pull downloaded replays off the queue as soon as they are on disk, their results are wrapped
+    # by Instrumented. Download timings are recorded in this process and picked up by the progress
+    for replay, result, error in supervisor.imap_unordered(iter(downloaded.get, None)):
+        if error is None:
+            (record, entries), timings, profile = result
+            progress.update(timings=timings, key=replay['hash'], profile=profile)
+            for entry in entries:
+                manifest.add(entry)
+            ingest.add(record)
+            if replay['hash'] in failed:
+                db.clear_failure(replay['hash'])
+        else:
+            log.error(f'Failed to parse {replay["hash"]}: {error}')
+            db.record_failure(replay, 'parse', error)
+            progress.update(failed=True)
 
+        source.done(replay['hash'])
+        source.checkpoint(db, ingest)
 
-def get_replays_from_response(response, output_dir: str, db: Database, total_page: int, process_count: int = 1):
-    log.info(f"Downloading replays from page {response['page']}/{total_page}")
-    existing = db.get_existing_hashes()
-    with Pool(processes=process_count) as p:
-        for record in p.imap_unordered(partial(process_replay, output_dir=output_dir, existing_hashes=existing),
-                                       response['data'], 1):
-            if record is not None:
-                db.add(record)
-                db.commit()
+    source.checkpoint(db, ingest)
+    ingest.close()
+    progress.close()
 
 
 if __name__ == '__main__':
@@ -77,15 +388,24 @@ if __name__ == '__main__':
     parser.add_argument('--api-key', '-a', type=str, required=True)
     parser.add_argument('--output-dir', '-o', type=str, required=True)
     parser.add_argument('--processes', '-p', type=int, default=1)
-    parser.add_argument('--page', type=int, default=1)
+    parser.add_argument('--downloads', type=int, default=16, help='Maximum number of concurrent downloads')
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--prefetch', type=int, default=2, help='Number of listing pages to fetch ahead')
+    parser.add_argument('--host', type=str, default=HOST)
+    parser.add_argument('--page', type=int, default=None,
+                        help='Page to start from, defaults to resuming an unfinished first crawl. After that every '
+                             'crawl starts from the first page and stops at the replays the database has already')
+    parser.add_argument('--parse-timeout', type=float, default=600, help='Seconds before a parse is killed')
+    parser.add_argument('--max-tasks-per-worker', type=int, default=50)
+    parser.add_argument('--max-worker-memory', type=int, default=None,
+                        help='Recycle parse workers above this many MiB of memory')
+    parser.add_argument('--retry-failed', action='store_true', help='Only retry previously failed replays')
+    parser.add_argument('--max-attempts', type=int, default=3)
     parser.add_argument('--log', '-l', type=str, required=True)
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
     os.makedirs(args.output_dir, exist_ok=True)
-    os.makedirs(os.path.join(args.output_dir, 'replays'), exist_ok=True)
-    os.makedirs(os.path.join(args.output_dir, 'logs'), exist_ok=True)
-    os.makedirs(os.path.join(args.output_dir, 'stats'), exist_ok=True)
-    os.makedirs(os.path.join(args.output_dir, 'df'), exist_ok=True)
 
     logging.basicConfig(handlers=[logging.StreamHandler(), logging.FileHandler(args.log, encoding='utf-8')],
                         format='%(asctime)s %(levelname)s %(threadName)s %(message)s',
@@ -94,31 +414,30 @@ if __name__ == '__main__':
     log.info('Starting...')
 
     db = Database(args.output_dir)
-
-    page = args.page
-
-    json_response = requests.get(f'{HOST}/api/v1/replays?key={args.api_key}&page={page}&playlist=28&num=200').json()
-
-    total = json_response['total_count']
-    total_page = math.ceil(total / 200)
-
-    get_replays_from_response(json_response, args.output_dir, db, total_page, args.processes)
-
-    next_url = json_response.get("next", None)
-
-    if next_url:
-        page += 1
-        next_url = f'{HOST}/api/v1/replays?key={args.api_key}&page={page}&playlist=28&num=200'
-
-    while True:
-        json_response = requests.get(next_url).json()
-        get_replays_from_response(json_response, args.output_dir, db, total_page, args.processes)
-        next_url = json_response.get('next', None)
-
-        if not next_url or len(json_response['data']) == 0:
-            break
-
-        page += 1
-        next_url = f'{HOST}/api/v1/replays?key={args.api_key}&page={page}&playlist=28&num=200'
-
+    manifest = db.artifact_writer()
+    downloader = ReplayDownloader(args.output_dir, args.host, args.downloads, args.retries, manifest=manifest,
+                                  known=db.get_artifact_hashes('replay'))
+
+    max_rss = args.max_worker_memory * 1024 * 1024 if args.max_worker_memory is not None else None
+    supervisor = Supervisor(Instrumented(partial(process_replay, output_dir=args.output_dir), args.profile > 0),
+                            args.processes, args.parse_timeout, args.max_tasks_per_worker, max_rss)
+
+    if args.retry_failed:
+        source = FailedReplaySource(db.get_failed_replays(args.max_attempts))
+    else:
+        newest = db.get_state('crawl_newest', None)
+        newest = None if newest is None else dateutil.parser.parse(newest)
+        page = args.page
+        if page is None:
+            # the first crawl resumes where it was interrupted, every later one catches up on the new uploads
+            page = 1 if newest is not None else db.get_state('crawl_page', 0) + 1
+            log.info(f'Starting crawl from page {page}')
+        source = CrawlFrontier(downloader, args.api_key, page, args.prefetch, newest)
+
+    # the crawl has no known end, only retries have a total
+    total = len(source.failed) if args.retry_failed else None
+    process_replays(source, db, downloader, supervisor, Progress.from_args('download_replays', total, args), manifest)
+
+    downloader.close()
+    manifest.close()
     db.close()
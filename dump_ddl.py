@@ -1,3 +1,4 @@
+import argparse
 from sqlalchemy import create_engine
 from database import Base
 
@@ -7,5 +8,9 @@ def metadata_dump(sql, *multiparams, **params):
     print(sql.compile(dialect=engine.dialect))
 
 
-engine = create_engine('sqlite://', strategy='mock', executor=metadata_dump)
+parser = argparse.ArgumentParser()
+parser.add_argument('--dialect', type=str, default='sqlite', help='e.g. sqlite or postgresql')
+args = parser.parse_args()
+
+engine = create_engine(f'{args.dialect}://', strategy='mock', executor=metadata_dump)
 Base.metadata.create_all(engine)
@@ -1,55 +1,74 @@
-import os
-import sys
 import logging
 import argparse
-from carball.analysis.utils.proto_manager import ProtobufManager
-from database import Database, ItemsExtracted, GoalRecord
+from functools import partial
+from multiprocessing import Pool
+from replay_summary import load_summary
+from database import Database, ItemsExtracted
+from metrics import Instrumented, Progress
+from discovery import stream, count, imap_bounded, extracted_without_goals
+import metrics
 
 log = logging.getLogger(__name__)
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-d', '--directory', type=str, required=True)
-    parser.add_argument('-p', '--processes', type=int, default=1)
-    args = parser.parse_args()
 
-    db = Database(args.directory)
-    total = db.Session().query(ItemsExtracted).count()
-    processed = 0
+def get_goals(summary):
+    goals = []
+
+    for goal in summary['goals']:
+        player = next(filter(lambda x: x['id'] == goal['player_id'], summary['players']))
+
+        goals.append({
+            'player_id': goal['player_id'],
+            'frame': goal['frame'],
+            'pre_item': goal['pre_items'],
+            'item': goal['used_item'] if goal['scored_with_item'] else -1,
+            'is_orange': player['is_orange']
+        })
 
-    for replay in db.Session().query(ItemsExtracted):
-        try:
-            with open(os.path.join(args.directory, f'stats/{replay.hash}.pts'), 'rb') as f:
-                proto = ProtobufManager.read_proto_out_from_file(f)
+    return goals
 
-                for goal in proto.game_metadata.goals:
-                    player = next(filter(lambda x: x.id.id == goal.player_id.id, proto.players))
 
-                    goal_record = GoalRecord(
-                        parent_id=replay.id,
-                        player_id=goal.player_id.id,
-                        frame=goal.frame_number,
-                        pre_item=goal.extra_mode_info.pre_items,
-                        is_orange=player.is_orange
-                    )
+def process(replay_hash: str, directory: str):
+    try:
+        summary = load_summary(directory, replay_hash)
+        with metrics.timer('extract'):
+            return get_goals(summary)
+    except Exception as e:
+        log.error(f'Failed to handle {replay_hash}', exc_info=e)
+        return None
 
-                    if goal.extra_mode_info.scored_with_item:
-                        goal_record.item = goal.extra_mode_info.used_item
-                    else:
-                        goal_record.item = -1
 
-                    db.Session().add(goal_record)
+def process_with_hash(replay_hash: str, directory: str):
+    return replay_hash, process(replay_hash, directory)
 
-                if processed % 1000 == 0:
-                    db.commit()
 
-        except Exception as e:
-            log.error(f'Failed to handle {replay.hash}', exc_info=e)
-            db.Session.rollback()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('--all', action='store_true', help='Extract the goals of replays that already have some')
+    parser.add_argument('--batch-size', type=int, default=5000, help='Rows written per transaction')
+    parser.add_argument('--flush-interval', type=float, default=5.0, help='Seconds between writes at most')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    db = Database(args.directory)
+    # goals go through the extraction writer so that the goal rollup stays in sync
+    writer = db.extraction_writer(args.batch_size, args.flush_interval)
+    table = ItemsExtracted.__table__
+    pending = None if args.all else extracted_without_goals()
+    replays = map(lambda x: x['hash'], stream(db, table, [table.c.hash], pending))
+
+    progress = Progress.from_args('extract_goals', count(db, table, pending), args)
+    task = Instrumented(partial(process_with_hash, directory=args.directory), args.profile > 0)
 
-        finally:
-            processed += 1
-            sys.stdout.write(f'\r{processed}/{total}')
-            sys.stdout.flush()
+    with Pool(args.processes) as p:
+        for (replay_hash, goals), timings, profile in imap_bounded(p, task, replays, args.processes * 40,
+                                                                   chunksize=10):
+            if goals is not None:
+                writer.add({'hash': replay_hash}, goals=goals, replace=True)
+            progress.update(timings=timings, key=replay_hash, profile=profile, failed=goals is None)
 
-    db.commit()
+    writer.close()
+    progress.close()
+    db.close()
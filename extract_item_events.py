@@ -1,17 +1,18 @@
-import os
 import re
-import sys
-import gzip
 import json
 import logging
 import argparse
 import numpy as np
 from functools import partial
+from contextlib import nullcontext
 from multiprocessing import Pool
-from carball.analysis.utils.pandas_manager import PandasManager
-from carball.analysis.utils.proto_manager import ProtobufManager
-from database import Database, ReplayRecord, ItemRecord, ItemsExtracted
+from database import Database, ReplayRecord, ExtractionWriter
 from map import maps
+from replay_summary import load_summary
+from item_sidecar import load_item_uses
+from metrics import Instrumented, Progress
+from discovery import stream, count, imap_bounded, replays_without_items
+import metrics
 
 STEAM_ID_PATTERN = re.compile('^7656119[0-9]+$')
 log = logging.getLogger(__name__)
@@ -21,15 +22,14 @@ def is_steam_id(player_id: str):
     return STEAM_ID_PATTERN.match(player_id) is not None
 
 
-def is_kickoff_item(frame_get: int, proto, id: str):
+def is_kickoff_item(frame_get: int, summary, id: str):
     try:
-        kickoff_frame = next(frame for frame in map(lambda x: x.start_frame_number, reversed(proto.game_stats.kickoffs)) if
-                             frame < frame_get)
+        kickoff_frame = next(frame for frame in reversed(summary['kickoffs']) if frame < frame_get)
     except StopIteration:
         return False
 
     item_get_frames = list(
-        map(lambda x: x.frame_number_get, filter(lambda x: x.player_id.id == id, proto.game_stats.rumble_items)))
+        map(lambda x: x['frame_get'], filter(lambda x: x['player_id'] == id, summary['rumble_items'])))
 
     # first item get frame after kick off
     next_get_frame = next((frame for frame in item_get_frames if frame > kickoff_frame), -1)
@@ -37,132 +37,167 @@ def is_kickoff_item(frame_get: int, proto, id: str):
     return frame_get == next_get_frame
 
 
-def process_replay(replay: ReplayRecord, directory: str):
-    try:
-        replay['mmrs'] = json.loads(replay['mmrs'])
-        replay['ranks'] = json.loads(replay['ranks'])
+def get_rank_data(replay: dict):
+    rank_mmr = list(zip(json.loads(replay['mmrs']), json.loads(replay['ranks'])))
+    rank_mmr = list(filter(lambda x: x[0] is not None and x[0] > 0, rank_mmr))
 
-        rank_mmr = list(zip(replay['mmrs'], replay['ranks']))
-        rank_mmr = list(filter(lambda x: x[0] is not None and x[0] > 0, rank_mmr))
+    if len(rank_mmr) == 0:
+        return None, None
 
-        replay_data = {
-            'hash': replay['hash'],
-            'map': None,
-            'avg_mmr': None,
-            'avg_rank': None
-        }
+    if all(map(lambda x: x[1] == 0, rank_mmr)):
+        return None, None
 
-        if len(rank_mmr) == 0:
-            return None, replay_data
+    avg_mmr = np.average(list(map(lambda x: x[0], rank_mmr))).item()
+    avg_rank = round(np.average(list(filter(lambda x: x > 0, map(lambda x: x[1], rank_mmr)))).item())
 
-        if all(map(lambda x: x[1] == 0, rank_mmr)):
-            return None, replay_data
+    return avg_mmr, avg_rank
 
-        avg_mmr = np.average(list(map(lambda x: x[0], rank_mmr))).item()
-        avg_rank = round(np.average(list(filter(lambda x: x > 0, map(lambda x: x[1], rank_mmr)))).item())
 
-        replay_data['avg_mmr'] = avg_mmr
-        replay_data['avg_rank'] = avg_rank
+def get_kickoff_items(summary, player_ids: np.ndarray, frame_get: np.ndarray):
+    is_kickoff = np.zeros(len(frame_get), dtype=bool)
+    kickoffs = np.array(summary['kickoffs'], dtype=np.int64)
 
-        with gzip.open(os.path.join(directory, f'df/{replay["hash"]}.gzip'), 'rb') as f:
-            frames = PandasManager.read_numpy_from_memory(f)
+    if len(kickoffs) == 0:
+        return is_kickoff
 
-        with open(os.path.join(directory, f'stats/{replay["hash"]}.pts'), 'rb') as f:
-            proto = ProtobufManager.read_proto_out_from_file(f)
+    # the last kickoff before each item, the searches below assume chronological order so check that first
+    kickoff_sorted = bool(np.all(np.diff(kickoffs) >= 0))
+    kickoff_index = np.searchsorted(kickoffs, frame_get, side='left') - 1
 
-        replay_data['map'] = maps.inverse[proto.game_metadata.map]
+    for player_id in np.unique(player_ids):
+        mask = player_ids == player_id
+        gets = frame_get[mask]
 
-        ids = dict(map(lambda x: (x.id.id, (x.name, x.is_orange)), proto.players))
+        if not kickoff_sorted or np.any(np.diff(gets) < 0):
+            is_kickoff[mask] = list(map(lambda x: is_kickoff_item(x, summary, player_id), gets))
+            continue
 
-        events = []
+        after_kickoff = kickoff_index[mask] >= 0
+        kickoff_frames = kickoffs[np.maximum(kickoff_index[mask], 0)]
+        # first item get frame after kick off
+        next_get_frames = gets[np.minimum(np.searchsorted(gets, kickoff_frames, side='right'), len(gets) - 1)]
+        is_kickoff[mask] = after_kickoff & (gets == next_get_frames)
 
-        for event in proto.game_stats.rumble_items:
-            df = frames[ids[event.player_id.id][0]]
+    return is_kickoff
 
-            item_event = {
-                'player_id': event.player_id.id,
-                'frame_get': event.frame_number_get,
-                'frame_use': event.frame_number_use,
-                'item': event.item,
-                'use_x': None,
-                'use_y': None,
-                'use_z': None,
-                'wait_time': None,
-                'is_kickoff': is_kickoff_item(event.frame_number_get, proto, event.player_id.id),
-                'is_orange': ids[event.player_id.id][1] == 1,
-            }
 
-            if event.frame_number_use > -1:
-                item_event['use_x'] = df.loc[event.frame_number_use]['pos_x'].item()
-                item_event['use_y'] = df.loc[event.frame_number_use]['pos_y'].item()
-                item_event['use_z'] = df.loc[event.frame_number_use]['pos_z'].item()
-                item_event['wait_time'] = frames['game'].loc[event.frame_number_use]['time'].item() - \
-                                          frames['game'].loc[event.frame_number_get]['time'].item()
+def get_item_events(summary, uses):
+    # uses are the times and positions of item_sidecar.get_item_uses
+    ids = dict(map(lambda x: (x['id'], (x['name'], x['is_orange'])), summary['players']))
+    rumble_items = summary['rumble_items']
 
-            events.append(item_event)
+    if len(rumble_items) == 0:
+        return []
 
-        return events, replay_data
-    except Exception as e:
-        log.error(f'Failed to handle {replay["hash"]}', exc_info=e)
-        return None, None
+    player_ids = np.array(list(map(lambda x: x['player_id'], rumble_items)))
+    frame_get = np.array(list(map(lambda x: x['frame_get'], rumble_items)), dtype=np.int64)
+    frame_use = np.array(list(map(lambda x: x['frame_use'], rumble_items)), dtype=np.int64)
+    is_kickoff = get_kickoff_items(summary, player_ids, frame_get)
+
+    used = np.flatnonzero(frame_use > -1).tolist()
+    missing = list(filter(lambda x: uses['time_get'][x] is None or uses['time_use'][x] is None, used))
+    if len(missing) > 0:
+        raise KeyError(f'Frames {list(map(lambda x: (frame_get[x].item(), frame_use[x].item()), missing))} are missing')
+
+    # position and wait time of the used items
+    used = dict(map(lambda x: (x, ((uses['use_x'][x], uses['use_y'][x], uses['use_z'][x]),
+                                   uses['time_use'][x] - uses['time_get'][x])), used))
+
+    events = []
+    for i, event in enumerate(rumble_items):
+        position, wait_time = used.get(i, ((None, None, None), None))
+
+        events.append({
+            'player_id': event['player_id'],
+            'frame_get': event['frame_get'],
+            'frame_use': event['frame_use'],
+            'item': event['item'],
+            'use_x': position[0],
+            'use_y': position[1],
+            'use_z': position[2],
+            'wait_time': wait_time,
+            'is_kickoff': bool(is_kickoff[i]),
+            'is_orange': ids[event['player_id']][1] == 1,
+        })
+
+    return events
 
 
-def add_to_db(events, db: Database, replay_data):
+def process_replay(replay: dict, directory: str):
     try:
-        if replay_data is None:
-            return
+        replay_data = {
+            'hash': replay['hash'],
+            'map': None,
+            'avg_mmr': None,
+            'avg_rank': None
+        }
 
-        extracted = db.Session().query(ItemsExtracted).filter_by(hash=replay_data['hash']).first()
+        avg_mmr, avg_rank = get_rank_data(replay)
+
+        if avg_rank is None:
+            return None, replay_data
+
+        replay_data['avg_mmr'] = avg_mmr
+        replay_data['avg_rank'] = avg_rank
 
-        if extracted is None:
-            extracted = ItemsExtracted.create(replay_data)
-            db.Session().add(extracted)
-            db.commit()
+        summary = load_summary(directory, replay['hash'])
+        uses = load_item_uses(directory, replay['hash'], summary)
 
-        if events is None:
-            return
+        replay_data['map'] = maps.inverse[summary['map']]
 
-        for event in events:
-            record = ItemRecord.create(event)
-            record.parent_id = extracted.id
-            record.parent = extracted
-            db.add(record)
-        db.commit()
+        with metrics.timer('extract'):
+            return get_item_events(summary, uses), replay_data
     except Exception as e:
-        log.error('', exc_info=e)
-        db.Session().rollback()
+        log.error(f'Failed to handle {replay["hash"]}', exc_info=e)
+        return None, None
+
+
+def add_to_db(events, writer: ExtractionWriter, replay_data):
+    if replay_data is None:
+        return
+
+    writer.add(replay_data, events)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--directory', type=str, required=True)
     parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=5000, help='Rows written per transaction')
+    parser.add_argument('--flush-interval', type=float, default=5.0, help='Seconds between writes at most')
+    parser.add_argument('--ingest-mode', action='store_true',
+                        help='Drop the secondary indexes during the run and rebuild them at the end')
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
     db = Database(args.directory)
+    writer = db.extraction_writer(args.batch_size, args.flush_interval)
 
-    processed = db.Session().query(ItemRecord.parent_id, ItemsExtracted.hash).join(ItemsExtracted).distinct()
-    processed = set(map(lambda x: x.hash, processed))
-
-    replays = list(filter(lambda x: x['hash'] not in processed, map(lambda x: x.as_dict(), db.get_replays())))
+    # replays without item rows, streamed in pages as the pool asks for them
+    pending = replays_without_items()
+    replays = stream(db, ReplayRecord.__table__, where=pending)
 
     # process_replay(next(filter(lambda x: x['hash'] == 'AC37C42811E9603488AB2C8907F79D1C', replays)), args.directory)
 
-    progress = 0
-
-    if args.processes > 1:
-        with Pool(args.processes) as p:
-            for events, replay_data in p.imap_unordered(partial(process_replay, directory=args.directory), replays,
-                                                        chunksize=10):
-                add_to_db(events, db, replay_data)
-                progress += 1
-                sys.stdout.write(f'\r{progress}/{len(replays)}')
-                sys.stdout.flush()
-
-    else:
-        for replay in replays:
-            events, replay_data = process_replay(replay, args.directory)
-            add_to_db(events, db, replay_data)
-            progress += 1
-            sys.stdout.write(f'\r{progress}/{len(replays)}')
-            sys.stdout.flush()
+    with db.ingest_mode() if args.ingest_mode else nullcontext():
+        progress = Progress.from_args('extract_item_events', count(db, ReplayRecord.__table__, pending), args)
+        task = Instrumented(partial(process_replay, directory=args.directory), args.profile > 0)
+
+        def handle(result):
+            (events, replay_data), timings, profile = result
+            add_to_db(events, writer, replay_data)
+            progress.update(timings=timings, key=replay_data and replay_data['hash'], profile=profile,
+                            failed=replay_data is None)
+
+        if args.processes > 1:
+            with Pool(args.processes) as p:
+                for result in imap_bounded(p, task, replays, args.processes * 40, chunksize=10):
+                    handle(result)
+
+        else:
+            for replay in replays:
+                handle(task(replay))
+
+        writer.close()
+        progress.close()
+    db.close()
@@ -0,0 +1,172 @@
+import logging
+import argparse
+from functools import partial
+from contextlib import nullcontext
+from multiprocessing import Pool
+from database import Database, ReplayRecord
+from extract_item_events import get_rank_data, get_item_events
+from item_sidecar import get_frame_columns, get_item_uses, read_item_uses
+from frame_store import load_frames
+from replay_summary import load_summary
+from map import maps
+from metrics import Instrumented, Progress
+from discovery import stream, count, imap_bounded, replays_not_extracted
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+class ReplayContext(object):
+
+    def __init__(self, replay: dict, directory: str):
+        self.replay = replay
+        self.hash = replay['hash']
+        self.directory = directory
+        self.frame_columns = set()
+        self.avg_mmr, self.avg_rank = get_rank_data(replay)
+        self._summary = None
+        self._frames = None
+        self._item_uses = None
+        self._item_uses_read = False
+
+    @property
+    def summary(self):
+        if self._summary is None:
+            self._summary = load_summary(self.directory, self.hash)
+        return self._summary
+
+    @property
+    def frames(self):
+        # loaded once with the columns of every extractor
+        if self._frames is None:
+            self._frames = load_frames(self.directory, self.hash, sorted(self.frame_columns))
+        return self._frames
+
+    @property
+    def item_uses(self):
+        # from the item sidecar, None for replays parsed before it existed
+        if not self._item_uses_read:
+            self._item_uses = read_item_uses(self.directory, self.hash, self.summary)
+            self._item_uses_read = True
+        return self._item_uses
+
+
+class Extractor(object):
+    name = None
+
+    def frame_columns(self, context: ReplayContext):
+        return []
+
+    def extract(self, context: ReplayContext, result: dict):
+        raise NotImplementedError
+
+
+class MetadataExtractor(Extractor):
+    name = 'metadata'
+
+    def extract(self, context: ReplayContext, result: dict):
+        team_0_score, team_1_score = context.summary['score']
+
+        result['replay']['map'] = maps.inverse[context.summary['map']]
+        result['replay']['match_date'] = context.replay['match_date']
+        result['replay']['orange_winner'] = team_0_score < team_1_score if team_0_score != team_1_score else None
+
+
+class ItemExtractor(Extractor):
+    name = 'items'
+
+    def frame_columns(self, context: ReplayContext):
+        if context.avg_rank is None or context.item_uses is not None:
+            return []
+        return get_frame_columns(context.summary)
+
+    def extract(self, context: ReplayContext, result: dict):
+        if context.avg_rank is None:
+            return
+        uses = context.item_uses
+        if uses is None:
+            uses = get_item_uses(context.summary, context.frames)
+        result['items'] = get_item_events(context.summary, uses)
+
+
+class GoalExtractor(Extractor):
+    name = 'goals'
+
+    def extract(self, context: ReplayContext, result: dict):
+        players = dict(map(lambda x: (x['id'], x), context.summary['players']))
+
+        result['goals'] = [{
+            'player_id': goal['player_id'],
+            'frame': goal['frame'],
+            'pre_item': goal['pre_items'],
+            'item': goal['used_item'] if goal['scored_with_item'] else -1,
+            'is_orange': players[goal['player_id']]['is_orange']
+        } for goal in context.summary['goals']]
+
+
+EXTRACTORS = dict(map(lambda x: (x.name, x), [MetadataExtractor, ItemExtractor, GoalExtractor]))
+
+
+def extract_replay(replay: dict, directory: str, extractors):
+    try:
+        context = ReplayContext(replay, directory)
+        result = {
+            'replay': {
+                'hash': context.hash,
+                'avg_mmr': context.avg_mmr,
+                'avg_rank': context.avg_rank
+            },
+            'items': None,
+            'goals': None
+        }
+
+        for extractor in extractors:
+            context.frame_columns.update(extractor.frame_columns(context))
+
+        # the lazily loaded summary and frames are timed on their own and inside the first extractor using them
+        for extractor in extractors:
+            with metrics.timer(f'extract_{extractor.name}'):
+                extractor.extract(context, result)
+
+        return result
+    except Exception as e:
+        log.error(f'Failed to handle {replay["hash"]}', exc_info=e)
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('-e', '--extractors', nargs='+', choices=list(EXTRACTORS.keys()),
+                        default=list(EXTRACTORS.keys()))
+    parser.add_argument('--all', action='store_true', help='Rerun the extractors on already extracted replays')
+    parser.add_argument('--batch-size', type=int, default=5000, help='Rows written per transaction')
+    parser.add_argument('--flush-interval', type=float, default=5.0, help='Seconds between writes at most')
+    parser.add_argument('--ingest-mode', action='store_true',
+                        help='Drop the secondary indexes during the run and rebuild them at the end')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    db = Database(args.directory)
+    writer = db.extraction_writer(args.batch_size, args.flush_interval)
+
+    pending = None if args.all else replays_not_extracted()
+    replays = stream(db, ReplayRecord.__table__, where=pending)
+    extractors = list(map(lambda x: EXTRACTORS[x](), args.extractors))
+
+    with db.ingest_mode() if args.ingest_mode else nullcontext():
+        progress = Progress.from_args('extraction', count(db, ReplayRecord.__table__, pending), args)
+        task = Instrumented(partial(extract_replay, directory=args.directory, extractors=extractors), args.profile > 0)
+
+        with Pool(args.processes) as p:
+            for result, timings, profile in imap_bounded(p, task, replays, args.processes * 40, chunksize=10):
+                if result is not None:
+                    # rerunning an extractor replaces the rows it produced before
+                    writer.add(result['replay'], result['items'], result['goals'], replace=True)
+                progress.update(timings=timings, key=result and result['replay']['hash'], profile=profile,
+                                failed=result is None)
+
+        writer.close()
+        progress.close()
+    db.close()
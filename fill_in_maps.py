@@ -1,25 +1,28 @@
-import sys
+import argparse
 from map import maps
+from backfill import run_file_backfill
 from database import Database, ItemsExtracted
-from carball.analysis.utils.proto_manager import ProtobufManager
+from replay_summary import load_summary
+import metrics
 
-db = Database('D:\\rumble_replays')
 
-processed = 0
-missing_replays = list(db.Session().query(ItemsExtracted).filter(ItemsExtracted.map == None))
+def get_map(replay_hash: str, directory: str):
+    summary = load_summary(directory, replay_hash)
+    return {'map': maps.inverse[summary['map']]}
 
-for item_e in missing_replays:
-    with open(f'D:\\rumble_replays\\stats/{item_e.hash}.pts', 'rb') as f:
-        proto = ProtobufManager.read_proto_out_from_file(f)
 
-    item_e.map = maps.inverse[proto.game_metadata.map]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
 
-    processed += 1
-    sys.stdout.write(f'\r{processed}/{len(missing_replays)}')
-    sys.stdout.flush()
+    db = Database(args.directory)
+    table = ItemsExtracted.__table__
 
-    if processed % 1000 == 0:
-        db.commit()
+    run_file_backfill(db, args.directory, table, [table.c.hash], get_map, table.c.map.is_(None), args.processes,
+                      args.chunk_size, args)
 
-db.commit()
-db.close()
+    db.close()
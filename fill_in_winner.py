@@ -1,27 +1,32 @@
-import sys
+import argparse
+from backfill import run_file_backfill
 from database import Database, ItemsExtracted
-from carball.analysis.utils.proto_manager import ProtobufManager
+from replay_summary import load_summary
+import metrics
 
-db = Database('D:\\rumble_replays')
 
-processed = 0
-total = db.Session().query(ItemsExtracted).count()
+def get_winner(replay_hash: str, directory: str):
+    summary = load_summary(directory, replay_hash)
 
-for item_e in db.Session().query(ItemsExtracted):
-    with open(f'D:\\rumble_replays\\stats/{item_e.hash}.pts', 'rb') as f:
-        proto = ProtobufManager.read_proto_out_from_file(f)
-
-    score = proto.game_metadata.score
-    if score.team_0_score != score.team_1_score:
-        item_e.orange_winner = score.team_0_score < score.team_1_score
+    team_0_score, team_1_score = summary['score']
+    if team_0_score != team_1_score:
+        return {'orange_winner': team_0_score < team_1_score}
     else:
-        item_e.orange_winner = None
-    processed += 1
-    sys.stdout.write(f'\r{processed}/{total}')
-    sys.stdout.flush()
+        return {'orange_winner': None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    db = Database(args.directory)
+    table = ItemsExtracted.__table__
 
-    if processed % 1000 == 0:
-        db.commit()
+    run_file_backfill(db, args.directory, table, [table.c.hash], get_winner, processes=args.processes,
+                      chunk_size=args.chunk_size, args=args)
 
-db.commit()
-db.close()
+    db.close()
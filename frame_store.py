@@ -0,0 +1,174 @@
+import os
+import gzip
+import logging
+import json
+import struct
+import argparse
+import numpy as np
+import pandas as pd
+from functools import partial
+from multiprocessing import Pool
+from artifact_store import ArtifactStore
+from database import Database
+from metrics import Instrumented, Progress
+import metrics
+
+log = logging.getLogger(__name__)
+
+# A .frames file is the magic, the length of a json header and then one uncompressed, aligned block per column,
+# so single columns can be memory-mapped without touching the rest of the file.
+MAGIC = b'RLFRAME1'
+ALIGNMENT = 64
+
+
+def _encode(series: pd.Series):
+    if isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biuf':
+        return np.ascontiguousarray(series.values), None
+
+    # strings and nullable booleans are stored as category codes, -1 being missing
+    codes, categories = pd.factorize(series)
+    return codes.astype(np.int16 if len(categories) < 2 ** 15 else np.int32), categories.tolist()
+
+
+def write_frames(file_path: str, df: pd.DataFrame):
+    blocks = [(None, None, np.ascontiguousarray(df.index.values.astype(np.int64)), None)]
+    for obj, field in df.columns:
+        array, categories = _encode(df[(obj, field)])
+        blocks.append((obj, field, array, categories))
+
+    columns = []
+    offset = 0
+    for obj, field, array, categories in blocks:
+        column = {'object': obj, 'field': field, 'dtype': array.dtype.str, 'offset': offset}
+        if categories is not None:
+            column['categories'] = categories
+        columns.append(column)
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({'rows': len(df.index), 'index': columns[0], 'columns': columns[1:]}).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    with open(f'{file_path}.part', 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for column, (_, _, array, _) in zip(columns, blocks):
+            f.seek(data_start + column['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+    os.replace(f'{file_path}.part', file_path)
+
+
+def read_header(file_path: str):
+    with open(file_path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{file_path} is not a frames file')
+        header_length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_length).decode('utf-8'))
+
+    header['data_start'] = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+    return header
+
+
+def read_arrays(file_path: str, columns=None):
+    # memory-maps the requested (object, field) columns, or all of them, the frame numbers are under 'index'
+    header = read_header(file_path)
+    wanted = None if columns is None else set(columns)
+    arrays = {}
+
+    for column in [header['index']] + header['columns']:
+        key = 'index' if column['object'] is None else (column['object'], column['field'])
+        if key != 'index' and wanted is not None and key not in wanted:
+            continue
+
+        array = np.memmap(file_path, dtype=np.dtype(column['dtype']), mode='r',
+                          offset=header['data_start'] + column['offset'], shape=(header['rows'],))
+        if 'categories' in column:
+            array = np.array(column['categories'] + [np.nan], dtype=object)[array]
+        arrays[key] = array
+
+    return arrays
+
+
+def read_frames(file_path: str, columns=None):
+    arrays = read_arrays(file_path, columns)
+    index = pd.Index(np.array(arrays.pop('index')))
+    df = pd.DataFrame({key: np.array(array) for key, array in arrays.items()}, index=index)
+    df.columns = pd.MultiIndex.from_tuples(list(arrays.keys()))
+    return df
+
+
+def load_frames(directory: str, replay_hash: str, columns=None):
+    store = ArtifactStore(directory)
+    file_path = store.locate(replay_hash, 'frames')
+    if file_path is not None:
+        with metrics.timer('frame_load'):
+            return read_frames(file_path, columns)
+
+    # replays parsed before the frame store existed only have the gzipped pandas dump
+    from carball.analysis.utils.pandas_manager import PandasManager
+
+    with metrics.timer('frame_load'), store.open(replay_hash, 'df') as raw, gzip.open(raw, 'rb') as f:
+        df = PandasManager.read_numpy_from_memory(f)
+
+    if columns is not None:
+        df = df[[column for column in columns if column in df.columns]]
+
+    return df
+
+
+def convert(replay_hash: str, directory: str, delete: bool):
+    # returns the hash, the manifest entry of the written frames or None if they existed already and whether the
+    # gzip file was deleted, None when the conversion failed
+    try:
+        from carball.analysis.utils.pandas_manager import PandasManager
+
+        store = ArtifactStore(directory)
+        gzip_file = store.locate(replay_hash, 'df')
+        entry = None
+
+        if not store.exists(replay_hash, 'frames'):
+            file_path = store.target(replay_hash, 'frames')
+            with gzip.open(gzip_file, 'rb') as f:
+                write_frames(file_path, PandasManager.read_numpy_from_memory(f))
+            entry = store.register(replay_hash, 'frames', file_path)
+
+        if delete:
+            os.remove(gzip_file)
+        return replay_hash, entry, delete
+    except Exception:
+        log.exception(f'Failed to convert {replay_hash}')
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts the gzipped pandas dumps in df/ to the frame store')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('--delete', action='store_true', help='Delete the gzip files once converted')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    db = Database(args.directory)
+    manifest = db.artifact_writer()
+
+    hashes = list(ArtifactStore(args.directory).hashes('df'))
+    progress = Progress.from_args('frame_store', len(hashes), args)
+    fn = Instrumented(partial(convert, directory=args.directory, delete=args.delete), args.profile > 0)
+
+    with Pool(args.processes) as p:
+        for result, timings, profile in p.imap_unordered(fn, hashes, chunksize=10):
+            if result is not None:
+                replay_hash, entry, deleted = result
+                if entry is not None:
+                    manifest.add(entry)
+                if deleted:
+                    manifest.remove(replay_hash, 'df')
+            progress.update(timings=timings, key=result and result[0], profile=profile, failed=result is None)
+    progress.close()
+
+    manifest.close()
+    db.close()
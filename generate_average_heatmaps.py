@@ -1,15 +1,20 @@
 import os
-import sys
-import gzip
+import logging
 import argparse
-import pandas as pd
 import numpy as np
 from map import standard_maps, maps
 from functools import partial
 from multiprocessing import Pool
 from database import Database, ItemsExtracted
-from carball.analysis.utils.proto_manager import ProtobufManager
-from carball.analysis.utils.pandas_manager import PandasManager
+from frame_store import load_frames
+from replay_summary import load_summary
+from heatmap_store import HeatmapStore
+from season import get_season
+from metrics import Instrumented, Progress
+from discovery import stream, count, imap_bounded
+import metrics
+
+log = logging.getLogger(__name__)
 
 item_map = {
     'ball_freeze': 1,
@@ -26,90 +31,169 @@ item_map = {
     'tornado': 11
 }
 
+ITEM_COUNT = 11
+
 heatmap_range = ((-4500, 4500), (-6500, 6500))
 heatmap_bins = (int(9000 / 50), int(13000 / 50))
 
 
+def get_live_frames(index: np.ndarray, summary):
+    # false from the start of the replay to the first kickoff and from every goal to the kickoff after it
+    live = np.ones(len(index), dtype=bool)
+    kickoffs = summary['kickoffs']
+
+    if len(kickoffs) == 0:
+        return live
+
+    live &= ~((index >= 0) & (index <= kickoffs[0]))
+
+    for i, goal in enumerate(summary['goals']):
+        if len(kickoffs) > i + 1:
+            kickoff = kickoffs[i + 1]
+        else:
+            kickoff = index[live][-1]
+
+        live &= ~((index >= goal['frame']) & (index <= kickoff))
+
+    return live
+
+
+def get_unheld_frames(power_up_active: np.ndarray):
+    # frames where no item is active, minus the run of frames right after an item was used
+    is_active = power_up_active == True
+    is_inactive = power_up_active == False
+
+    positions = np.arange(len(power_up_active))
+    last_not_inactive = np.maximum.accumulate(np.where(is_inactive, -1, positions))
+    previous = np.concatenate([[-1], last_not_inactive[:-1]])
+    after_use = (previous >= 0) & is_active[np.maximum(previous, 0)]
+
+    return is_inactive & ~after_use
+
+
 def process(replay_hash: str, directory: str):
     try:
-        with open(os.path.join(directory, f'stats/{replay_hash}.pts'), 'rb') as f:
-            proto = ProtobufManager.read_proto_out_from_file(f)
-
-        with gzip.open(os.path.join(directory, f'df/{replay_hash}.gzip'), 'rb') as f:
-            df = PandasManager.read_numpy_from_memory(f)
-    except Exception as e:
-        return
+        summary = load_summary(directory, replay_hash)
 
-    if len(proto.game_stats.kickoffs) > 0:
-        df.drop(df.loc[0:proto.game_stats.kickoffs[0].start_frame_number].index, inplace=True, errors='ignore')
+        columns = []
+        for player in summary['players']:
+            columns += [(player['name'], field) for field in ['pos_x', 'pos_y', 'power_up', 'power_up_active']]
+        df = load_frames(directory, replay_hash, columns)
 
-        for i, goal in enumerate(proto.game_metadata.goals):
-            if len(proto.game_stats.kickoffs) > i + 1:
-                kickoff = proto.game_stats.kickoffs[i + 1].start_frame_number
-            else:
-                kickoff = df.index[-1].item()
+        with metrics.timer('heatmap'):
+            return get_heatmap(summary, df)
+    except Exception:
+        # one bad replay must not take the whole run and its uncommitted counts down with it
+        log.exception(f'Failed to load heatmap of {replay_hash}')
+        return None
 
-            df.drop(df.loc[goal.frame_number:kickoff].index, inplace=True, errors='ignore')
 
-    item_dfs = []
+def get_heatmap(summary, df):
+    live = get_live_frames(df.index.values, summary)
 
-    for i in range(11):
-        item_dfs.append(pd.DataFrame(columns=['pos_x', 'pos_y', 'pos_z']))
+    items = []
+    xs = []
+    ys = []
 
-    for player in proto.players:
-        pdf = df[player.name]
+    for player in summary['players']:
+        pdf = df[player['name']]
         if 'power_up_active' not in pdf.columns:
             continue
         if 'power_up' not in pdf.columns:
             continue
-        pdf.drop('time_till_power_up', axis=1, inplace=True, errors='ignore')
-        while len(pdf.loc[(pdf['power_up_active'].shift(1) == True) & (pdf['power_up_active'] == False)]) > 0:
-            pdf = pdf.loc[(pdf['power_up_active'].shift(1) != True) | (pdf['power_up_active'] != False)]
 
-        pdf = pdf[pdf['power_up_active'] == False]
+        power_up_active = pdf['power_up_active'].to_numpy(dtype=object)[live]
+        power_up = pdf['power_up'].to_numpy(dtype=object)[live]
+        unheld = get_unheld_frames(power_up_active)
+
+        sign = -1 if player['is_orange'] else 1
+        pos_x = sign * pdf['pos_x'].values[live]
+        pos_y = sign * pdf['pos_y'].values[live]
 
-        if player.is_orange:
-            pdf['pos_y'] = -pdf['pos_y']
-            pdf['pos_x'] = -pdf['pos_x']
+        for item_name, item in item_map.items():
+            mask = unheld & (power_up == item_name)
+            items.append(np.full(np.count_nonzero(mask), item - 1))
+            xs.append(pos_x[mask])
+            ys.append(pos_y[mask])
 
-        for item_name in item_map.keys():
-            item_dfs[item_map[item_name] - 1] = item_dfs[item_map[item_name] - 1] \
-                .append(pdf.loc[pdf['power_up'] == item_name][['pos_x', 'pos_y', 'pos_z']], ignore_index=True)
+    if len(items) == 0:
+        items, xs, ys = [np.empty(0)], [np.empty(0)], [np.empty(0)]
 
-    h = list(map(lambda x: np.histogram2d(x['pos_x'], x['pos_y'], heatmap_bins, heatmap_range)[0], item_dfs))
+    # one histogram over (item, x, y), the item axis has a bin per item
+    h, _ = np.histogramdd((np.concatenate(items) + 0.5, np.concatenate(xs), np.concatenate(ys)),
+                          (ITEM_COUNT,) + heatmap_bins, ((0, ITEM_COUNT),) + heatmap_range)
 
-    return h
+    return list(h)
+
+
+def process_with_key(task, directory: str):
+    # the key travels with the task so that nothing has to be kept per pending replay
+    replay_hash, key = task
+    return replay_hash, key, process(replay_hash, directory)
+
+
+def get_heatmap_key(replay):
+    # replay is a row or dict of items_extracted
+    return replay['avg_rank'], get_season(replay['match_date']), replay['map']
+
+
+def worker_stores(store_dir: str):
+    # queue workers (worker.py -j heatmaps) each fold into their own store under workers/
+    workers = os.path.join(store_dir, 'workers')
+    names = sorted(os.listdir(workers)) if os.path.isdir(workers) else []
+    return list(map(lambda x: HeatmapStore(os.path.join(workers, x), (ITEM_COUNT,) + heatmap_bins), names))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--directory', type=str, required=True)
     parser.add_argument('-p', '--processes', type=int, required=True)
+    parser.add_argument('-s', '--store', type=str, default=None,
+                        help='Heatmap store directory, defaults to heatmaps/ in the replay directory')
+    parser.add_argument('--commit-every', type=int, default=10000, help='Replays to fold in between commits')
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
-    db = Database(args.directory)
-
-    processed = 0
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
-    heatmaps = [None] * 11
+    db = Database(args.directory)
+    store_dir = args.store or os.path.join(args.directory, 'heatmaps')
+    store = HeatmapStore(store_dir, (ITEM_COUNT,) + heatmap_bins)
+    workers = worker_stores(store_dir)
+
+    # the hashes the stores hold are only known to the stores, they are filtered out of the stream here
+    included = set(store.included_hashes()).union(*map(lambda x: x.included_hashes(), workers))
+    table = ItemsExtracted.__table__
+    columns = [table.c.hash, table.c.avg_rank, table.c.match_date, table.c.map]
+    replays = map(lambda x: (x['hash'], get_heatmap_key(x)),
+                  filter(lambda x: x['hash'] not in included, stream(db, table, columns, table.c.map.isnot(None))))
+
+    folded = []
+    # replays in the stores that lost their map since are counted too, so this can be a little off
+    progress = Progress.from_args('generate_average_heatmaps',
+                                  max(count(db, table, table.c.map.isnot(None)) - len(included), 0), args)
+    task = Instrumented(partial(process_with_key, directory=args.directory), args.profile > 0)
 
-    items = list(
-        map(lambda x: x.hash, filter(lambda x: maps[x.map] in standard_maps, db.Session().query(ItemsExtracted))))
-    total = len(items)
     with Pool(args.processes) as p:
-        for h in p.imap_unordered(partial(process, directory=args.directory), items):
+        for (replay_hash, key, h), timings, profile in imap_bounded(p, task, replays, args.processes * 4):
+            progress.update(timings=timings, key=replay_hash, profile=profile, failed=h is None)
+
             if h is None:
                 continue
-            for i in range(11):
-                heatmap = h[i]
-                if heatmaps[i] is None:
-                    heatmaps[i] = heatmap
-                else:
-                    heatmaps[i] += heatmap.astype(np.uint)
-
-            processed += 1
-            sys.stdout.write(f'\r{processed}/{total}')
-            sys.stdout.flush()
-
-    for i in range(11):
+
+            store.add(key, h)
+            folded.append(replay_hash)
+
+            if len(folded) >= args.commit_every:
+                with metrics.timer('store_commit'):
+                    store.commit(folded)
+                folded = []
+
+    with metrics.timer('store_commit'):
+        store.commit(folded)
+    progress.close()
+
+    standard = set(map(lambda x: maps.inverse[x], standard_maps))
+    heatmaps = sum(map(lambda x: x.sum(map=standard), workers), store.sum(map=standard)).astype(np.float64)
+    for i in range(ITEM_COUNT):
         np.save(f'rumble/heatmap{i}', heatmaps[i])
@@ -0,0 +1,74 @@
+import argparse
+import numpy as np
+from sqlalchemy import text
+from database import Database
+from analytics import cached, in_list
+
+# bin edges of the notebook's hist2d calls, the last bin is closed on both sides like in numpy
+BIN_SIZE = 50
+Y_EDGES = np.arange(-6500, 6500, BIN_SIZE)
+X_EDGES = np.arange(-4500, 4500, BIN_SIZE)
+Z_EDGES = np.arange(-500, 2500, BIN_SIZE)
+
+
+def bin_sql(column: str, edges, dialect: str):
+    # -1 for positions outside of the edges. sqlite truncates when casting, which is a floor for the values in range,
+    # other databases round and sqlite may be built without floor()
+    low, high = int(edges[0]), int(edges[-1])
+    offset = f'({column} - {low}) / {float(BIN_SIZE)}'
+    return f'CASE WHEN {column} IS NULL OR {column} < {low} OR {column} > {high} THEN -1 ' \
+           f'WHEN {column} = {high} THEN {len(edges) - 2} ' \
+           f'ELSE CAST({offset if dialect == "sqlite" else f"FLOOR({offset})"} AS INTEGER) END'
+
+
+@cached(['items_extracted', 'item', 'season', 'map'])
+def item_heatmaps(db: Database, items=None, avg_ranks=None, seasons=None, maps=None, standard_only: bool = True):
+    # returns the top-down (y, x) and side (y, z) count grids of item uses, orange positions mirrored onto blue's side.
+    # mirroring, filtering and binning happen in the database, only the non-empty bins are transferred
+    params = {'is_standard': True}
+    dialect = db.engine.dialect.name
+    sql = 'SELECT i.item, i.is_orange, i.use_x, i.use_y, i.use_z FROM item i ' \
+          'JOIN items_extracted p ON i.parent_id = p.id'
+    if standard_only:
+        sql += ' JOIN map m ON p.map = m.id AND m.is_standard = :is_standard'
+    if seasons is not None:
+        sql += ' JOIN season s ON p.match_date >= s.start_date AND p.match_date < s.end_date'
+    sql += ' WHERE p.avg_rank IS NOT NULL AND i.use_x IS NOT NULL' + in_list('i.item', items, params) + \
+        in_list('p.avg_rank', avg_ranks, params) + in_list('p.map', maps, params) + in_list('s.season', seasons, params)
+
+    mirrored = f'SELECT CASE WHEN is_orange THEN -use_x ELSE use_x END AS x, ' \
+               f'CASE WHEN is_orange THEN -use_y ELSE use_y END AS y, use_z AS z FROM ({sql}) u'
+    binned = f'SELECT {bin_sql("y", Y_EDGES, dialect)} AS bin_y, {bin_sql("x", X_EDGES, dialect)} AS bin_x, ' \
+             f'{bin_sql("z", Z_EDGES, dialect)} AS bin_z FROM ({mirrored}) m'
+    rows = db.engine.execute(text(f'SELECT bin_y, bin_x, bin_z, count(*) FROM ({binned}) b WHERE bin_y >= 0 '
+                                  'GROUP BY bin_y, bin_x, bin_z'), **params).fetchall()
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 4)
+
+    topdown = np.zeros((len(Y_EDGES) - 1, len(X_EDGES) - 1), dtype=np.int64)
+    side = np.zeros((len(Y_EDGES) - 1, len(Z_EDGES) - 1), dtype=np.int64)
+
+    has_x = rows[:, 1] >= 0
+    np.add.at(topdown, (rows[has_x, 0], rows[has_x, 1]), rows[has_x, 3])
+    has_z = rows[:, 2] >= 0
+    np.add.at(side, (rows[has_z, 0], rows[has_z, 2]), rows[has_z, 3])
+
+    return topdown, side
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Saves item use heatmaps as rumble/use_heatmap{item}_{view}.npy')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-r', '--ranks', type=int, nargs='+')
+    parser.add_argument('-s', '--seasons', type=int, nargs='+')
+    parser.add_argument('--all-maps', action='store_true', help='Include non-standard maps')
+    args = parser.parse_args()
+
+    db = Database(args.directory)
+
+    for item in range(1, 12):
+        topdown, side = item_heatmaps(db, items=[item], avg_ranks=args.ranks, seasons=args.seasons,
+                                      standard_only=not args.all_maps)
+        np.save(f'rumble/use_heatmap{item}_topdown', topdown)
+        np.save(f'rumble/use_heatmap{item}_side', side)
+
+    db.close()
@@ -0,0 +1,121 @@
+import os
+import json
+import numpy as np
+
+# Count grids keyed by (avg_rank, season, map), each an (item, x, y) uint32 .npy file. Every commit writes new
+# generation files and then swaps the manifest, so a crashed run never leaves half-added replays behind.
+MANIFEST = 'manifest.json'
+
+
+class HeatmapStore(object):
+
+    def __init__(self, directory: str, shape):
+        self.directory = directory
+        self.shape = tuple(shape)
+        os.makedirs(directory, exist_ok=True)
+
+        self.manifest = self.read_manifest()
+        self.pending = {}
+        self._included = None
+        self._hash_files = set()
+
+    def read_manifest(self):
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        if not os.path.exists(manifest_path):
+            return {'generation': 0, 'grids': {}, 'hashes': []}
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    def reload(self):
+        # picks up the commits another process made to this store, only the new hash files are read
+        self.manifest = self.read_manifest()
+
+    @staticmethod
+    def key_name(key):
+        return '_'.join(map(lambda x: 'none' if x is None else str(x), key))
+
+    @staticmethod
+    def parse_key(name: str):
+        return tuple(map(lambda x: None if x == 'none' else int(x), name.split('_')))
+
+    def keys(self):
+        return list(map(self.parse_key, self.manifest['grids'].keys()))
+
+    def included_hashes(self):
+        if self._included is None:
+            self._included = set()
+        for file in filter(lambda x: x not in self._hash_files, self.manifest['hashes']):
+            with open(os.path.join(self.directory, file), 'r') as f:
+                self._included.update(f.read().split())
+            self._hash_files.add(file)
+        return self._included
+
+    def load(self, key, mmap: bool = True):
+        file = self.manifest['grids'].get(self.key_name(key), None)
+        if file is None:
+            return None
+        return np.load(os.path.join(self.directory, file), mmap_mode='r' if mmap else None)
+
+    def add(self, key, heatmap):
+        grid = self.pending.get(key, None)
+        if grid is None:
+            grid = self.load(key, mmap=False)
+            grid = np.zeros(self.shape, dtype=np.uint32) if grid is None else grid
+            self.pending[key] = grid
+        grid += np.asarray(heatmap).astype(np.uint32)
+
+    def commit(self, hashes):
+        hashes = list(hashes)
+        if len(self.pending) == 0 and len(hashes) == 0:
+            return
+
+        generation = self.manifest['generation'] + 1
+        grids = dict(self.manifest['grids'])
+        replaced = []
+
+        for key, grid in self.pending.items():
+            name = self.key_name(key)
+            file = f'{name}.{generation}.npy'
+            np.save(os.path.join(self.directory, file), grid)
+            if name in grids:
+                replaced.append(grids[name])
+            grids[name] = file
+
+        hash_files = list(self.manifest['hashes'])
+        if len(hashes) > 0:
+            hash_file = f'hashes.{generation}.txt'
+            with open(os.path.join(self.directory, hash_file), 'w') as f:
+                f.write('\n'.join(hashes))
+            hash_files.append(hash_file)
+
+        manifest = {'generation': generation, 'grids': grids, 'hashes': hash_files}
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        with open(f'{manifest_path}.part', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(f'{manifest_path}.part', manifest_path)
+
+        self.manifest = manifest
+        self.pending = {}
+        if self._included is not None and len(hashes) > 0:
+            self._included.update(hashes)
+            self._hash_files.add(hash_file)
+
+        for file in replaced:
+            os.remove(os.path.join(self.directory, file))
+
+    def sum(self, items=None, avg_rank=None, season=None, map=None):
+        # every filter is either None for all values, a single value or a collection of values
+
+        def matches(value, selected):
+            if selected is None:
+                return True
+            if isinstance(selected, (set, list, tuple, frozenset, range)):
+                return value in selected
+            return value == selected
+
+        total = np.zeros(self.shape, dtype=np.uint64)
+        for key in self.keys():
+            if matches(key[0], avg_rank) and matches(key[1], season) and matches(key[2], map):
+                total += self.load(key)
+
+        return total if items is None else total[items]
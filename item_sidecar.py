@@ -0,0 +1,146 @@
+import os
+import json
+import logging
+import argparse
+import numpy as np
+from functools import partial
+from multiprocessing import Pool
+import metrics
+from metrics import Instrumented, Progress
+from artifact_store import ArtifactStore
+from database import Database
+from frame_store import load_frames
+from replay_summary import load_summary
+
+log = logging.getLogger(__name__)
+
+# the game time at the get and use frame and the car position at the use frame of every rumble item, in the order of
+# summary['rumble_items']. download_replays.py writes it while the parsed frames are still in memory so that item
+# extraction never has to load frames
+
+
+def get_frame_columns(summary):
+    columns = [('game', 'time')]
+    for player in summary['players']:
+        columns += [(player['name'], 'pos_x'), (player['name'], 'pos_y'), (player['name'], 'pos_z')]
+    return columns
+
+
+def get_item_uses(summary, frames):
+    # None where the item was not used or the frame is missing from the frames
+    names = dict(map(lambda x: (x['id'], x['name']), summary['players']))
+    rumble_items = summary['rumble_items']
+    count = len(rumble_items)
+
+    player_ids = np.array(list(map(lambda x: x['player_id'], rumble_items)), dtype=object)
+    frame_get = np.array(list(map(lambda x: x['frame_get'], rumble_items)), dtype=np.int64)
+    frame_use = np.array(list(map(lambda x: x['frame_use'], rumble_items)), dtype=np.int64)
+
+    get_rows = frames.index.get_indexer(frame_get)
+    use_rows = frames.index.get_indexer(frame_use)
+    use_rows[frame_use < 0] = -1
+
+    time = frames[('game', 'time')].values.astype(np.float64)
+    time_get = np.full(count, None, dtype=object)
+    time_use = np.full(count, None, dtype=object)
+    time_get[get_rows >= 0] = time[get_rows[get_rows >= 0]].tolist()
+    time_use[use_rows >= 0] = time[use_rows[use_rows >= 0]].tolist()
+
+    positions = np.full((count, 3), None, dtype=object)
+    for player_id in np.unique(player_ids[use_rows >= 0]):
+        mask = (player_ids == player_id) & (use_rows >= 0)
+        columns = frames[names[player_id]][['pos_x', 'pos_y', 'pos_z']].values
+        positions[mask] = columns[use_rows[mask]].tolist()
+
+    return {
+        'player_id': player_ids.tolist(),
+        'frame_get': frame_get.tolist(),
+        'frame_use': frame_use.tolist(),
+        'time_get': time_get.tolist(),
+        'time_use': time_use.tolist(),
+        'use_x': positions[:, 0].tolist(),
+        'use_y': positions[:, 1].tolist(),
+        'use_z': positions[:, 2].tolist()
+    }
+
+
+def write_item_uses(directory: str, replay_hash: str, summary, frames):
+    # returns the manifest entry of the sidecar
+    store = ArtifactStore(directory)
+    file_path = store.target(replay_hash, 'items')
+    with open(f'{file_path}.part', 'w', encoding='utf-8') as f:
+        json.dump(get_item_uses(summary, frames), f, separators=(',', ':'))
+    os.replace(f'{file_path}.part', file_path)
+    return store.register(replay_hash, 'items', file_path)
+
+
+def read_item_uses(directory: str, replay_hash: str, summary):
+    # None when there is no sidecar or it does not belong to the rumble items of the summary
+    file_path = ArtifactStore(directory).locate(replay_hash, 'items')
+    if file_path is None:
+        return None
+
+    with metrics.timer('items_load'), open(file_path, 'r', encoding='utf-8') as f:
+        uses = json.load(f)
+
+    rumble_items = summary['rumble_items']
+    for column in ['player_id', 'frame_get', 'frame_use']:
+        if uses.get(column) != list(map(lambda x: x[column], rumble_items)):
+            return None
+    return uses
+
+
+def load_item_uses(directory: str, replay_hash: str, summary):
+    uses = read_item_uses(directory, replay_hash, summary)
+    if uses is not None:
+        return uses
+
+    # replays parsed before the sidecar existed
+    frames = load_frames(directory, replay_hash, get_frame_columns(summary))
+    with metrics.timer('items_from_frames'):
+        return get_item_uses(summary, frames)
+
+
+def build(replay_hash: str, directory: str):
+    # returns the hash and the manifest entry of the written sidecar or None if it existed already, None when the
+    # frames failed to load
+    try:
+        store = ArtifactStore(directory)
+        if store.exists(replay_hash, 'items'):
+            return replay_hash, None
+
+        summary = load_summary(directory, replay_hash)
+        return replay_hash, write_item_uses(directory, replay_hash, summary,
+                                            load_frames(directory, replay_hash, get_frame_columns(summary)))
+    except Exception:
+        log.exception(f'Failed to write the item sidecar of {replay_hash}')
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the item sidecar for every replay in frames/ or df/')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    db = Database(args.directory)
+    manifest = db.artifact_writer()
+
+    store = ArtifactStore(args.directory)
+    hashes = sorted(set(store.hashes('frames')).union(store.hashes('df')))
+    progress = Progress.from_args('item_sidecar', len(hashes), args)
+    fn = Instrumented(partial(build, directory=args.directory), args.profile > 0)
+
+    with Pool(args.processes) as p:
+        for result, timings, profile in p.imap_unordered(fn, hashes, chunksize=100):
+            if result is not None and result[1] is not None:
+                # the hash and the entry, None when the sidecar existed already
+                manifest.add(result[1])
+            progress.update(timings=timings, key=result and result[0], profile=profile, failed=result is None)
+    progress.close()
+
+    manifest.close()
+    db.close()
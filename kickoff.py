@@ -0,0 +1,139 @@
+import argparse
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from database import Database
+from analytics import in_list
+
+KICKOFF_SIZE = 6
+COLUMNS = ['parent_id', 'frame', 'o', 'b', 'l']
+
+
+def get_parent_ranges(db: Database, avg_ranks=None, maps=None, seasons=None, chunk_size: int = 20000):
+    # splits the matching replays into id ranges so that a kickoff never spans two chunks
+    params = {}
+    ids = db.engine.execute(text(f'SELECT p.id FROM items_extracted p{filters(avg_ranks, maps, seasons, params)} '
+                                 'ORDER BY p.id'), **params).fetchall()
+    ids = np.array(list(map(lambda x: x[0], ids)), dtype=np.int64)
+
+    for i in range(0, len(ids), chunk_size):
+        yield ids[i] - 1, ids[min(i + chunk_size, len(ids)) - 1]
+
+
+def filters(avg_ranks, maps, seasons, params: dict):
+    sql = ''
+    if seasons is not None:
+        sql += ' JOIN season s ON p.match_date >= s.start_date AND p.match_date < s.end_date'
+    return sql + ' WHERE 1 = 1' + in_list('p.avg_rank', avg_ranks, params) + in_list('p.map', maps, params) + \
+        in_list('s.season', seasons, params)
+
+
+def read_kickoff_items(db: Database, avg_ranks=None, maps=None, seasons=None, chunk_size: int = 20000):
+    # yields (parent_id, frame_get, item, is_orange) arrays sorted by parent_id and frame_get, chunk_size replays each
+    for low, high in get_parent_ranges(db, avg_ranks, maps, seasons, chunk_size):
+        params = {'low': int(low), 'high': int(high), 'is_kickoff': True}
+        result = db.engine.execute(text(
+            'SELECT i.parent_id, i.frame_get, i.item, i.is_orange FROM item i '
+            f'JOIN items_extracted p ON i.parent_id = p.id{filters(avg_ranks, maps, seasons, params)} '
+            'AND i.is_kickoff = :is_kickoff AND i.parent_id > :low AND i.parent_id <= :high ORDER BY i.parent_id, i.frame_get'),
+            **params)
+        rows = np.array(result.fetchall(), dtype=np.int64).reshape(-1, 4)
+
+        if len(rows) > 0:
+            yield rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3].astype(bool)
+
+
+def get_kickoff_groups(parent_id, frame_get):
+    # a kickoff starts on a new replay or when an item is picked up more than a frame after the kickoff's first pickup
+    breaks = np.ones(len(frame_get), dtype=bool)
+    breaks[1:] = (parent_id[1:] != parent_id[:-1]) | (np.diff(frame_get) > 1)
+    starts = np.flatnonzero(breaks)
+    ends = np.append(starts[1:], len(frame_get))
+
+    # runs of pickups one frame apart need the first pickup of each kickoff, those are rare and walked one by one
+    long = np.flatnonzero(frame_get[ends - 1] - frame_get[starts] > 1)
+    for start, end in zip(starts[long], ends[long]):
+        group_start = frame_get[start]
+        for i in range(start + 1, end):
+            if frame_get[i] - group_start > 1:
+                breaks[i] = True
+                group_start = frame_get[i]
+
+    return np.cumsum(breaks) - 1
+
+
+def max_duplicates(group, item, team=None):
+    # the largest number of equal items per group (and team), counted on one combined integer key
+    item = item - item.min()
+    width = item.max() + 1
+    slots = 1 if team is None else 2
+    key = (group if team is None else group * 2 + team) * width + item
+    counts = np.bincount(key, minlength=(group[-1] + 1) * slots * width)
+    return counts.reshape(group[-1] + 1, slots, width).max(axis=2)
+
+
+def analyze_chunk(parent_id, frame_get, item, is_orange):
+    if len(parent_id) == 0:
+        return pd.DataFrame(columns=COLUMNS)
+
+    group = get_kickoff_groups(parent_id, frame_get)
+    sizes = np.bincount(group)
+
+    # only full lobbies where every player got an item
+    full = sizes[group] == KICKOFF_SIZE
+    group, item, is_orange = group[full], item[full], is_orange[full]
+    if len(group) == 0:
+        return pd.DataFrame(columns=COLUMNS)
+
+    # renumber the remaining groups from 0
+    first = np.r_[True, group[1:] != group[:-1]]
+    group = np.cumsum(first) - 1
+    first = np.flatnonzero(first)
+    team = max_duplicates(group, item, is_orange.astype(np.int64))
+    lobby = max_duplicates(group, item)
+
+    return pd.DataFrame({
+        'parent_id': parent_id[full][first],
+        'frame': frame_get[full][first],
+        'o': pd.array(team[:, 1], dtype='UInt8'),
+        'b': pd.array(team[:, 0], dtype='UInt8'),
+        'l': pd.array(lobby[:, 0], dtype='UInt8')
+    })
+
+
+def analyze(db: Database, avg_ranks=None, maps=None, seasons=None, chunk_size: int = 20000):
+    # per kickoff the most duplicated item count for orange (o), blue (b) and the whole lobby (l)
+    chunks = list(map(lambda x: analyze_chunk(*x), read_kickoff_items(db, avg_ranks, maps, seasons, chunk_size)))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def lobby_distribution(kickoffs: pd.DataFrame):
+    return kickoffs['l'].value_counts().reindex(range(1, KICKOFF_SIZE + 1), fill_value=0)
+
+
+def team_distribution(kickoffs: pd.DataFrame):
+    return pd.concat([kickoffs['o'], kickoffs['b']], ignore_index=True).value_counts() \
+        .reindex(range(1, KICKOFF_SIZE // 2 + 1), fill_value=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distribution of duplicate items on kickoffs')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-r', '--ranks', type=int, nargs='+')
+    parser.add_argument('-m', '--maps', type=int, nargs='+')
+    parser.add_argument('-s', '--seasons', type=int, nargs='+')
+    parser.add_argument('--chunk-size', type=int, default=20000, help='Replays read at once')
+    args = parser.parse_args()
+
+    db = Database(args.directory)
+    kickoffs = analyze(db, args.ranks, args.maps, args.seasons, args.chunk_size)
+
+    print(f'{len(kickoffs)} kickoffs')
+    print('Lobby')
+    print(lobby_distribution(kickoffs) / max(len(kickoffs), 1))
+    print('Team')
+    print(team_distribution(kickoffs) / max(len(kickoffs) * 2, 1))
+
+    db.close()
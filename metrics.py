@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import heapq
+import marshal
+import cProfile
+import threading
+import collections
+import numpy as np
+from contextlib import contextmanager
+
+SAMPLES = 10000
+WINDOW = 60.0
+
+# timings recorded in this process since the last collect(), workers send theirs back with their results. Bounded
+# so that callers without a Progress collecting them do not grow it forever
+_timings = collections.defaultdict(lambda: collections.deque(maxlen=SAMPLES))
+_lock = threading.Lock()
+
+
+def _reset():
+    # a forked worker starts with the samples its parent had not collected yet, it would send them back as its own.
+    # The lock is replaced too as another thread of the parent may have held it during the fork
+    global _timings, _lock
+    _timings = collections.defaultdict(lambda: collections.deque(maxlen=SAMPLES))
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset)
+
+
+@contextmanager
+def timer(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def record(stage: str, seconds: float):
+    with _lock:
+        _timings[stage].append(seconds)
+
+
+def collect():
+    with _lock:
+        timings = dict(map(lambda x: (x[0], list(x[1])), _timings.items()))
+        _timings.clear()
+    return timings
+
+
+class Instrumented(object):
+    # wraps a pool task so that it returns (result, timings, profile), the profile is the marshallable stats of a
+    # cProfile run when profiling is on. Has to be picklable, so no lambdas or closures as fn
+
+    def __init__(self, fn, profile: bool = False):
+        self.fn = fn
+        self.profile = profile
+
+    def __call__(self, *args, **kwargs):
+        profiler = cProfile.Profile() if self.profile else None
+        start = time.perf_counter()
+
+        if profiler is not None:
+            profiler.enable()
+        try:
+            result = self.fn(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record('total', time.perf_counter() - start)
+
+        stats = None
+        if profiler is not None:
+            profiler.create_stats()
+            stats = profiler.stats
+
+        return result, collect(), stats
+
+
+class Progress(object):
+    # replaces the \r{n}/{total} counters: rolling throughput, ETA and per stage latency percentiles on the console,
+    # the same as json lines in the metrics file and the profiles of the slowest replays
+
+    def __init__(self, name: str, total: int, metrics_file: str = None, profile_slowest: int = 0,
+                 profile_dir: str = 'profiles', interval: float = 5.0):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.window = collections.deque()
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=SAMPLES))
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.metrics_file = open(metrics_file, 'a', encoding='utf-8') if metrics_file is not None else None
+        self.profile_slowest = profile_slowest
+        self.profile_dir = profile_dir
+        self.profiles = []
+        self.interval = interval
+        self.last_report = 0.0
+
+    @staticmethod
+    def from_args(name: str, total: int, args):
+        return Progress(name, total, args.metrics, args.profile, args.profile_dir)
+
+    def add_timings(self, timings):
+        for stage, values in (timings or {}).items():
+            self.samples[stage].extend(values)
+            self.totals[stage] += sum(values)
+            self.counts[stage] += len(values)
+
+    def update(self, count: int = 1, timings=None, key: str = None, profile=None, failed: bool = False):
+        self.done += count
+        self.failed += 1 if failed else 0
+        self.add_timings(timings)
+        self.add_timings(collect())
+
+        now = time.monotonic()
+        self.window.append((now, count))
+        while now - self.window[0][0] > WINDOW:
+            self.window.popleft()
+
+        if profile is not None and self.profile_slowest > 0:
+            seconds = sum((timings or {}).get('total', [0.0]))
+            entry = (seconds, self.done, key or str(self.done), profile)
+            if len(self.profiles) < self.profile_slowest:
+                heapq.heappush(self.profiles, entry)
+            elif seconds > self.profiles[0][0]:
+                heapq.heapreplace(self.profiles, entry)
+
+        self.render()
+        if self.metrics_file is not None and now - self.last_report >= self.interval:
+            self.write_metrics()
+            self.last_report = now
+
+    def rate(self):
+        # replays per second over the last WINDOW seconds, or since the start for shorter runs
+        now = time.monotonic()
+        elapsed = min(now - self.started, WINDOW)
+        return sum(map(lambda x: x[1], filter(lambda x: now - x[0] <= WINDOW, self.window))) / elapsed \
+            if elapsed > 0 else 0.0
+
+    def eta(self):
+        rate = self.rate()
+        return (self.total - self.done) / rate if rate > 0 and self.total is not None else None
+
+    def stages(self):
+        stages = {}
+        for stage, samples in self.samples.items():
+            p50, p95, p99 = np.percentile(np.fromiter(samples, dtype=np.float64), [50, 95, 99]) \
+                if len(samples) > 0 else (0.0, 0.0, 0.0)
+            stages[stage] = {
+                'count': self.counts[stage],
+                'seconds': self.totals[stage],
+                'p50_ms': p50 * 1000,
+                'p95_ms': p95 * 1000,
+                'p99_ms': p99 * 1000
+            }
+        return stages
+
+    def render(self):
+        eta = self.eta()
+        eta = '?' if eta is None else time.strftime('%H:%M:%S', time.gmtime(eta))
+        slowest = sorted(self.totals.items(), key=lambda x: -x[1])
+        slowest = ' '.join(map(lambda x: f'{x[0]} {self.totals[x[0]] / max(self.counts[x[0]], 1) * 1000:.0f}ms',
+                               filter(lambda x: x[0] != 'total', slowest[:4])))
+        done = self.done if self.total is None else f'{self.done}/{self.total}'
+        sys.stdout.write(f'\r{done} {self.rate():.1f}/s ETA {eta} {slowest}'.ljust(100))
+        sys.stdout.flush()
+
+    def write_metrics(self):
+        self.metrics_file.write(json.dumps({
+            'time': time.time(),
+            'name': self.name,
+            'done': self.done,
+            'failed': self.failed,
+            'total': self.total,
+            'elapsed': time.monotonic() - self.started,
+            'rate': self.rate(),
+            'eta': self.eta(),
+            'stages': self.stages()
+        }) + '\n')
+        self.metrics_file.flush()
+
+    def close(self):
+        self.add_timings(collect())
+        self.render()
+        sys.stdout.write('\n')
+
+        if self.metrics_file is not None:
+            self.write_metrics()
+            self.metrics_file.close()
+
+        # the stats dicts are what cProfile.dump_stats writes, pstats.Stats and snakeviz read them
+        if len(self.profiles) > 0:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            for _, _, key, stats in self.profiles:
+                with open(os.path.join(self.profile_dir, f'{self.name}-{key}.prof'), 'wb') as f:
+                    marshal.dump(stats, f)
+            print(f'Wrote the profiles of the {len(self.profiles)} slowest to {self.profile_dir}')
+
+
+def add_arguments(parser):
+    parser.add_argument('--metrics', type=str, default=None, help='Append progress and stage timings as json lines')
+    parser.add_argument('--profile', type=int, default=0, help='Keep cProfile output of the N slowest replays')
+    parser.add_argument('--profile-dir', type=str, default='profiles')
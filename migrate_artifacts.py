@@ -0,0 +1,94 @@
+import os
+import logging
+import argparse
+from functools import partial
+from multiprocessing import Pool
+from artifact_store import ArtifactStore, KINDS
+from database import Database
+from metrics import Instrumented, Progress
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+def get_legacy_files(directory: str, kind: str):
+    # the flat <kind dir>/<hash><extension> files download_replays.py wrote before the store
+    root = os.path.join(directory, KINDS[kind][0])
+    if not os.path.isdir(root):
+        return []
+
+    extension = KINDS[kind][1]
+    return list(map(lambda x: (x.name[:-len(extension)], kind),
+                    filter(lambda x: x.is_file() and x.name.endswith(extension), os.scandir(root))))
+
+
+def migrate(task, directory: str, compress: bool, level: int):
+    replay_hash, kind = task
+    store = ArtifactStore(directory, compress, level)
+    try:
+        return store.put(replay_hash, kind, store.legacy_path(replay_hash, kind))
+    except Exception as e:
+        log.error(f'Failed to migrate the {kind} of {replay_hash}', exc_info=e)
+        return None
+
+
+def index(task, directory: str):
+    replay_hash, kind = task
+    try:
+        return ArtifactStore(directory).register(replay_hash, kind)
+    except Exception as e:
+        log.error(f'Failed to index the {kind} of {replay_hash}', exc_info=e)
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Moves the flat replays/, stats/, frames/, summary/, df/ and logs/ '
+                                                 'directories into the sharded artifact store and records every '
+                                                 'artifact in the manifest')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('-k', '--kinds', nargs='+', choices=list(KINDS.keys()), default=list(KINDS.keys()))
+    parser.add_argument('--no-compress', action='store_true', help='Keep replays and protos uncompressed')
+    parser.add_argument('--level', type=int, default=3, help='zstd compression level')
+    parser.add_argument('--index', action='store_true',
+                        help='Also record artifacts that are on disk but missing from the manifest')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    db = Database(args.directory)
+    manifest = db.artifact_writer()
+
+    tasks = [task for kind in args.kinds for task in get_legacy_files(args.directory, kind)]
+    log.info(f'Migrating {len(tasks)} files')
+
+    progress = Progress.from_args('migrate_artifacts', len(tasks), args)
+    fn = Instrumented(partial(migrate, directory=args.directory, compress=not args.no_compress, level=args.level),
+                      args.profile > 0)
+
+    with Pool(args.processes) as p:
+        for entry, timings, profile in p.imap_unordered(fn, tasks, chunksize=10):
+            if entry is not None:
+                manifest.add(entry)
+            progress.update(timings=timings, profile=profile, failed=entry is None)
+    progress.close()
+
+    if args.index:
+        manifest.flush()
+        store = ArtifactStore(args.directory)
+        tasks = [(replay_hash, kind) for kind in args.kinds
+                 for replay_hash in set(store.hashes(kind)) - db.get_artifact_hashes(kind)]
+        log.info(f'Indexing {len(tasks)} artifacts missing from the manifest')
+
+        progress = Progress.from_args('index_artifacts', len(tasks), args)
+        with Pool(args.processes) as p:
+            for entry, timings, profile in p.imap_unordered(Instrumented(partial(index, directory=args.directory)),
+                                                            tasks, chunksize=10):
+                if entry is not None:
+                    manifest.add(entry)
+                progress.update(timings=timings, profile=profile, failed=entry is None)
+        progress.close()
+
+    manifest.close()
+    db.close()
@@ -0,0 +1,19 @@
+import logging
+import argparse
+from database import Database
+
+# brings an existing database up to date. Tables the schema added since are created when the database is opened and
+# the rollup tables are built right away if the database already holds items or goals, rebuild_rollups.py builds them
+# again from scratch when they are off
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Brings the indexes of an existing replays.sqlite in line with the '
+                                                 'schema')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    db = Database(args.directory)
+    db.sync_indexes()
+    db.close()
@@ -0,0 +1,14 @@
+import argparse
+from database import Database, rebuild_rollups
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recomputes the item and goal rollup tables from scratch')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    args = parser.parse_args()
+
+    db = Database(args.directory)
+
+    with db.engine.begin() as connection:
+        rebuild_rollups(connection)
+
+    db.close()
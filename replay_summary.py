@@ -0,0 +1,103 @@
+import os
+import json
+import logging
+import argparse
+from functools import partial
+from multiprocessing import Pool
+import metrics
+from metrics import Instrumented, Progress
+from artifact_store import ArtifactStore
+from database import Database
+from carball.analysis.utils.proto_manager import ProtobufManager
+
+log = logging.getLogger(__name__)
+
+
+def summarize(proto):
+    return {
+        'map': proto.game_metadata.map,
+        'score': [proto.game_metadata.score.team_0_score, proto.game_metadata.score.team_1_score],
+        'players': [{
+            'id': player.id.id,
+            'name': player.name,
+            'is_orange': player.is_orange
+        } for player in proto.players],
+        'goals': [{
+            'player_id': goal.player_id.id,
+            'frame': goal.frame_number,
+            'pre_items': goal.extra_mode_info.pre_items,
+            'scored_with_item': goal.extra_mode_info.scored_with_item,
+            'used_item': goal.extra_mode_info.used_item
+        } for goal in proto.game_metadata.goals],
+        'kickoffs': [kickoff.start_frame_number for kickoff in proto.game_stats.kickoffs],
+        'rumble_items': [{
+            'player_id': event.player_id.id,
+            'item': event.item,
+            'frame_get': event.frame_number_get,
+            'frame_use': event.frame_number_use
+        } for event in proto.game_stats.rumble_items]
+    }
+
+
+def write_summary(directory: str, replay_hash: str, proto):
+    # returns the manifest entry of the summary
+    store = ArtifactStore(directory)
+    file_path = store.target(replay_hash, 'summary')
+    with open(f'{file_path}.part', 'w', encoding='utf-8') as f:
+        json.dump(summarize(proto), f, separators=(',', ':'))
+    os.replace(f'{file_path}.part', file_path)
+    return store.register(replay_hash, 'summary', file_path)
+
+
+def load_summary(directory: str, replay_hash: str):
+    store = ArtifactStore(directory)
+    file_path = store.locate(replay_hash, 'summary')
+    if file_path is not None:
+        with metrics.timer('summary_load'), open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    with metrics.timer('proto_load'), store.open(replay_hash, 'proto') as f:
+        return summarize(ProtobufManager.read_proto_out_from_file(f))
+
+
+def build(replay_hash: str, directory: str):
+    # returns the hash and the manifest entry of the written summary or None if it existed already, None when the
+    # proto failed to load
+    try:
+        store = ArtifactStore(directory)
+        if store.exists(replay_hash, 'summary'):
+            return replay_hash, None
+
+        with store.open(replay_hash, 'proto') as f:
+            return replay_hash, write_summary(directory, replay_hash, ProtobufManager.read_proto_out_from_file(f))
+    except Exception:
+        log.exception(f'Failed to summarize {replay_hash}')
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the summary sidecar for every replay in stats/')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    db = Database(args.directory)
+    manifest = db.artifact_writer()
+
+    hashes = list(ArtifactStore(args.directory).hashes('proto'))
+    progress = Progress.from_args('replay_summary', len(hashes), args)
+    fn = Instrumented(partial(build, directory=args.directory), args.profile > 0)
+
+    with Pool(args.processes) as p:
+        for result, timings, profile in p.imap_unordered(fn, hashes, chunksize=100):
+            if result is not None and result[1] is not None:
+                # the hash and the entry, None when the summary existed already
+                manifest.add(result[1])
+            progress.update(timings=timings, key=result and result[0], profile=profile, failed=result is None)
+    progress.close()
+
+    manifest.close()
+    db.close()
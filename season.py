@@ -0,0 +1,19 @@
+from datetime import datetime
+
+seasons = {
+    9: (datetime(2018, 9, 24), datetime(2019, 2, 19)),
+    10: (datetime(2019, 2, 19), datetime(2019, 5, 13)),
+    11: (datetime(2019, 5, 13), datetime(2019, 8, 27)),
+    12: (datetime(2019, 8, 27), datetime(2019, 12, 4))
+}
+
+
+def get_season(match_date: datetime):
+    if match_date is None:
+        return None
+
+    for season, (start, end) in seasons.items():
+        if start <= match_date < end:
+            return season
+
+    return None
@@ -0,0 +1,169 @@
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+POLL_INTERVAL = 0.1
+
+log = logging.getLogger(__name__)
+
+
+def get_rss():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if resource is not None:
+        # peak rss in KiB on linux, close enough to tell a bloated worker apart
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return 0
+
+
+def work(fn, connection, max_tasks: int, max_rss: int):
+    for i in range(max_tasks):
+        task = connection.recv()
+        if task is None:
+            break
+
+        try:
+            ok, value = True, fn(task)
+        except Exception as e:
+            ok, value = False, f'{type(e).__name__}: {e}'
+
+        # tell the supervisor when this was the last task so it doesn't hand us another one
+        retiring = i == max_tasks - 1 or (max_rss is not None and get_rss() > max_rss)
+        connection.send((ok, value, retiring))
+
+        if retiring:
+            break
+
+    connection.close()
+
+
+class Worker(object):
+
+    def __init__(self, context, fn, max_tasks: int, max_rss: int):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=work, args=(fn, child_connection, max_tasks, max_rss), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.task = None
+        self.deadline = None
+        self.retiring = False
+
+    def assign(self, task, timeout: float):
+        self.task = task
+        self.deadline = time.monotonic() + timeout
+        self.connection.send(task)
+
+    def receive(self):
+        ok, value, self.retiring = self.connection.recv()
+        task = self.task
+        self.task = None
+        return (task, value, None) if ok else (task, None, value)
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class Supervisor(object):
+    _DONE = object()
+
+    def __init__(self, fn, process_count: int = 1, timeout: float = 600, max_tasks: int = 100,
+                 max_rss: int = None):
+        self.fn = fn
+        self.process_count = process_count
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.context = multiprocessing.get_context()
+
+    def spawn(self):
+        return Worker(self.context, self.fn, self.max_tasks, self.max_rss)
+
+    def imap_unordered(self, tasks):
+        # yields (task, result, error) tuples in completion order, error is None when fn succeeded
+        pending = queue.Queue(maxsize=self.process_count)
+
+        def feed():
+            try:
+                for task in tasks:
+                    pending.put(task)
+            finally:
+                pending.put(self._DONE)
+
+        threading.Thread(target=feed, name='supervisor-feeder', daemon=True).start()
+
+        workers = [self.spawn() for _ in range(self.process_count)]
+        exhausted = False
+
+        try:
+            while True:
+                for worker in workers:
+                    if exhausted:
+                        break
+                    if worker.task is not None or worker.retiring or not worker.process.is_alive():
+                        continue
+                    try:
+                        task = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if task is self._DONE:
+                        exhausted = True
+                    else:
+                        worker.assign(task, self.timeout)
+
+                busy = [worker for worker in workers if worker.task is not None]
+                if exhausted and len(busy) == 0:
+                    break
+
+                timeout = POLL_INTERVAL
+                if len(busy) > 0:
+                    timeout = max(0.0, min(timeout, min(worker.deadline for worker in busy) - time.monotonic()))
+                wait([worker.connection for worker in busy] + [worker.process.sentinel for worker in workers],
+                     timeout)
+
+                for i, worker in enumerate(workers):
+                    if worker.task is not None and worker.connection.poll():
+                        try:
+                            yield worker.receive()
+                            continue
+                        except EOFError:
+                            pass
+
+                    if worker.task is not None and time.monotonic() > worker.deadline:
+                        log.error(f'Killing worker {worker.process.pid}, {worker.task} timed out')
+                        task = worker.task
+                        worker.kill()
+                        workers[i] = self.spawn()
+                        yield task, None, f'Timed out after {self.timeout}s'
+                    elif worker.retiring or not worker.process.is_alive():
+                        task = worker.task
+                        worker.stop()
+                        workers[i] = self.spawn()
+                        if task is not None:
+                            yield task, None, f'Worker exited with code {worker.process.exitcode}'
+        finally:
+            for worker in workers:
+                worker.stop()
@@ -0,0 +1,48 @@
+import os
+import pytest
+from database import Database
+
+
+@pytest.fixture(autouse=True)
+def no_database_url(monkeypatch):
+    monkeypatch.delenv('RL_STATS_DATABASE_URL', raising=False)
+
+
+def open_database(directory, url=None):
+    db = Database(str(directory), url)
+    url = str(db.engine.url)
+    db.close()
+    return url
+
+
+def test_defaults_to_the_directory(tmp_path):
+    assert open_database(tmp_path) == f'sqlite:///{tmp_path}/replays.sqlite'
+    assert os.path.exists(tmp_path / 'replays.sqlite')
+
+
+def test_honors_the_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv('RL_STATS_DATABASE_URL', f'sqlite:///{tmp_path}/other.sqlite')
+
+    assert open_database(tmp_path) == f'sqlite:///{tmp_path}/other.sqlite'
+    assert os.path.exists(tmp_path / 'other.sqlite')
+    assert not os.path.exists(tmp_path / 'replays.sqlite')
+
+
+def test_url_overrides_the_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv('RL_STATS_DATABASE_URL', f'sqlite:///{tmp_path}/other.sqlite')
+
+    assert open_database(tmp_path, f'sqlite:///{tmp_path}/given.sqlite') == f'sqlite:///{tmp_path}/given.sqlite'
+    assert os.path.exists(tmp_path / 'given.sqlite')
+    assert not os.path.exists(tmp_path / 'other.sqlite')
+
+
+def test_cache_stays_in_the_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv('RL_STATS_DATABASE_URL', f'sqlite:///{tmp_path}/other.sqlite')
+    os.makedirs(tmp_path / 'replays')
+
+    db = Database(str(tmp_path / 'replays'))
+    try:
+        assert db.cache_dir == os.path.join(str(tmp_path / 'replays'), 'cache')
+    finally:
+        db.close()
+
@@ -0,0 +1,144 @@
+import threading
+import time
+import http.server
+import pytest
+import requests
+import download_replays
+from download_replays import ReplayDownloader
+from artifact_store import ArtifactStore
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    # /flaky/<n> fails with a 503 n times before it succeeds, /missing is a 404 and /slow takes a moment so that
+    # downloads overlap. Every other path answers with its own name
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.calls[self.path] = server.calls.get(self.path, 0) + 1
+            calls = server.calls[self.path]
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+        try:
+            if self.path.startswith('/slow'):
+                time.sleep(0.05)
+
+            if self.path.startswith('/flaky') and calls <= int(self.path.split('/')[2]):
+                self.respond(503, b'')
+            elif self.path == '/missing':
+                self.respond(404, b'')
+            else:
+                self.respond(200, self.path.encode() * 100)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def respond(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.calls = {}
+    server.in_flight = 0
+    server.max_in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # the backoff delays instead of actually waiting them out
+    delays = []
+    monkeypatch.setattr(download_replays.time, 'sleep', delays.append)
+    return delays
+
+
+def make_downloader(tmp_path, server, **kwargs):
+    return ReplayDownloader(str(tmp_path), f'http://127.0.0.1:{server.server_port}', **kwargs)
+
+
+def read_replay(tmp_path, replay_hash: str):
+    with ArtifactStore(str(tmp_path)).open(replay_hash, 'replay') as f:
+        return f.read()
+
+
+def test_retries_with_exponential_backoff(tmp_path, server, sleeps):
+    downloader = make_downloader(tmp_path, server, retries=3, backoff=0.5)
+    try:
+        downloader.download({'hash': 'A', 'download': '/flaky/2'})
+    finally:
+        downloader.close()
+
+    assert server.calls['/flaky/2'] == 3
+    assert sleeps == [0.5, 1.0]
+    assert read_replay(tmp_path, 'A') == b'/flaky/2' * 100
+
+
+def test_gives_up_after_the_retries(tmp_path, server, sleeps):
+    downloader = make_downloader(tmp_path, server, retries=2, backoff=0.5)
+    try:
+        with pytest.raises(requests.HTTPError):
+            downloader.download({'hash': 'A', 'download': '/flaky/5'})
+    finally:
+        downloader.close()
+
+    assert server.calls['/flaky/5'] == 3
+    assert sleeps == [0.5, 1.0]
+    assert not ArtifactStore(str(tmp_path)).exists('A', 'replay')
+
+
+def test_does_not_retry_client_errors(tmp_path, server, sleeps):
+    downloader = make_downloader(tmp_path, server, retries=3)
+    try:
+        with pytest.raises(requests.HTTPError):
+            downloader.download({'hash': 'A', 'download': '/missing'})
+    finally:
+        downloader.close()
+
+    assert server.calls['/missing'] == 1
+    assert sleeps == []
+
+
+def test_skips_replays_that_exist(tmp_path, server):
+    downloader = make_downloader(tmp_path, server, known={'B'})
+    try:
+        downloader.download({'hash': 'A', 'download': '/a'})
+        downloader.download({'hash': 'A', 'download': '/a'})
+        downloader.download({'hash': 'B', 'download': '/b'})
+    finally:
+        downloader.close()
+
+    assert server.calls == {'/a': 1}
+
+
+def test_download_all_bounds_the_downloads_in_flight(tmp_path, server):
+    replays = list(map(lambda x: {'hash': f'R{x}', 'download': f'/slow/{x}'}, range(20)))
+    replays.append({'hash': 'M', 'download': '/missing'})
+    done = []
+    failed = []
+
+    downloader = make_downloader(tmp_path, server, max_in_flight=3, retries=0)
+    try:
+        downloader.download_all(iter(replays), lambda x: done.append(x['hash']),
+                                lambda x: failed.append(x['hash']))
+    finally:
+        downloader.close()
+
+    # download_all only returns once every callback ran
+    assert sorted(done) == sorted(map(lambda x: f'R{x}', range(20)))
+    assert failed == ['M']
+    assert 1 < server.max_in_flight <= 3
+    assert read_replay(tmp_path, 'R7') == b'/slow/7' * 100
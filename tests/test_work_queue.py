@@ -0,0 +1,154 @@
+import pytest
+from sqlalchemy import select
+from database import Database, ReplayRecord, StateRecord
+from work_queue import WorkQueue, PENDING, LEASED, DONE, FAILED
+from worker import Job, write_results
+
+HASHES = ['A', 'B', 'C', 'D']
+
+
+class StateJob(Job):
+    # writes a state row per result, or fails halfway through its write with fail_after set
+    name = 'test'
+    fail_after = None
+
+    def write(self, connection, results):
+        for i, (replay_hash, value) in enumerate(results):
+            if i == self.fail_after:
+                raise RuntimeError('write failed')
+            connection.execute(StateRecord.__table__.insert(), key=f'result.{replay_hash}', value=value)
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path))
+    db.engine.execute(ReplayRecord.__table__.insert(), list(map(lambda x: {'hash': x}, HASHES)))
+    yield db
+    db.close()
+
+
+def make_queue(db: Database, owner: str, **kwargs):
+    return WorkQueue(db, 'test', owner, **kwargs)
+
+
+def states(db: Database):
+    t = WorkQueue(db, 'test').table
+    return dict(map(tuple, db.engine.execute(select([t.c.hash, t.c.state]))))
+
+
+def results(db: Database):
+    t = StateRecord.__table__
+    return sorted(map(lambda x: x[0], db.engine.execute(select([t.c.key]).where(t.c.key.like('result.%')))))
+
+
+def test_enqueue_skips_queued_tasks(db):
+    queue = make_queue(db, 'a')
+    assert queue.enqueue(select([ReplayRecord.__table__.c.hash])) == 4
+    assert queue.enqueue(select([ReplayRecord.__table__.c.hash])) == 0
+    assert queue.status() == {PENDING: 4, LEASED: 0, DONE: 0, FAILED: 0}
+
+
+def test_leases_are_disjoint(db):
+    a = make_queue(db, 'a')
+    b = make_queue(db, 'b')
+    a.enqueue(select([ReplayRecord.__table__.c.hash]))
+
+    leased_a = a.lease(3)
+    leased_b = b.lease(3)
+    assert len(leased_a) == 3
+    assert len(leased_b) == 1
+    assert set(leased_a).isdisjoint(leased_b)
+    assert b.lease(3) == []
+
+
+def test_expired_lease_goes_to_the_next_worker(db):
+    # a negative lease runs out right away, like the lease of a worker that died
+    a = make_queue(db, 'a', lease_seconds=-1)
+    b = make_queue(db, 'b')
+    a.enqueue(select([ReplayRecord.__table__.c.hash]))
+
+    assert sorted(a.lease(2)) == ['A', 'B']
+    assert a.status()[PENDING] == 4
+    assert sorted(b.lease(2)) == ['A', 'B']
+
+    # the first worker no longer holds them, so it can neither complete nor fail them
+    assert a.complete(['A', 'B']) == 0
+    assert a.fail(['A'], 'late') == 0
+    assert b.complete(['A', 'B']) == 2
+    assert states(db) == {'A': DONE, 'B': DONE, 'C': PENDING, 'D': PENDING}
+
+
+def test_expired_lease_on_the_last_attempt_fails(db):
+    a = make_queue(db, 'a', lease_seconds=-1, max_attempts=2)
+    a.enqueue(select([ReplayRecord.__table__.c.hash]))
+
+    assert sorted(a.lease(1)) == ['A']
+    assert sorted(a.lease(1)) == ['A']
+    # the next lease finds the second attempt expired as well
+    assert sorted(a.lease(1)) == ['B']
+    assert states(db)['A'] == FAILED
+
+
+def test_retry_failed(db):
+    a = make_queue(db, 'a', max_attempts=1)
+    a.enqueue(select([ReplayRecord.__table__.c.hash]))
+
+    assert sorted(a.lease(2)) == ['A', 'B']
+    assert a.fail(['A', 'B'], 'broken') == 2
+    assert a.status() == {PENDING: 2, LEASED: 0, DONE: 0, FAILED: 2}
+    assert sorted(a.lease(4)) == ['C', 'D']
+
+    assert a.retry_failed() == 2
+    assert a.status() == {PENDING: 2, LEASED: 2, DONE: 0, FAILED: 0}
+    assert sorted(a.lease(4)) == ['A', 'B']
+
+
+def test_release_keeps_the_attempt(db):
+    a = make_queue(db, 'a', max_attempts=1)
+    a.enqueue(select([ReplayRecord.__table__.c.hash]))
+
+    assert sorted(a.lease(2)) == ['A', 'B']
+    assert a.release(['A', 'B']) == 2
+    assert sorted(a.lease(2)) == ['A', 'B']
+
+
+def test_write_results_completes_the_tasks_with_the_results(db):
+    queue = make_queue(db, 'a')
+    queue.enqueue(select([ReplayRecord.__table__.c.hash]))
+    job = StateJob(db, '', 'a')
+
+    leased = queue.lease(2)
+    write_results(job, queue, list(map(lambda x: (x, '1'), leased)))
+
+    assert results(db) == sorted(map(lambda x: f'result.{x}', leased))
+    assert queue.status() == {PENDING: 2, LEASED: 0, DONE: 2, FAILED: 0}
+
+
+def test_write_results_is_atomic(db):
+    queue = make_queue(db, 'a')
+    queue.enqueue(select([ReplayRecord.__table__.c.hash]))
+    job = StateJob(db, '', 'a')
+    job.fail_after = 1
+
+    leased = queue.lease(2)
+    with pytest.raises(RuntimeError):
+        write_results(job, queue, list(map(lambda x: (x, '1'), leased)))
+
+    # neither the row written before the failure nor the completion is committed
+    assert results(db) == []
+    assert queue.status() == {PENDING: 2, LEASED: 2, DONE: 0, FAILED: 0}
+
+
+def test_write_results_drops_tasks_no_longer_held(db):
+    a = make_queue(db, 'a', lease_seconds=-1)
+    b = make_queue(db, 'b')
+    a.enqueue(select([ReplayRecord.__table__.c.hash]))
+
+    assert sorted(a.lease(2)) == ['A', 'B']
+    assert sorted(b.lease(1)) == ['A']
+
+    # a's lease on B ran out too but nobody took it, so it is renewed and completed with the result
+    write_results(StateJob(db, '', 'a'), a, [('A', '1'), ('B', '1')])
+
+    assert results(db) == ['result.B']
+    assert states(db) == {'A': LEASED, 'B': DONE, 'C': PENDING, 'D': PENDING}
@@ -0,0 +1,152 @@
+import os
+import uuid
+import socket
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, bindparam, literal, and_, or_, case
+from database import Database, TaskRecord, insert_ignore
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def default_owner():
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+class WorkQueue(object):
+    # tasks of one job keyed by replay hash in the task table. Workers anywhere lease batches, a lease that is not
+    # completed, failed or renewed before it expires goes back to the queue. Completing and failing only apply to
+    # tasks the worker still holds, so a worker whose lease ran out can not overwrite the outcome of the next one
+
+    def __init__(self, db: Database, job: str, owner: str = None, lease_seconds: float = 600, max_attempts: int = 3):
+        self.db = db
+        self.job = job
+        self.owner = owner or default_owner()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.table = TaskRecord.__table__
+
+    def enqueue(self, source):
+        # source is a select of replay hashes, the ones already queued for this job are left alone whatever their
+        # state so finished work is never redone
+        t = self.table
+        source = source.alias('source')
+        query = select([literal(self.job), list(source.c)[0], literal(PENDING), literal(0)])
+
+        insert = insert_ignore(self.db.engine, t).from_select(['job', 'hash', 'state', 'attempts'], query)
+
+        with self.db.engine.begin() as connection:
+            before = connection.execute(select([func.count()]).where(t.c.job == self.job)).scalar()
+            connection.execute(insert)
+            after = connection.execute(select([func.count()]).where(t.c.job == self.job)).scalar()
+        return after - before
+
+    def claimable(self, now: datetime):
+        t = self.table
+        return and_(t.c.job == self.job, t.c.attempts < self.max_attempts,
+                    or_(t.c.state == PENDING, and_(t.c.state == LEASED, t.c.lease_expires < now)))
+
+    def lease(self, count: int):
+        # claims up to count tasks and returns their hashes. Workers racing for the same rows get disjoint sets, the
+        # claim is one update and the condition is checked again on the rows it locks
+        t = self.table
+        now = datetime.utcnow()
+        lease_id = uuid.uuid4().hex
+        claimable = self.claimable(now)
+        candidates = select([t.c.hash]).where(claimable).order_by(t.c.hash).limit(count) \
+            .with_for_update(skip_locked=True)
+
+        with self.db.engine.begin() as connection:
+            # tasks whose worker died on their last attempt
+            connection.execute(t.update().where(and_(t.c.job == self.job, t.c.state == LEASED, t.c.lease_expires < now,
+                                                     t.c.attempts >= self.max_attempts))
+                               .values(state=FAILED, lease_id=None, owner=None, updated=now,
+                                       error=func.coalesce(t.c.error, 'Lease expired on the last attempt')))
+            connection.execute(t.update().where(and_(claimable, t.c.hash.in_(candidates)))
+                               .values(state=LEASED, lease_id=lease_id, owner=self.owner, attempts=t.c.attempts + 1,
+                                       lease_expires=now + timedelta(seconds=self.lease_seconds), updated=now))
+            return list(map(lambda x: x[0], connection.execute(
+                select([t.c.hash]).where(and_(t.c.job == self.job, t.c.lease_id == lease_id)))))
+
+    def held(self, hashes=None):
+        t = self.table
+        condition = and_(t.c.job == self.job, t.c.owner == self.owner, t.c.state == LEASED)
+        return condition if hashes is None else and_(condition, t.c.hash.in_(bindparam('hashes', expanding=True)))
+
+    def _update(self, hashes, connection, **values):
+        hashes = list(hashes)
+        if len(hashes) == 0:
+            return 0
+
+        statement = self.table.update().where(self.held(hashes)).values(updated=datetime.utcnow(), **values)
+        rows = 0
+        for i in range(0, len(hashes), 500):
+            if connection is None:
+                with self.db.engine.begin() as c:
+                    rows += c.execute(statement, hashes=hashes[i:i + 500]).rowcount
+            else:
+                rows += connection.execute(statement, hashes=hashes[i:i + 500]).rowcount
+        return rows
+
+    def renew(self):
+        # extends every lease this worker holds, call it well within lease_seconds when a batch runs long
+        with self.db.engine.begin() as connection:
+            return connection.execute(self.table.update().where(self.held()).values(
+                lease_expires=datetime.utcnow() + timedelta(seconds=self.lease_seconds))).rowcount
+
+    def confirm(self, hashes, connection):
+        # renews the leases of the hashes this worker still holds and returns those. Run it first in the transaction
+        # that writes the results, the update locks the rows so no other worker can lease them before the commit
+        hashes = list(hashes)
+        t = self.table
+        held = []
+        expires = datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            connection.execute(t.update().where(self.held(chunk)).values(lease_expires=expires), hashes=chunk)
+            held += map(lambda x: x[0], connection.execute(select([t.c.hash]).where(self.held(chunk)), hashes=chunk))
+        return held
+
+    def complete(self, hashes, connection=None):
+        # pass the connection of the transaction that wrote the results to finish the tasks atomically with them,
+        # completing a task twice or one that is no longer held does nothing
+        return self._update(hashes, connection, state=DONE, lease_id=None, owner=None, lease_expires=None,
+                            error=None)
+
+    def fail(self, hashes, error: str, connection=None):
+        # back to pending, or failed for good once the attempts are used up
+        t = self.table
+        return self._update(hashes, connection, state=case([(t.c.attempts >= self.max_attempts, FAILED)],
+                                                           else_=PENDING),
+                            lease_id=None, owner=None, lease_expires=None, error=error[:2000])
+
+    def release(self, hashes, connection=None):
+        # hands back tasks this worker did not get to without using up an attempt
+        t = self.table
+        return self._update(hashes, connection, state=PENDING, attempts=t.c.attempts - 1, lease_id=None, owner=None,
+                            lease_expires=None)
+
+    def retry_failed(self):
+        t = self.table
+        with self.db.engine.begin() as connection:
+            return connection.execute(t.update().where(and_(t.c.job == self.job, t.c.state == FAILED))
+                                      .values(state=PENDING, attempts=0, updated=datetime.utcnow())).rowcount
+
+    def status(self):
+        # task counts by state, leases that ran out count as pending
+        t = self.table
+        now = datetime.utcnow()
+        state = case([(and_(t.c.state == LEASED, t.c.lease_expires < now), PENDING)], else_=t.c.state)
+        rows = self.db.engine.execute(select([state, func.count()]).where(t.c.job == self.job).group_by(state))
+        counts = dict.fromkeys([PENDING, LEASED, DONE, FAILED], 0)
+        counts.update(map(tuple, rows))
+        return counts
+
+    def remaining(self):
+        counts = self.status()
+        return counts[PENDING] + counts[LEASED]
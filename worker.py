@@ -0,0 +1,294 @@
+import os
+import time
+import socket
+import logging
+import argparse
+import multiprocessing
+from sqlalchemy import select
+from database import Database, ReplayRecord, ItemsExtracted, write_extractions
+from discovery import replays_without_items, replays_not_extracted, extracted_without_goals
+from heatmap_store import HeatmapStore
+from work_queue import WorkQueue
+import extract_item_events
+import extraction
+import extract_goals
+import generate_average_heatmaps
+
+log = logging.getLogger(__name__)
+
+
+class Job(object):
+    # a kind of task the queue hands out. source() selects the hashes to enqueue, inputs() loads what process()
+    # needs for leased hashes, process() returns None when it failed and write() stores the results inside the
+    # transaction that completes the tasks, so a task is done exactly when its results are in
+    name = None
+
+    def __init__(self, db: Database, directory: str, worker_name: str):
+        self.db = db
+        self.directory = directory
+        self.worker_name = worker_name
+
+    @staticmethod
+    def source():
+        raise NotImplementedError
+
+    def inputs(self, hashes):
+        return list(map(lambda x: (x, x), hashes))
+
+    def process(self, replay_hash: str, task):
+        raise NotImplementedError
+
+    def write(self, connection, results):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ReplayJob(Job):
+    # jobs on replays from the listing, written like the extraction writer writes them
+
+    def inputs(self, hashes):
+        replays = self.db.Session().query(ReplayRecord).filter(ReplayRecord.hash.in_(hashes))
+        return list(map(lambda x: (x.hash, x.as_dict()), replays))
+
+    def write(self, connection, results):
+        # replace makes a retried task overwrite what an earlier attempt wrote
+        write_extractions(connection, list(map(lambda x: (True,) + x[1], results)))
+
+
+class ItemEventsJob(ReplayJob):
+    name = 'item_events'
+
+    @staticmethod
+    def source():
+        return select([ReplayRecord.__table__.c.hash]).where(replays_without_items())
+
+    def process(self, replay_hash: str, task):
+        events, replay_data = extract_item_events.process_replay(task, self.directory)
+        return None if replay_data is None else (replay_data, events, None)
+
+
+class ExtractionJob(ReplayJob):
+    name = 'extraction'
+
+    def __init__(self, db: Database, directory: str, worker_name: str):
+        super().__init__(db, directory, worker_name)
+        self.extractors = list(map(lambda x: x(), extraction.EXTRACTORS.values()))
+
+    @staticmethod
+    def source():
+        return select([ReplayRecord.__table__.c.hash]).where(replays_not_extracted())
+
+    def process(self, replay_hash: str, task):
+        result = extraction.extract_replay(task, self.directory, self.extractors)
+        return None if result is None else (result['replay'], result['items'], result['goals'])
+
+
+class GoalsJob(ReplayJob):
+    name = 'goals'
+
+    @staticmethod
+    def source():
+        return select([ItemsExtracted.__table__.c.hash]).where(extracted_without_goals())
+
+    def inputs(self, hashes):
+        return list(map(lambda x: (x, x), hashes))
+
+    def process(self, replay_hash: str, task):
+        goals = extract_goals.process(task, self.directory)
+        return None if goals is None else ({'hash': task}, None, goals)
+
+
+class HeatmapJob(Job):
+    # every worker folds into its own store under heatmaps/workers/, generate_average_heatmaps.py sums them up.
+    # The store remembers the hashes it holds, so a task retried after its store commit is not counted twice
+    name = 'heatmaps'
+
+    def __init__(self, db: Database, directory: str, worker_name: str):
+        super().__init__(db, directory, worker_name)
+        self.store_dir = os.path.join(directory, 'heatmaps')
+        self.store = HeatmapStore(os.path.join(self.store_dir, 'workers', worker_name),
+                                  (generate_average_heatmaps.ITEM_COUNT,) + generate_average_heatmaps.heatmap_bins)
+        self.others = {}
+
+    @staticmethod
+    def source():
+        parent = ItemsExtracted.__table__
+        return select([parent.c.hash]).where(parent.c.map.isnot(None))
+
+    def inputs(self, hashes):
+        parent = ItemsExtracted.__table__
+        replays = self.db.engine.execute(select([parent.c.hash, parent.c.avg_rank, parent.c.match_date, parent.c.map])
+                                         .where(parent.c.hash.in_(hashes)))
+        return list(map(lambda x: (x['hash'], generate_average_heatmaps.get_heatmap_key(x)), replays))
+
+    def process(self, replay_hash: str, task):
+        h = generate_average_heatmaps.process(replay_hash, self.directory)
+        return None if h is None else (task, h)
+
+    def write(self, connection, results):
+        # generate_average_heatmaps.py adds every store up, so a replay any of them holds already is skipped. That is
+        # a replay from the main store or one whose task an earlier worker committed but failed to complete
+        included = set(self.store.included_hashes())
+        for store in self.other_stores():
+            included.update(store.included_hashes())
+
+        hashes = []
+        for replay_hash, (key, h) in results:
+            if replay_hash not in included:
+                self.store.add(key, h)
+                hashes.append(replay_hash)
+                included.add(replay_hash)
+        self.store.commit(hashes)
+
+    def other_stores(self):
+        # kept open between batches so that only the hash files committed since are read
+        workers = os.path.join(self.store_dir, 'workers')
+        names = os.listdir(workers) if os.path.isdir(workers) else []
+        directories = [self.store_dir] + list(map(lambda x: os.path.join(workers, x), names))
+        for directory in filter(lambda x: x != self.store.directory, directories):
+            if directory in self.others:
+                self.others[directory].reload()
+            else:
+                self.others[directory] = HeatmapStore(directory, self.store.shape)
+        return self.others.values()
+
+
+JOBS = dict(map(lambda x: (x.name, x), [ItemEventsJob, ExtractionJob, GoalsJob, HeatmapJob]))
+
+
+def write_results(job: Job, queue: WorkQueue, results):
+    with job.db.engine.begin() as connection:
+        # a task whose lease ran out may be with another worker already, its result is left to that one
+        held = set(queue.confirm(map(lambda x: x[0], results), connection))
+        if len(held) < len(results):
+            log.warning(f'Dropping {len(results) - len(held)} results of tasks that are no longer leased to '
+                        f'{queue.owner}')
+
+        results = list(filter(lambda x: x[0] in held, results))
+        job.write(connection, results)
+        queue.complete(map(lambda x: x[0], results), connection)
+
+
+def process_batch(job: Job, queue: WorkQueue, hashes):
+    results = []
+    failed = []
+    renewed = time.monotonic()
+    inputs = job.inputs(hashes)
+
+    # hashes that are queued but no longer in the source table
+    missing = set(hashes) - set(map(lambda x: x[0], inputs))
+    if len(missing) > 0:
+        queue.fail(missing, 'Not found')
+
+    for replay_hash, task in inputs:
+        try:
+            result = job.process(replay_hash, task)
+        except Exception as e:
+            log.error(f'Failed to handle {replay_hash}', exc_info=e)
+            result = None
+
+        if result is None:
+            failed.append(replay_hash)
+        else:
+            results.append((replay_hash, result))
+
+        if time.monotonic() - renewed > queue.lease_seconds / 3:
+            queue.renew()
+            renewed = time.monotonic()
+
+    try:
+        write_results(job, queue, results)
+    except Exception as e:
+        # one bad replay should not fail the whole batch
+        log.error(f'Failed to write a batch of {len(results)}, retrying them one by one', exc_info=e)
+        for result in results:
+            try:
+                write_results(job, queue, [result])
+            except Exception as e:
+                log.error(f'Failed to write {result[0]}', exc_info=e)
+                queue.fail([result[0]], f'{type(e).__name__}: {e}')
+
+    if len(failed) > 0:
+        queue.fail(failed, 'Processing failed, see the worker log')
+
+    return len(results), len(failed)
+
+
+def run_worker(directory: str, job_name: str, worker_name: str, batch_size: int, lease_seconds: float,
+               max_attempts: int, poll_interval: float, follow: bool):
+    db = Database(directory)
+    queue = WorkQueue(db, job_name, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    job = JOBS[job_name](db, directory, worker_name)
+    done = 0
+    failed = 0
+    hashes = []
+
+    log.info(f'Worker {queue.owner} started on {job_name}')
+
+    try:
+        while True:
+            hashes = queue.lease(batch_size)
+            if len(hashes) == 0:
+                # tasks leased by others may still come back when their worker dies
+                if not follow and queue.remaining() == 0:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            batch_done, batch_failed = process_batch(job, queue, hashes)
+            done += batch_done
+            failed += batch_failed
+            hashes = []
+            log.info(f'Worker {queue.owner}: {done} done, {failed} failed')
+    finally:
+        # tasks of an interrupted batch go back to the queue right away instead of waiting for the lease to run out
+        if len(hashes) > 0:
+            queue.release(hashes)
+        job.close()
+        db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Works off the task queue in the database, run it on any number of '
+                                                 'machines that share the database and the replay directory')
+    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('-j', '--job', type=str, choices=list(JOBS.keys()), required=True)
+    parser.add_argument('-p', '--processes', type=int, default=1, help='Worker processes on this machine')
+    parser.add_argument('-n', '--name', type=str, default=socket.gethostname(),
+                        help='Unique name of this machine, heatmap workers keep their store under it')
+    parser.add_argument('--batch-size', type=int, default=50, help='Tasks leased at a time')
+    parser.add_argument('--lease', type=float, default=600, help='Seconds before the tasks of a silent worker are '
+                                                                 'handed out again')
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--poll-interval', type=float, default=5.0)
+    parser.add_argument('--follow', action='store_true', help='Keep waiting for new tasks when the queue is empty')
+    parser.add_argument('--enqueue', action='store_true', help='Queue the replays the job has not seen yet first')
+    parser.add_argument('--retry-failed', action='store_true', help='Queue the failed tasks again first')
+    parser.add_argument('--status', action='store_true', help='Print the task counts and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(processName)s %(message)s')
+
+    db = Database(args.directory)
+    queue = WorkQueue(db, args.job, max_attempts=args.max_attempts)
+
+    if args.enqueue:
+        log.info(f'Queued {queue.enqueue(JOBS[args.job].source())} {args.job} tasks')
+    if args.retry_failed:
+        log.info(f'Queued {queue.retry_failed()} failed {args.job} tasks again')
+
+    print(queue.status())
+    db.close()
+
+    if not args.status:
+        workers = list(map(lambda x: multiprocessing.Process(
+            target=run_worker, name=f'{args.job}-{x}',
+            args=(args.directory, args.job, f'{args.name}-{x}', args.batch_size, args.lease, args.max_attempts,
+                  args.poll_interval, args.follow)), range(args.processes)))
+
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()